@@ -2,25 +2,35 @@ from panels import *
 from plots import *
 from glob import glob
 import dash_html_components as html
+from multidriftdetector.state_log import ColumnarLog, is_columnar
 
 def get_plots(streams):
     return [ stream.get_plot() for stream in streams ]
 
+def load_streams(group_dir, stream_class):
+    '''
+    Load every stream in a group directory, from the columnar layout if the
+    detector wrote one, and otherwise from the per-stream csv files.
+    '''
+    if not is_columnar(group_dir):
+        return [ stream_class(path) for path in sorted(list(glob(group_dir+'/*.csv'))) ]
+    log = ColumnarLog(group_dir)
+    streams = []
+    for name in sorted(log.names):
+        values, statuses, descriptions = log.stream(name)
+        content = pd.DataFrame({'value': values, 'status': statuses, 'description': descriptions})
+        streams.append(stream_class(os.path.join(group_dir, name+'.csv'), content))
+    return streams
+
 def get_layout(dir):
 
     ####################
     ### LOADING DATA ###
     ####################
 
-    acc_path = os.path.join(dir, 'accuracy.csv')
-    acc_stream = AccuracyStream(acc_path)
-
-    feature_streams = []
-    for feature_path in sorted(list(glob(dir+'/features/*.csv'))):
-        feature_streams.append(FeatureStream(feature_path))
-    label_streams = []
-    for label_path in sorted(list(glob(dir+'/predictions/*.csv'))):
-        label_streams.append(LabelStream(label_path))
+    acc_stream = load_streams(os.path.join(dir, 'accuracy'), AccuracyStream)[0]
+    feature_streams = load_streams(os.path.join(dir, 'features'), FeatureStream)
+    label_streams = load_streams(os.path.join(dir, 'predictions'), LabelStream)
 
     ######################
     ### CONTROL PANELS ###
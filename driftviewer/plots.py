@@ -15,13 +15,14 @@ class DataStream:
         DataStream.STREAM_COUNT += 1
         return f'Plot-{DataStream.STREAM_COUNT}'
 
-    def __init__(self, path):
+    def __init__(self, path, content=None):
 
         self.id_ = DataStream.get_panel_id()
 
         self.path = path
         self.title = re.match('.+/(\w+).csv', path).group(1)
-        content = pd.read_csv(path)
+        if content is None:
+            content = pd.read_csv(path)
 
         self.x = self.X = list(content.index)
         self.y = self.Y = np.array(content.value, dtype='float32')
@@ -112,8 +113,8 @@ class AccuracyStream(DataStream):
 
     acc_stream = []
 
-    def __init__(self, path):
-        super().__init__(path)
+    def __init__(self, path, content=None):
+        super().__init__(path, content)
         AccuracyStream.acc_stream = self
 
     @staticmethod
@@ -138,8 +139,8 @@ class FeatureStream(DataStream):
     def register(self):
         FeatureStream.streams.append(self)
 
-    def __init__(self, path):
-        super().__init__(path)
+    def __init__(self, path, content=None):
+        super().__init__(path, content)
         self.register()
 
     @staticmethod
@@ -187,8 +188,8 @@ class LabelStream(DataStream):
     def register(self):
         LabelStream.streams.append(self)
 
-    def __init__(self, path):
-        super().__init__(path)
+    def __init__(self, path, content=None):
+        super().__init__(path, content)
         self.register()
 
     @staticmethod
@@ -0,0 +1,250 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import tracemalloc
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+import numpy as np
+
+repo_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, repo_path)
+
+from multidriftdetector.multidriftdetector import MultiDriftDetector
+from multidriftdetector.instrumentation import Instrumentation
+
+'''
+Benchmarks MultiDriftDetector on synthetic referral streams.
+
+Each configuration is run in a fresh process, so that its peak RSS is its own.
+The results are printed, and appended to a history file (one json object per
+line), along with the change in throughput since the last run of the same configuration.
+
+e.g.
+(triage_drift_env)$ python experiments/benchmark_detector.py --features 10 1000 50000 --vectorized
+'''
+
+##################################
+## Generate a synthetic stream ##
+##################################
+
+def generate_stream(n_features, n_labels, n_instances, drift_points, seed=0):
+    '''
+    Generate the features, model predictions and true labels of a stream of referrals.
+    At each of drift_points (fractions of the way through the stream), the rates of
+    a tenth of the features change, the predicted labels shift, and the model's
+    accuracy drops.
+    '''
+
+    rng = np.random.default_rng(seed)
+    feature_rates = rng.random(n_features) ** 4 # mostly rare, like bag-of-words features
+    label_rates = rng.dirichlet(np.ones(n_labels))
+    accuracy = 0.9
+
+    features = np.empty((n_instances, n_features), dtype=np.uint8)
+    predictions = np.empty((n_instances, n_labels))
+    labels = np.empty(n_instances, dtype=int)
+
+    boundaries = [0] + [ int(point * n_instances) for point in sorted(drift_points) ] + [n_instances]
+    for concept, (start, end) in enumerate(zip(boundaries[:-1], boundaries[1:])):
+        if concept > 0:
+            drifted = rng.choice(n_features, max(1, n_features // 10), replace=False)
+            feature_rates[drifted] = rng.random(len(drifted))
+            label_rates = rng.dirichlet(np.ones(n_labels))
+            accuracy *= 0.8
+        n = end - start
+        features[start:end] = rng.random((n, n_features)) < feature_rates
+        predicted = rng.choice(n_labels, n, p=label_rates)
+        predictions[start:end] = rng.dirichlet(np.ones(n_labels), n)
+        predictions[start+np.arange(n), predicted] += 1
+        correct = rng.random(n) < accuracy
+        labels[start:end] = np.where(correct, predicted, rng.integers(0, n_labels, n))
+
+    return features, predictions, labels
+
+#########################
+## Run one benchmark ##
+#########################
+
+def run_benchmark(config):
+    '''
+    Run the detector over a synthetic stream, with the settings in config,
+    and return the measurements.
+
+    The stream is run twice: once as it is, for the throughput, and once
+    instrumented, for the latencies and bytes written. (The instrumentation
+    times every stream, which slows the detector down too much to time it as well.)
+    '''
+
+    stream = generate_stream(
+        config['features'], config['labels'], config['instances'], config['drift_points'])
+
+    elapsed, bytes_per_stream, bytes_with_log, _, _ = run_stream(config, stream)
+    _, _, _, stats, bytes_on_disk = run_stream(config, stream, instrument=True)
+
+    return {
+        'instances_per_sec': config['instances'] / elapsed,
+        'seconds': elapsed,
+        'latency_ns': { name: { key: latency[key] for key in ['p50_ns', 'p99_ns', 'count'] }
+            for name, latency in stats['latency'].items() },
+        'bytes_per_stream': bytes_per_stream,
+        'bytes_per_stream_with_log': bytes_with_log,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'bytes_written': stats['counters'].get('bytes_written', 0),
+        'bytes_on_disk': bytes_on_disk,
+    }
+
+def run_stream(config, stream, instrument=False):
+    '''
+    Run a fresh detector over the stream. Returns the seconds taken, the bytes
+    taken by each feature stream (on its own, and with its state log), the
+    Instrumentation stats (if instrument is True), and the bytes written to disk.
+    '''
+
+    features, predictions, labels = stream
+    feature_names = [ f'feature{j}' for j in range(config['features']) ]
+    label_names = [ f'label{k}' for k in range(config['labels']) ]
+    n_instances = config['instances']
+    delay = config['label_delay']
+    batch_size = config['batch_size']
+
+    write_dir = tempfile.mkdtemp(prefix='benchmark_detector_')
+    try:
+        detector = MultiDriftDetector(write_dir, drift_action=lambda event: None, storage=config['storage'])
+        # The memory taken by each feature's stream on its own, and with its share
+        # of the state log (the open files and their buffers).
+        tracemalloc.start()
+        streams = detector.make_feature_streams(feature_names, vectorized=config['vectorized'])
+        bytes_per_stream = tracemalloc.get_traced_memory()[0] / config['features']
+        del streams
+        tracemalloc.stop()
+        tracemalloc.start()
+        detector.set_features(feature_names, vectorized=config['vectorized'])
+        bytes_with_log = tracemalloc.get_traced_memory()[0] / config['features']
+        tracemalloc.stop()
+        detector.set_labels(label_names, vectorized=config['vectorized'])
+        if config.get('shards'):
+            detector.shard_features(config['shards'])
+        stats = Instrumentation().attach(detector) if instrument else None
+
+        start = time.perf_counter()
+        if batch_size == 1:
+            for i in range(n_instances):
+                detector.add_instance(features[i], i)
+                detector.add_prediction(predictions[i], i)
+                # Labels arrive label_delay instances after their prediction.
+                if i >= delay:
+                    detector.add_label(label_names[labels[i-delay]], i-delay)
+        else:
+            for i in range(0, n_instances, batch_size):
+                ids = range(i, min(i+batch_size, n_instances))
+                detector.add_instances(features[ids.start:ids.stop], ids)
+                detector.add_predictions(predictions[ids.start:ids.stop], ids)
+                labelled = range(max(ids.start-delay, 0), max(ids.stop-delay, 0))
+                detector.add_labels([ label_names[k] for k in labels[labelled.start:labelled.stop] ], labelled)
+        detector.close()
+        elapsed = time.perf_counter() - start
+
+        if instrument:
+            stats = stats.get_stats()
+        bytes_on_disk = sum(
+            os.path.getsize(os.path.join(root, fname))
+            for root, _, fnames in os.walk(write_dir) for fname in fnames
+        )
+    finally:
+        shutil.rmtree(write_dir, ignore_errors=True)
+
+    return elapsed, bytes_per_stream, bytes_with_log, stats, bytes_on_disk
+
+#############################
+## Keep a history of runs ##
+#############################
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_path,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def read_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [ json.loads(line) for line in f if line.strip() ]
+
+def previous_result(history, config):
+    # The most recent result for the same configuration.
+    for entry in reversed(history):
+        if entry['config'] == config:
+            return entry['results']
+    return None
+
+def run_benchmarks(configs, history_path):
+
+    history = read_history(history_path)
+    commit = get_commit()
+
+    for config in configs:
+
+        # A fresh process for each configuration, so that the peak RSS is its own.
+        with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as pool:
+            results = pool.submit(run_benchmark, config).result()
+
+        previous = previous_result(history, config)
+        change = ''
+        if previous is not None:
+            ratio = results['instances_per_sec'] / previous['instances_per_sec']
+            change = f' ({100*(ratio-1):+.1f}% on last run)'
+        # With batches, the latency is of a whole call to add_instances.
+        entry_point = 'add_instance' if config['batch_size'] == 1 else 'add_instances'
+        add_instance = results['latency_ns'][entry_point]
+        streams = 'vectorized' if config['vectorized'] else 'DataStreams'
+        if config.get('shards'):
+            streams += f" in {config['shards']} shards"
+        print(f"{config['features']:>6} features, {streams}, "
+            f"{config['storage']}, batch {config['batch_size']}: "
+            f"{results['instances_per_sec']:.0f} instances/sec{change}, "
+            f"{entry_point} p50 {add_instance['p50_ns']/1e3:.0f}us p99 {add_instance['p99_ns']/1e3:.0f}us, "
+            f"{results['bytes_per_stream']:.0f} bytes/stream ({results['bytes_per_stream_with_log']:.0f} with its log), peak RSS {results['peak_rss_mb']:.0f}MB, {results['bytes_on_disk']/2**20:.1f}MB written")
+
+        entry = {'time': time.time(), 'commit': commit, 'config': config, 'results': results}
+        history.append(entry)
+        with open(history_path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark MultiDriftDetector on synthetic streams.')
+    parser.add_argument('--features', type=int, nargs='+', default=[10, 1000], help='the numbers of features to benchmark')
+    parser.add_argument('--labels', type=int, default=5, help='the number of labels')
+    parser.add_argument('--instances', type=int, default=2000, help='the number of instances in the stream')
+    parser.add_argument('--label-delay', type=int, default=100, help='how many instances later each label arrives')
+    parser.add_argument('--drift-points', type=float, nargs='*', default=[0.5], help='where to inject drift, as fractions of the stream')
+    parser.add_argument('--batch-size', type=int, default=1, help='add instances one at a time (1), or in batches of this size')
+    parser.add_argument('--vectorized', action='store_true', help='monitor the features and labels with a StreamBank')
+    parser.add_argument('--storage', default='csv', choices=['csv', 'columnar'])
+    parser.add_argument('--shards', type=int, default=0, help='split the feature streams across this many processes')
+    parser.add_argument('--history', default=os.path.join(repo_path, 'experiments', 'benchmark_results', 'detector_history.jsonl'))
+    args = parser.parse_args()
+
+    configs = [ {
+        'features': n_features,
+        'labels': args.labels,
+        'instances': args.instances,
+        'label_delay': args.label_delay,
+        'drift_points': args.drift_points,
+        'batch_size': args.batch_size,
+        'vectorized': args.vectorized,
+        'storage': args.storage,
+    } for n_features in args.features ]
+    if args.shards:
+        for config in configs:
+            config['shards'] = args.shards
+
+    run_benchmarks(configs, args.history)
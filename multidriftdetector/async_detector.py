@@ -0,0 +1,221 @@
+import sys
+import asyncio
+import traceback
+import numpy as np
+from multidriftdetector.detector_bank import StreamBank
+from concurrent.futures import ThreadPoolExecutor
+
+class AsyncDetector:
+
+    '''
+    An asyncio front-end to a MultiDriftDetector, so that the detector's file
+    writes don't hold up the event loop.
+
+    add_instance, add_prediction and add_label are coroutines which put the record
+    in a queue of at most max_queue records, and return. A worker task takes the
+    records off the queue up to batch_size at a time, and adds them to the detector
+    in a thread of executor (by default a thread of its own). A run of records of
+    the same kind is added with one call to add_instances, add_predictions or add_labels,
+    and the records are added in the order they were queued, so a label still
+    comes after the prediction it's matched with.
+
+    When the queue is full, overflow decides what happens to a new record:
+    - 'block': wait for there to be room in the queue
+    - 'drop_oldest': drop the oldest record in the queue to make room (counted in dropped)
+    - 'error': raise asyncio.QueueFull
+
+    queue_depth is the number of records waiting.
+
+    An instance or prediction of the wrong shape is rejected by add_instance or
+    add_prediction, before it's queued. If adding a run of records fails anyway,
+    they're added again one at a time, so that only the records which fail are
+    lost (they're counted in failed, and their errors printed to stderr).
+
+    >>> detector = AsyncDetector(MultiDriftDetector(write_dir), overflow='drop_oldest')
+    >>> await detector.add_instance(instance, instance_id)
+    >>> ...
+    >>> await detector.close()
+    '''
+
+    overflow_modes = ['block', 'drop_oldest', 'error']
+
+    def __init__(
+            self,
+            detector, # The MultiDriftDetector to add the records to
+            max_queue=10000, # The most records which can be waiting
+            batch_size=256, # The most records to take off the queue at once
+            overflow='block', # What to do with a record when the queue is full
+            executor=None # Where to run the detector (by default a thread of its own)
+            ):
+        if overflow not in AsyncDetector.overflow_modes:
+            raise ValueError(f'overflow must be one of {AsyncDetector.overflow_modes}, not {overflow!r}.')
+        self.detector = detector
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.overflow = overflow
+        self.own_executor = executor is None
+        self.executor = ThreadPoolExecutor(1) if executor is None else executor
+        self.queue = None
+        self.worker = None
+
+        self.dropped = 0
+        self.added = 0
+        self.batches = 0
+        self.failed = 0
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def start(self):
+        # The queue and worker belong to the running event loop, so they're made
+        # when the first record is added.
+        if self.worker is None:
+            self.queue = asyncio.Queue(self.max_queue)
+            self.worker = asyncio.get_running_loop().create_task(self.run())
+
+    async def add_instance(self, instance, instance_id, description=''):
+        await self.put(('instance', self.check_instance(instance), instance_id, description))
+
+    async def add_prediction(self, prediction, instance_id, description=''):
+        await self.put(('prediction', self.check_prediction(prediction), instance_id, description))
+
+    async def add_label(self, label, instance_id, description=''):
+        await self.put(('label', label, instance_id, description))
+
+    def check_instance(self, instance):
+        # Convert an instance as the detector would, raising ValueError if it isn't one row of features.
+        row = self.detector.as_array(instance)
+        if hasattr(row, 'tocsr') and row.shape[0] != 1 or \
+                not hasattr(row, 'tocsr') and row.size != len(self.detector.feature_names):
+            raise ValueError(f'Expected a single instance, not one of shape {row.shape}.')
+        return row
+
+    def check_prediction(self, prediction):
+        prediction = np.asarray(prediction)
+        if prediction.shape != (len(self.detector.label_names),):
+            raise ValueError(f'Expected {len(self.detector.label_names)} label scores, not an array of shape {prediction.shape}.')
+        return prediction
+
+    async def put(self, record):
+        self.start()
+        if self.overflow == 'block':
+            await self.queue.put(record)
+            return
+        if self.queue.full() and self.overflow == 'drop_oldest':
+            self.queue.get_nowait()
+            self.queue.task_done()
+            self.dropped += 1
+        self.queue.put_nowait(record) # raises asyncio.QueueFull if overflow is 'error'
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            records = [await self.queue.get()]
+            while len(records) < self.batch_size and not self.queue.empty():
+                records.append(self.queue.get_nowait())
+            try:
+                await loop.run_in_executor(self.executor, self.add_records, records)
+            except Exception:
+                # A failing batch shouldn't stop the records after it from being added.
+                traceback.print_exc(file=sys.stderr)
+            for _ in records:
+                self.queue.task_done()
+
+    def add_records(self, records):
+        '''
+        Add a batch of records to the detector, a run of the same kind at a time.
+        '''
+        start = 0
+        for end in range(1, len(records) + 1):
+            if end == len(records) or records[end][0] != records[start][0]:
+                self.added += self.add_run(records[start:end])
+                start = end
+        self.batches += 1
+
+    def add_run(self, records):
+        # Add a run of records of the same kind. Returns how many were added.
+        kind, values, instance_ids, descriptions = zip(*records)
+        detector = self.detector
+        if kind[0] == 'instance' and any(hasattr(row, 'tocsr') for row in values):
+            # Sparse rows are held by the detector anyway (see add_sparse_instance),
+            # or made dense one at a time by add_instance.
+            return sum( self.add_record(record) for record in records )
+        try:
+            # The batch methods check their records before changing anything, so a
+            # batch which fails has added none of them.
+            if kind[0] == 'label':
+                detector.add_labels(list(values), list(instance_ids), list(descriptions))
+            elif kind[0] == 'prediction':
+                detector.add_predictions(np.vstack(values), list(instance_ids), list(descriptions))
+            else:
+                detector.add_instances(np.vstack(values), list(instance_ids), list(descriptions))
+            return len(records)
+        except Exception:
+            if len(records) == 1:
+                self.failed += 1
+                traceback.print_exc(file=sys.stderr)
+                return 0
+        # One at a time, outside the except block so their errors aren't chained to the run's.
+        return sum( self.add_record(record) for record in records )
+
+    def add_record(self, record):
+        # Add one record, as a fallback for a run which failed. Returns 1 if it was added.
+        kind, value, instance_id, description = record
+        detector = self.detector
+        try:
+            if kind == 'label':
+                detector.add_label(value, instance_id, description)
+            elif kind == 'prediction':
+                detector.add_prediction(value, instance_id, description)
+            elif hasattr(value, 'tocsr') and isinstance(detector.feature_streams, StreamBank):
+                detector.add_sparse_instance(value, instance_id, description)
+            else:
+                detector.add_instance(value, instance_id, description)
+            return 1
+        except Exception:
+            self.failed += 1
+            traceback.print_exc(file=sys.stderr)
+            return 0
+
+    async def call(self, method, *args):
+        # Run a method of the detector in the executor, after the records before it.
+        await self.join()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, method, *args)
+
+    async def join(self):
+        '''
+        Wait until every record queued so far has been added to the detector.
+        '''
+        if self.queue is not None:
+            await self.queue.join()
+
+    async def get_status(self, display=False):
+        return await self.call(self.detector.get_status, display)
+
+    async def flush(self, sync=False):
+        '''
+        Add the records waiting, and write the detector's buffered rows to disk.
+        '''
+        await self.call(self.detector.flush, sync)
+
+    async def close(self):
+        '''
+        Add the records waiting, close the detector, and stop the worker.
+        '''
+        await self.call(self.detector.close)
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+        if self.own_executor:
+            self.executor.shutdown()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
@@ -0,0 +1,157 @@
+import math
+from collections import namedtuple
+from functools import lru_cache
+from tornado_mod.drift_detection.__init__ import HDDM_A_test
+
+# The confidences and test type of a detector, and the constants in its Hoeffding bounds.
+# (Bounds pickled before two_sided was added are two-sided, as those detectors behaved.)
+HDDMBounds = namedtuple('HDDMBounds',
+    ['drift_confidence', 'warning_confidence', 'log_bound', 'log_drift', 'log_warning', 'two_sided'],
+    defaults=[True])
+
+@lru_cache(maxsize=None)
+def get_bounds(drift_confidence, warning_confidence, two_sided=True):
+    '''
+    The HDDMBounds for these confidences, with the constants computed as
+    HDDM_A_test computes them. Detectors with the same confidences share one
+    (immutable) HDDMBounds, rather than each keeping its own copy.
+    '''
+    return HDDMBounds(
+        drift_confidence,
+        warning_confidence,
+        math.log(1.0 / drift_confidence, math.e),
+        math.log(2.0 / drift_confidence, math.e),
+        math.log(2.0 / warning_confidence, math.e),
+        two_sided,
+    )
+
+class BidirectionalHDDM:
+
+    '''
+    Tests a binary stream for both increases and decreases with a single set of
+    HDDM_A_test statistics.
+
+    A bidirectional DataStream used to feed a second copy of its detector with the
+    negation of each value. For a binary stream that second detector is fully
+    determined by the first: its count is total_n - total_c, its minimum point is the
+    first detector's maximum point (and vice versa), and its test for an increase is
+    the first detector's test for a decrease. So both directions can be tested from
+    one set of statistics, at half the cost.
+
+    Once either direction signals drift the DataStream stops updating its detector,
+    and as resets only happen on a drift the two directions never need to diverge.
+    So the detector's test_type only matters when just increases are being
+    monitored (see detect_counts).
+    '''
+
+    # There's one of these per stream, so they're kept small.
+    __slots__ = ['bounds', 'n_min', 'c_min', 'total_n', 'total_c', 'n_max', 'c_max']
+
+    def __init__(self, detector):
+
+        if not isinstance(detector, HDDM_A_test):
+            raise ValueError('BidirectionalHDDM can only be made from an HDDM_A_test detector.')
+
+        self.bounds = get_bounds(detector.drift_confidence, detector.warning_confidence,
+            detector.test_type == 'two-sided')
+
+        self.n_min = detector.n_min
+        self.c_min = detector.c_min
+        self.total_n = detector.total_n
+        self.total_c = detector.total_c
+        self.n_max = detector.n_max
+        self.c_max = detector.c_max
+
+    def detect(self, value):
+        '''
+        Add a value to the stream. Returns the warning and drift statuses for an
+        increase and then for a decrease, in the same sense as a DataStream's
+        detector and detector2 respectively.
+        '''
+
+        return self.detect_counts(1, 1 if value is False else 0)
+
+    def detect_counts(self, n, c, bidirectional=True):
+        '''
+        Add n values at once, c of which are False. Returns the same as detect.
+        The statistics are the same as after adding the values one by one, except
+        that the minimum and maximum points can only fall on the last of them.
+
+        If bidirectional is False only increases are being monitored, and as in
+        HDDM_A_test (and HDDMBank.update) a decrease only resets the statistics of
+        a two-sided test.
+        '''
+
+        if n == 0:
+            return False, False, False, False
+        bounds = self.bounds
+        log_bound = bounds.log_bound
+
+        # 1. UPDATING STATS
+        self.total_n += n
+        self.total_c += c
+
+        if self.n_min == 0:
+            self.n_min = self.total_n
+            self.c_min = self.total_c
+
+        if self.n_max == 0:
+            self.n_max = self.total_n
+            self.c_max = self.total_c
+
+        cota = math.sqrt((1.0 / (2 * self.n_min)) * log_bound)
+        cota1 = math.sqrt((1.0 / (2 * self.total_n)) * log_bound)
+        if self.c_min / self.n_min + cota >= self.total_c / self.total_n + cota1:
+            self.c_min = self.total_c
+            self.n_min = self.total_n
+
+        cota = math.sqrt((1.0 / (2 * self.n_max)) * log_bound)
+        if self.c_max / self.n_max - cota <= self.total_c / self.total_n - cota1:
+            self.c_max = self.total_c
+            self.n_max = self.total_n
+
+        # 2. UPDATING WARNING AND DRIFT STATUSES
+        drift_increase = self.mean_incr(bounds.log_drift)
+        warning_increase = not drift_increase and self.mean_incr(bounds.log_warning)
+        drift_decrease = self.mean_decr(bounds.log_drift)
+        warning_decrease = not drift_decrease and self.mean_decr(bounds.log_warning)
+
+        if drift_increase or (drift_decrease and (bidirectional or bounds.two_sided)):
+            self.n_min = self.n_max = self.total_n = 0
+            self.c_min = self.c_max = self.total_c = 0
+
+        return warning_increase, drift_increase, warning_decrease, drift_decrease
+
+    @property
+    def drift_confidence(self):
+        return self.bounds.drift_confidence
+
+    @property
+    def warning_confidence(self):
+        return self.bounds.warning_confidence
+
+    def mean_incr(self, log_confidence):
+        if self.n_min == self.total_n:
+            return False
+        m = (self.total_n - self.n_min) / self.n_min * (1.0 / self.total_n)
+        cota = math.sqrt((m / 2) * log_confidence)
+        return self.total_c / self.total_n - self.c_min / self.n_min >= cota
+
+    def mean_decr(self, log_confidence):
+        if self.n_max == self.total_n:
+            return False
+        m = (self.total_n - self.n_max) / self.n_max * (1.0 / self.total_n)
+        cota = math.sqrt((m / 2) * log_confidence)
+        return self.c_max / self.n_max - self.total_c / self.total_n >= cota
+
+    def __getstate__(self):
+        return { name: getattr(self, name) for name in BidirectionalHDDM.__slots__ }
+
+    def __setstate__(self, state):
+        # Share the bounds again after a restore. (A checkpoint from before the
+        # bounds were shared has the confidences and constants in its state.)
+        bounds = state.get('bounds') or HDDMBounds(**{ field: state[field]
+            for field in HDDMBounds._fields if field in state })
+        self.bounds = get_bounds(bounds.drift_confidence, bounds.warning_confidence, bounds.two_sided)
+        for name in BidirectionalHDDM.__slots__[1:]:
+            setattr(self, name, state[name])
@@ -1,5 +1,13 @@
+import os
+import json
+from itertools import islice
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
-from sklearn.feature_extraction.text import CountVectorizer
+import scipy.sparse
+from sklearn.feature_extraction.text import CountVectorizer, HashingVectorizer
+from multidriftdetector.state_log import get_stream_names
 
 class BOWMachine:
 
@@ -13,45 +21,291 @@ class BOWMachine:
     The difference between them is that convert_train_data establishes
     the vocabulary, whereas convert_online uses the existing vocabulary.
 
-    There is also a static method for converting BOWs from dataframes to arff files.
+    Both return a scipy sparse matrix instead if sparse=True, which takes memory
+    in proportion to the number of non-zero counts rather than documents x vocabulary.
+    If packed=True they return only whether each token is present in each document,
+    packed 8 to a byte (see pack), which MultiDriftDetector.add_packed_instances takes.
+
+    The vectorizer fitted by convert_train_data is kept and reused by
+    convert_online, so online text is tokenized exactly as the training text was.
+
+    Alternatively, if n_buckets is given, each token is hashed into one of
+    n_buckets features (named hash000, hash001, ...) rather than looked up in a
+    vocabulary. Then there is nothing to fit and no vocabulary to keep:
+    the features are known before any text has been seen, and any chunk of text
+    can be converted on its own.
+
+    For large backfills, n_jobs > 1 splits the strings into chunks of chunk_size
+    and tokenizes them in a pool of n_jobs processes. convert_chunks streams the
+    converted chunks back in order; convert_train_data fits the vocabulary from
+    the document frequencies counted by each process.
+
+    oov_tokens() gives the tokens of each string which aren't in the vocabulary,
+    and so are dropped by convert_online (see emerging_tokens.py).
+
+    save() writes the vocabulary and tokenization settings to a small json file,
+    and load() makes a BOWMachine from it without refitting.
     '''
 
-    def __init__(self):
+    # The settings of the CountVectorizer.
+    vectorizer_settings = dict(
+        lowercase=True, # convert to lowercase
+        stop_words='english', # remove English stopwords
+        binary=False, # use counts rather than binary inclusion
+        max_df=0.95, # ignore tokens which occur more than 99% of documents
+        min_df=0.05, # ignore tokens which occur in fewer than 1% documents
+        token_pattern='[A-Za-z]+' # only use pure-alphabetic tokens (no numeric chars)
+    )
+
+    # The settings which determine how text is split into tokens.
+    tokenization = ['lowercase', 'stop_words', 'binary', 'token_pattern']
+
+    def __init__(self, n_buckets=None):
 
         self.vocab = None
+        self.vectorizer = None
+        self.columns = None
+        self.known_tokens = None
+        self.n_buckets = n_buckets
+
+        if n_buckets is not None:
+            vectorizer = HashingVectorizer(
+                n_features=n_buckets,
+                alternate_sign=False, # count tokens, rather than adding and subtracting them
+                norm=None, # keep the raw counts
+                dtype=np.int64,
+                **BOWMachine.tokenization_settings()
+            )
+            self.set_vectorizer(vectorizer, BOWMachine.bucket_names(n_buckets))
+
+    def convert_train_data(self, strings, sparse=False, n_jobs=1, chunk_size=1000, packed=False):
 
-    def convert_train_data(self, strings):
+        # Hashed features don't need to be fitted.
+        if self.n_buckets is not None:
+            return self.convert_online(strings, sparse, n_jobs, chunk_size, packed)
 
         if self.vocab != None:
             raise ValueError('BOWMachine already has a vocabulary. ' + \
                 'Try creating a new BOWMachine or using ' + \
-                'convert_test_data instead.')
-
-        vectorizer = CountVectorizer(
-            lowercase=True, # convert to lowercase
-            stop_words='english', # remove English stopwords
-            binary=False, # use counts rather than binary inclusion
-            max_df=0.95, # ignore tokens which occur more than 99% of documents
-            min_df=0.05, # ignore tokens which occur in fewer than 1% documents
-            token_pattern='[A-Za-z]+' # only use pure-alphabetic tokens (no numeric chars)
-        )
+                'convert_online instead.')
+
+        if n_jobs == 1:
+            vectorizer = CountVectorizer(**BOWMachine.vectorizer_settings)
+            bow_obj = vectorizer.fit_transform(strings)
+            self.set_vectorizer(vectorizer, get_feature_names(vectorizer))
+            return self.to_output(bow_obj, sparse, packed)
+
+        # Count the number of documents each token occurs in, chunk by chunk,
+        # then choose the vocabulary as CountVectorizer.fit would.
+        # The strings are read twice, so an iterator (e.g. a generator) is read into a list first.
+        if iter(strings) is strings:
+            strings = list(strings)
+        document_frequencies = Counter()
+        n_documents = 0
+        analyzer = CountVectorizer(**BOWMachine.vectorizer_settings).build_analyzer()
+        for chunk_frequencies, chunk_documents in map_chunks(
+                count_documents, iter_chunks(strings, chunk_size), n_jobs, analyzer):
+            document_frequencies.update(chunk_frequencies)
+            n_documents += chunk_documents
+        vocab = BOWMachine.limit_vocab(document_frequencies, n_documents)
+
+        vectorizer = CountVectorizer(vocabulary=vocab, **BOWMachine.tokenization_settings())
+        self.set_vectorizer(vectorizer, vocab)
+        return self.convert_online(strings, sparse, n_jobs, chunk_size, packed)
+
+    def convert_online(self, strings, sparse=False, n_jobs=1, chunk_size=1000, packed=False):
+
+        if self.vectorizer is None:
+            raise ValueError('BOWMachine has no vocabulary yet. ' + \
+                'Use convert_train_data first.')
+
+        if n_jobs == 1:
+            bow_obj = self.vectorizer.transform(strings)
+        else:
+            chunks = list(self.convert_chunks(strings, chunk_size, True, n_jobs))
+            if len(chunks) == 0:
+                bow_obj = scipy.sparse.csr_matrix((0, len(self.vocab)), dtype=np.int64)
+            else:
+                bow_obj = scipy.sparse.vstack(chunks)
+
+        return self.to_output(bow_obj, sparse, packed)
+
+    def convert_chunks(self, strings, chunk_size=1000, sparse=True, n_jobs=1, packed=False):
+        '''
+        Convert an iterable of strings chunk_size strings at a time, yielding
+        the BOW of each chunk in turn, so that the whole corpus is never held at once.
+        If n_jobs > 1 the chunks are tokenized in a pool of n_jobs processes.
+        '''
+        if self.vectorizer is None:
+            raise ValueError('BOWMachine has no vocabulary yet. ' + \
+                'Use convert_train_data first.')
 
-        bow_obj = vectorizer.fit_transform(strings)
-        self.vocab = vocab = vectorizer.get_feature_names()
-        bow_df = pd.DataFrame(bow_obj.toarray(), columns=vocab)
+        chunks = iter_chunks(strings, chunk_size)
+        if n_jobs == 1:
+            bow_objs = map(self.vectorizer.transform, chunks)
+        else:
+            bow_objs = map_chunks(transform, chunks, n_jobs, self.vectorizer)
+        for bow_obj in bow_objs:
+            yield self.to_output(bow_obj, sparse, packed)
 
-        return bow_df
+    def oov_tokens(self, strings):
+        '''
+        The set of tokens in each string which are out of the vocabulary.
+        This includes tokens left out of the vocabulary for being in too many
+        of the training documents (see max_df), but not stop words.
+        '''
+        if self.n_buckets is not None:
+            raise ValueError('A hashing BOWMachine has no vocabulary for tokens to be out of.')
+        if self.vectorizer is None:
+            raise ValueError('BOWMachine has no vocabulary yet. ' + \
+                'Use convert_train_data first.')
+        analyzer = self.vectorizer.build_analyzer()
+        return [ set(analyzer(string)).difference(self.known_tokens) for string in strings ]
 
-    def convert_online(self, strings):
+    def save(self, path):
+        '''
+        Save the vocabulary (or number of buckets) and tokenization settings to path.
+        '''
+        if self.vectorizer is None:
+            raise ValueError('BOWMachine has no vocabulary yet. ' + \
+                'Use convert_train_data first.')
+        state = {
+            'settings': BOWMachine.tokenization_settings(),
+            'n_buckets': self.n_buckets,
+            'vocab': list(self.vocab) if self.n_buckets is None else None,
+        }
+        with open(path, 'w') as f:
+            json.dump(state, f, separators=(',', ':'))
 
-        vectorizer = CountVectorizer(
-            lowercase=True, # convert to lowercase
-            binary=False, # use counts rather than binary inclusion
-            vocabulary=self.vocab # use the existing vocabulary
+    @staticmethod
+    def load(path, write_dir=None):
+        '''
+        Load a BOWMachine saved by save(). If write_dir is given, check that the
+        features match the feature streams a MultiDriftDetector has written there.
+        '''
+        with open(path) as f:
+            state = json.load(f)
+
+        bow_machine = BOWMachine(n_buckets=state['n_buckets'])
+        if state['n_buckets'] is None:
+            vectorizer = CountVectorizer(vocabulary=state['vocab'], **state['settings'])
+            bow_machine.set_vectorizer(vectorizer, state['vocab'])
+        elif state['settings'] != BOWMachine.tokenization_settings():
+            raise ValueError(f'The tokenization settings in {path} have changed.')
+
+        if write_dir is not None:
+            feature_dir = os.path.join(os.path.abspath(write_dir), 'features')
+            names = get_stream_names(feature_dir)
+            if sorted(names) != sorted(bow_machine.vocab):
+                raise ValueError(f'The features in {path} do not match the feature streams in {feature_dir}.')
+
+        return bow_machine
+
+    def set_vectorizer(self, vectorizer, vocab):
+        # Keep the fitted vectorizer, and the columns of the dataframes it produces.
+        # Every dataframe shares the one columns object, so MultiDriftDetector only checks it once.
+        self.vectorizer = vectorizer
+        self.vocab = vocab
+        self.columns = pd.Index(vocab)
+        self.known_tokens = frozenset(vocab)
+
+    @staticmethod
+    def pack(bow_obj):
+        '''
+        Whether each token is present in each document, as a uint8 array with a row
+        per document, the same as np.packbits(bow > 0, axis=1). This is built from
+        the sparse counts directly, without making a dense array of them first.
+        '''
+        bow_obj = scipy.sparse.csr_matrix(bow_obj)
+        n_documents, n_features = bow_obj.shape
+        n_bytes = (n_features + 7) // 8
+        present = bow_obj.data > 0
+        rows = np.repeat(np.arange(n_documents), np.diff(bow_obj.indptr))[present]
+        columns = bow_obj.indices[present]
+        # Each bit is set at most once, so summing the bits of each byte is the same as or-ing them.
+        bits = np.bincount(
+            rows * n_bytes + (columns >> 3),
+            weights=128 >> (columns & 7),
+            minlength=n_documents * n_bytes
         )
+        return bits.astype(np.uint8).reshape(n_documents, n_bytes)
+
+    @staticmethod
+    def tokenization_settings():
+        return { key: BOWMachine.vectorizer_settings[key] for key in BOWMachine.tokenization }
+
+    @staticmethod
+    def limit_vocab(document_frequencies, n_documents):
+        # The tokens which CountVectorizer.fit would keep, given their document frequencies.
+        max_df = BOWMachine.vectorizer_settings['max_df']
+        min_df = BOWMachine.vectorizer_settings['min_df']
+        max_count = max_df if isinstance(max_df, int) else max_df * n_documents
+        min_count = min_df if isinstance(min_df, int) else min_df * n_documents
+        vocab = sorted(
+            token for token, count in document_frequencies.items()
+            if min_count <= count <= max_count
+        )
+        if len(vocab) == 0:
+            raise ValueError('After pruning, no terms remain. Try a lower min_df or a higher max_df.')
+        return vocab
+
+    @staticmethod
+    def bucket_names(n_buckets):
+        # The names are zero padded so that they sort in the order of the buckets.
+        width = len(str(n_buckets - 1))
+        return [ f'hash{i:0{width}d}' for i in range(n_buckets) ]
+
+    def to_output(self, bow_obj, sparse, packed=False):
+        if packed:
+            return BOWMachine.pack(bow_obj)
+        if sparse:
+            return bow_obj.tocsr()
+        return pd.DataFrame(bow_obj.toarray(), columns=self.columns)
+
+def get_feature_names(vectorizer):
+    # scikit-learn 1.0 replaced get_feature_names with get_feature_names_out (and 1.2 removed it).
+    if hasattr(vectorizer, 'get_feature_names_out'):
+        return list(vectorizer.get_feature_names_out())
+    return vectorizer.get_feature_names()
+
+def iter_chunks(strings, chunk_size):
+    # Split an iterable of strings into lists of chunk_size strings.
+    strings = iter(strings)
+    while True:
+        chunk = list(islice(strings, chunk_size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+def map_chunks(function, chunks, n_jobs, worker_state):
+    '''
+    Apply function to each chunk in a pool of n_jobs processes, yielding the
+    results in the order of the chunks. worker_state (a vectorizer or analyzer) is
+    sent to each process once, rather than with every chunk. At most 2*n_jobs
+    chunks are in flight at once, so chunks can be a generator over a large corpus.
+    '''
+    with ProcessPoolExecutor(n_jobs, initializer=set_worker_state, initargs=(worker_state,)) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(function, chunk))
+            if len(pending) >= 2 * n_jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+# The vectorizer or analyzer used by a worker process in map_chunks.
+worker_state = None
+
+def set_worker_state(state):
+    global worker_state
+    worker_state = state
 
-        bow_obj = vectorizer.transform(strings)
-        self.vocab = vocab = vectorizer.get_feature_names()
-        bow_df = pd.DataFrame(bow_obj.toarray(), columns=vocab)
+def transform(chunk):
+    return worker_state.transform(chunk).tocsr()
 
-        return bow_df
+def count_documents(chunk):
+    # The number of documents in the chunk which each token occurs in.
+    counts = Counter()
+    for document in chunk:
+        counts.update(set(worker_state(document)))
+    return counts, len(chunk)
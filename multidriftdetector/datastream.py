@@ -3,6 +3,15 @@ import os
 from wasabi import color, Printer
 import numpy as np
 from copy import copy
+from multidriftdetector.bidirectional_hddm import BidirectionalHDDM
+from tornado_mod.drift_detection.__init__ import HDDM_A_test
+
+# Statuses and directions are stored as these codes, and only named at the
+# edges of the API (get_status, the drift events, and the return value of add_value).
+STATUS_NAMES = ('NORMAL', 'WARNING', 'DRIFT')
+NORMAL, WARNING, DRIFT = 0, 1, 2
+DIRECTION_NAMES = ('NORMAL', 'INCREASE', 'DECREASE')
+INCREASE, DECREASE = 1, 2
 
 class DataStream:
 
@@ -10,6 +19,11 @@ class DataStream:
     This monitors a single stream of data (feature, label, model accuracy) for drift.
     '''
 
+    # A detector can have tens of thousands of streams, so they're kept small:
+    # no __dict__, and the status and direction as codes.
+    __slots__ = ['drift_action', 'name', 'bidirectional', 'single_pass',
+        'detector', 'detector2', 'status_code', 'direction_code']
+
     # When a drift message is sent, should the status be colored?
     color_messages = True
 
@@ -25,26 +39,35 @@ class DataStream:
             detector, # The detection algorithm to be used on this stream
             drift_action=print, # The action to be taken when drift is detected
             name='unknown', # The name of this data stream
-            bidirectional=True # Monitor for increases AND decreases in the rate of this stream, or only increases?
+            bidirectional=True, # Monitor for increases AND decreases in the rate of this stream, or only increases?
+            single_pass=False # Test both directions from one set of statistics? (only applies to HDDM_A_test)
             ):
         self.drift_action = drift_action
-        self.detector = detector
-        self.status = 'NORMAL'
+        self.status_code = NORMAL
+        self.direction_code = NORMAL
         self.name = name
         self.bidirectional = bidirectional
-        self.detector2 = copy(detector) if bidirectional else None
-        self.drift_direction = 'NORMAL'
+        self.single_pass = bidirectional and single_pass and isinstance(detector, HDDM_A_test)
+        if self.single_pass:
+            self.detector = BidirectionalHDDM(detector)
+            self.detector2 = None
+        else:
+            self.detector = detector
+            self.detector2 = copy(detector) if bidirectional else None
 
     def add_value(self, value, conf=None):
         # Add a new value to this data stream
         # conf is confidence. This is for CDDM.
 
         # Once drift is detected no further updates are required.
-        if self.status == 'DRIFT':
+        if self.status_code == DRIFT:
             return 'DRIFT'
 
         # Get the drift status of the data stream
-        if conf:
+        if self.single_pass:
+            warning_status, drift_status, warning_status2, drift_status2 = \
+                self.detector.detect(value)
+        elif conf:
             warning_status, drift_status = self.detector.detect(value, conf)
             if self.bidirectional:
                 warning_status2, drift_status2 = self.detector2.detect(not value, conf)
@@ -59,27 +82,94 @@ class DataStream:
 
         # Has the drift status changed? If so, in what direction?
         if drift_status or drift_status2:
-            new_status = 'DRIFT'
-            self.direction = 'INCREASE' if drift_status else 'DECREASE'
+            new_status = DRIFT
+            self.direction_code = INCREASE if drift_status else DECREASE
         elif warning_status or warning_status2:
-            new_status = 'WARNING'
-            self.direction = 'INCREASE' if warning_status else 'DECREASE'
+            new_status = WARNING
+            self.direction_code = INCREASE if warning_status else DECREASE
         else:
-            new_status = 'NORMAL'
+            new_status = NORMAL
 
         # If the status has changed then do a drift action.
-        if new_status != self.status:
-            message = f'The status of {self.name} has changed to '
-            if DataStream.color_messages:
-                bg_color = DataStream.message_colors[new_status]
-                message += color(new_status, fg="black", bg=bg_color, bold=True)
-            else:
-                message += new_status
-            self.drift_action(message)
-            self.status = new_status
+        if new_status != self.status_code:
+            direction = DIRECTION_NAMES[self.direction_code] if new_status != NORMAL else 'NORMAL'
+            self.drift_action(DriftEvent(
+                self.name, STATUS_NAMES[self.status_code], STATUS_NAMES[new_status], direction))
+            self.status_code = new_status
+
+        return STATUS_NAMES[new_status]
 
-        return new_status
+    @staticmethod
+    def status_message(name, new_status):
+        # The message sent to the drift action when the status of a stream changes.
+        message = f'The status of {name} has changed to '
+        if DataStream.color_messages:
+            bg_color = DataStream.message_colors[new_status]
+            message += color(new_status, fg="black", bg=bg_color, bold=True)
+        else:
+            message += new_status
+        return message
+
+    @property
+    def status(self):
+        return STATUS_NAMES[self.status_code]
+
+    @property
+    def direction(self):
+        # The direction of the last change to WARNING or DRIFT.
+        return DIRECTION_NAMES[self.direction_code]
 
     def get_status(self):
         # What is the current status of the stream?
-        return self.status
+        return STATUS_NAMES[self.status_code]
+
+    def __reduce__(self):
+        # Always restored as a DataStream, even if pickled while instrumented
+        # (see instrumentation.py, which swaps in a subclass).
+        return (object.__new__, (DataStream,), self.__getstate__())
+
+    def __getstate__(self):
+        # The drift action isn't saved with a checkpoint, as it may not be picklable.
+        # Whoever restores the stream should set it again.
+        state = { name: getattr(self, name) for name in DataStream.__slots__ }
+        state['drift_action'] = None
+        return state
+
+    def __setstate__(self, state):
+        if 'status' in state:
+            # A checkpoint from before the statuses were stored as codes.
+            state = dict(state,
+                status_code=STATUS_NAMES.index(state['status']),
+                direction_code=DIRECTION_NAMES.index(state.get('direction', 'NORMAL')))
+        for name in DataStream.__slots__:
+            setattr(self, name, state[name])
+
+class DriftEvent:
+
+    '''
+    A change in the status of a stream, as passed to the drift action.
+
+    str(event) is the message drift actions used to be passed (so an action which
+    prints it still works). It's only built, and coloured, when it's asked for,
+    e.g. in a DriftDispatcher's thread, rather than by the stream which changed.
+    The details of the change are attributes:
+    - stream: the name of the stream
+    - old_status, new_status: 'NORMAL', 'WARNING' or 'DRIFT'
+    - direction: 'INCREASE' or 'DECREASE' (or 'NORMAL' if new_status is)
+    - instance_id: the instance which caused the change, if known
+    - step: the row of a batch which caused the change, if it came from one
+    '''
+
+    def __init__(self, stream, old_status, new_status, direction, step=None):
+        self.stream = stream
+        self.old_status = old_status
+        self.new_status = new_status
+        self.direction = direction
+        self.instance_id = None
+        self.step = step
+
+    def __str__(self):
+        return DataStream.status_message(self.stream, self.new_status)
+
+    def __repr__(self):
+        return f'DriftEvent({self.stream!r}, {self.old_status!r}, {self.new_status!r}, {self.direction!r})'
@@ -0,0 +1,336 @@
+import math
+import numpy as np
+from multidriftdetector import datastream
+from multidriftdetector.datastream import DriftEvent, NORMAL, WARNING, DRIFT, INCREASE, DECREASE
+from tornado_mod.drift_detection.__init__ import HDDM_A_test
+
+# Statuses and directions are stored with the same codes as in a DataStream.
+STATUS_NAMES = np.array(datastream.STATUS_NAMES)
+DIRECTION_NAMES = np.array(datastream.DIRECTION_NAMES)
+
+class HDDMBank:
+
+    '''
+    The statistics of many HDDM_A_test detectors, stored as a struct of arrays.
+    Each array has shape (n_streams,).
+
+    update() performs the same arithmetic as HDDM_A_test.run, in the same order,
+    so the warning and drift signals are identical to running one detector per stream.
+    As in BidirectionalHDDM, a bidirectional update tests for decreases from the
+    same statistics, rather than running a second detector on the negated values.
+    '''
+
+    STATS = ['n_min', 'c_min', 'total_n', 'total_c', 'n_max', 'c_max']
+
+    def __init__(self, detector, n_streams):
+
+        if not isinstance(detector, HDDM_A_test):
+            raise ValueError('A detector bank can only be made from an HDDM_A_test detector.')
+
+        self.drift_confidence = detector.drift_confidence
+        self.warning_confidence = detector.warning_confidence
+        self.two_sided = detector.test_type == 'two-sided'
+
+        # The constants in the Hoeffding bounds, computed as HDDM_A_test computes them.
+        self.log_bound = math.log(1.0 / self.drift_confidence, math.e)
+        self.log_drift = math.log(2.0 / self.drift_confidence, math.e)
+        self.log_warning = math.log(2.0 / self.warning_confidence, math.e)
+
+        # Start from the prototype detector's statistics.
+        for stat in HDDMBank.STATS:
+            setattr(self, stat, np.full(n_streams, getattr(detector, stat), dtype=np.int64))
+
+    def update(self, x, idx=slice(None), bidirectional=False):
+        '''
+        Add a value to each of the streams idx. x has shape (len(idx),), and x=1
+        where the detector would be passed False (ie, an error).
+
+        Returns the warning and drift signals. These have shape (1, len(idx)), or
+        if bidirectional is True, shape (2, len(idx)) where the second row is the
+        signals for a decrease.
+        '''
+
+        n_min, c_min, total_n, total_c, n_max, c_max = \
+            [ getattr(self, stat)[idx] for stat in HDDMBank.STATS ]
+
+        # 1. UPDATING STATS
+        total_n = total_n + 1
+        total_c = total_c + x
+
+        first = n_min == 0
+        n_min = np.where(first, total_n, n_min)
+        c_min = np.where(first, total_c, c_min)
+        first = n_max == 0
+        n_max = np.where(first, total_n, n_max)
+        c_max = np.where(first, total_c, c_max)
+
+        cota = np.sqrt((1.0 / (2 * n_min)) * self.log_bound)
+        cota1 = np.sqrt((1.0 / (2 * total_n)) * self.log_bound)
+        lower = c_min / n_min + cota >= total_c / total_n + cota1
+        n_min = np.where(lower, total_n, n_min)
+        c_min = np.where(lower, total_c, c_min)
+
+        cota = np.sqrt((1.0 / (2 * n_max)) * self.log_bound)
+        upper = c_max / n_max - cota <= total_c / total_n - cota1
+        n_max = np.where(upper, total_n, n_max)
+        c_max = np.where(upper, total_c, c_max)
+
+        # 2. UPDATING WARNING AND DRIFT STATUSES
+        drift = HDDMBank.mean_incr(n_min, c_min, total_n, total_c, self.log_drift)
+        warning = ~drift & HDDMBank.mean_incr(n_min, c_min, total_n, total_c, self.log_warning)
+        decrease = HDDMBank.mean_decr(n_max, c_max, total_n, total_c, self.log_drift)
+        if bidirectional:
+            warning = np.stack([warning,
+                ~decrease & HDDMBank.mean_decr(n_max, c_max, total_n, total_c, self.log_warning)])
+            drift = np.stack([drift, decrease])
+            reset = drift[0] | decrease
+        else:
+            reset = drift | (self.two_sided & decrease)
+            warning = warning[None]
+            drift = drift[None]
+
+        keep = ~reset
+        for stat, values in zip(HDDMBank.STATS, [n_min, c_min, total_n, total_c, n_max, c_max]):
+            getattr(self, stat)[idx] = values * keep
+
+        return warning, drift
+
+    def update_block(self, X, idx=slice(None)):
+        '''
+        Add several values to each of the streams idx, with the same result as
+        calling update(bidirectional=True) once per value. X has shape
+        (len(idx), n_steps), and as for update x=1 where the detector would be passed False.
+
+        The minimum point of HDDM_A_test is the point with the smallest value of
+        c/n + cota seen so far (ties going to the latest), and the maximum point
+        the one with the largest c/n - cota. So within a block they are running
+        minima and maxima, and every step can be computed at once with cumulative
+        operations along the block, rather than one step at a time.
+
+        A stream is reset when it drifts, and as a DataStream stops updating a
+        stream once it has drifted, its statistics stay reset for the rest of the
+        block. Its signals after the first drift are meaningless.
+
+        Returns the warning and drift signals, with shape (2, len(idx), n_steps)
+        where the second row is the signals for a decrease.
+        '''
+
+        n_min, c_min, total_n, total_c, n_max, c_max = \
+            [ getattr(self, stat)[idx] for stat in HDDMBank.STATS ]
+        n_steps = X.shape[1]
+        steps = np.arange(n_steps)
+
+        # 1. UPDATING STATS
+        n = total_n[:, None] + (steps + 1)
+        c = total_c[:, None] + np.cumsum(X, axis=1)
+        mean = c / n
+        cota1 = np.sqrt((1.0 / (2 * n)) * self.log_bound)
+
+        # The value of each point, and of the minimum and maximum points at the start.
+        lower = mean + cota1
+        upper = mean - cota1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lower0 = np.where(n_min > 0,
+                c_min / n_min + np.sqrt((1.0 / (2 * n_min)) * self.log_bound), np.inf)
+            upper0 = np.where(n_max > 0,
+                c_max / n_max - np.sqrt((1.0 / (2 * n_max)) * self.log_bound), -np.inf)
+
+        # A point becomes the minimum (maximum) point if it is no greater (less)
+        # than the minimum (maximum) point before it.
+        running_min = np.minimum.accumulate(np.hstack([lower0[:, None], lower]), axis=1)
+        running_max = np.maximum.accumulate(np.hstack([upper0[:, None], upper]), axis=1)
+        n_min, c_min = HDDMBank.latest(lower <= running_min[:, :-1], n, c, n_min, c_min)
+        n_max, c_max = HDDMBank.latest(upper >= running_max[:, :-1], n, c, n_max, c_max)
+
+        # 2. UPDATING WARNING AND DRIFT STATUSES
+        drift = HDDMBank.mean_incr(n_min, c_min, n, c, self.log_drift)
+        warning = ~drift & HDDMBank.mean_incr(n_min, c_min, n, c, self.log_warning)
+        decrease = HDDMBank.mean_decr(n_max, c_max, n, c, self.log_drift)
+        warning_decrease = ~decrease & HDDMBank.mean_decr(n_max, c_max, n, c, self.log_warning)
+
+        keep = ~(drift | decrease).any(axis=1)
+        for stat, values in zip(HDDMBank.STATS, [n_min, c_min, n, c, n_max, c_max]):
+            getattr(self, stat)[idx] = values[:, -1] * keep
+
+        return np.stack([warning, warning_decrease]), np.stack([drift, decrease])
+
+    @staticmethod
+    def latest(updated, n, c, n0, c0):
+        # The n and c of the latest updated point at each step, or n0 and c0 if there hasn't been one.
+        latest = np.maximum.accumulate(np.where(updated, np.arange(updated.shape[1]), -1), axis=1)
+        n_point = np.take_along_axis(n, np.maximum(latest, 0), axis=1)
+        c_point = np.take_along_axis(c, np.maximum(latest, 0), axis=1)
+        return np.where(latest >= 0, n_point, n0[:, None]), np.where(latest >= 0, c_point, c0[:, None])
+
+    @staticmethod
+    def mean_incr(n_min, c_min, total_n, total_c, log_confidence):
+        m = (total_n - n_min) / n_min * (1.0 / total_n)
+        cota = np.sqrt((m / 2) * log_confidence)
+        return (n_min != total_n) & (total_c / total_n - c_min / n_min >= cota)
+
+    @staticmethod
+    def mean_decr(n_max, c_max, total_n, total_c, log_confidence):
+        m = (total_n - n_max) / n_max * (1.0 / total_n)
+        cota = np.sqrt((m / 2) * log_confidence)
+        return (n_max != total_n) & (c_max / n_max - total_c / total_n >= cota)
+
+class StreamBank:
+
+    '''
+    Monitors many binary streams (e.g. every feature) for drift at once.
+
+    This behaves like a DataStream with an HDDM_A_test detector for each stream:
+    the statuses, directions and drift action messages are the same. But rather
+    than detector objects per stream, the statistics of every stream are kept in
+    an HDDMBank, and a whole vector of values (one per stream) is processed with
+    a few array operations.
+    '''
+
+    # add_block works on chunks of streams of about this many (stream, step) elements.
+    block_elements = 1 << 20
+
+    def __init__(
+            self,
+            names, # The names of the data streams
+            detector, # The HDDM_A_test detector to be used on every stream
+            drift_action=print, # The action to be taken when drift is detected
+            bidirectional=True # Monitor for increases AND decreases in the rate of the streams?
+            ):
+        self.names = list(names)
+        self.index = { name: i for i, name in enumerate(self.names) }
+        self.drift_action = drift_action
+        self.bidirectional = bidirectional
+        self.detectors = HDDMBank(detector, len(self.names))
+        self.status = np.zeros(len(self.names), dtype=np.uint8)
+        self.direction = np.zeros(len(self.names), dtype=np.uint8)
+
+    def add_values(self, values):
+        '''
+        Add a value to every stream, and return their statuses.
+        '''
+        values = np.asarray(values, dtype=bool)
+
+        # Once drift is detected no further updates are required.
+        active = np.flatnonzero(self.status != DRIFT)
+        if len(active) == len(self.names):
+            active = slice(None)
+            x = values
+        else:
+            x = values[active]
+
+        # HDDM_A_test counts the values which are False.
+        warning, drift = self.detectors.update(
+            (~x).astype(np.int64), active, self.bidirectional)
+
+        # What is the new status of each stream? If it's not normal, in what direction?
+        any_drift = drift.any(axis=0)
+        any_warning = warning.any(axis=0)
+        new_status = np.where(any_drift, DRIFT, np.where(any_warning, WARNING, NORMAL))
+        first_signal = np.where(any_drift, drift[0], warning[0])
+        signalled = any_drift | any_warning
+        direction = self.direction[active]
+        direction[signalled] = np.where(first_signal[signalled], INCREASE, DECREASE)
+        self.direction[active] = direction
+
+        # If the status has changed then do a drift action.
+        status = self.status[active]
+        for i in np.flatnonzero(new_status != status):
+            name = self.names[i] if isinstance(active, slice) else self.names[active[i]]
+            self.drift_action(DriftEvent(name, str(STATUS_NAMES[status[i]]),
+                str(STATUS_NAMES[new_status[i]]), StreamBank.direction_name(new_status[i], direction[i])))
+        self.status[active] = new_status
+
+        return STATUS_NAMES[self.status].tolist()
+
+    def add_block(self, block):
+        '''
+        Add several values to every stream. block[i] is the i-th vector of values.
+        Returns the statuses of each stream, as a list of columns.
+
+        The statuses and directions are the same as calling add_values once per
+        row, but drift action messages are grouped by stream rather than by row.
+        '''
+        block = np.asarray(block, dtype=bool)
+        if not self.bidirectional:
+            statuses = [ self.add_values(values) for values in block ]
+            return [ list(column) for column in zip(*statuses) ]
+
+        n_steps = len(block)
+        codes = np.repeat(self.status[:, None], n_steps, axis=1)
+
+        # Once drift is detected no further updates are required.
+        active = np.flatnonzero(self.status != DRIFT)
+        chunk_size = max(1, StreamBank.block_elements // max(n_steps, 1))
+        for start in range(0, len(active) if n_steps > 0 else 0, chunk_size):
+            idx = active[start:start+chunk_size]
+            # HDDM_A_test counts the values which are False.
+            warning, drift = self.detectors.update_block((~block[:, idx]).T.astype(np.int64), idx)
+
+            # What is the status of each stream at each step? Statuses stay at
+            # DRIFT from the first drift onwards.
+            any_drift = drift.any(axis=0)
+            drifted = np.cumsum(any_drift, axis=1) > 0
+            new_status = np.where(drifted, DRIFT, np.where(warning.any(axis=0), WARNING, NORMAL))
+
+            # The direction is that of the last signal, up to the first drift.
+            first_signal = np.where(any_drift, drift[0], warning[0])
+            direction = np.where(first_signal, INCREASE, DECREASE)
+            signalled = new_status != NORMAL
+            signalled[:, 1:] &= ~drifted[:, :-1]
+            last = np.where(signalled, np.arange(n_steps), -1).max(axis=1)
+            changed = last >= 0
+            self.direction[idx[changed]] = direction[changed, last[changed]]
+
+            # If the status has changed then do a drift action.
+            previous = np.hstack([self.status[idx, None], new_status[:, :-1]])
+            for i, step in zip(*np.nonzero(new_status != previous)):
+                self.drift_action(DriftEvent(self.names[idx[i]],
+                    str(STATUS_NAMES[previous[i, step]]), str(STATUS_NAMES[new_status[i, step]]),
+                    StreamBank.direction_name(new_status[i, step], direction[i, step]), step))
+            self.status[idx] = new_status[:, -1]
+            codes[idx] = new_status
+
+        return STATUS_NAMES[codes].tolist()
+
+    @staticmethod
+    def direction_name(status, direction):
+        return str(DIRECTION_NAMES[direction]) if status != NORMAL else 'NORMAL'
+
+    def get_status(self, name):
+        # What is the current status of a stream?
+        return str(STATUS_NAMES[self.status[self.index[name]]])
+
+    def get_direction(self, name):
+        return str(DIRECTION_NAMES[self.direction[self.index[name]]])
+
+    def __getitem__(self, name):
+        return BankedStream(self, name)
+
+    def __getstate__(self):
+        # As for DataStream, the drift action isn't saved with a checkpoint.
+        state = self.__dict__.copy()
+        state['drift_action'] = None
+        state.pop('add_values', None)
+        state.pop('add_block', None)
+        return state
+
+class BankedStream:
+
+    '''
+    A view of a single stream in a StreamBank, with the read-only parts of the DataStream interface.
+    '''
+
+    def __init__(self, bank, name):
+        self.bank = bank
+        self.name = name
+
+    @property
+    def status(self):
+        return self.bank.get_status(self.name)
+
+    @property
+    def direction(self):
+        return self.bank.get_direction(self.name)
+
+    def get_status(self):
+        return self.status
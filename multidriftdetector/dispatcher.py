@@ -0,0 +1,93 @@
+import sys
+import time
+import queue
+import threading
+import traceback
+
+class DriftDispatcher:
+
+    '''
+    A drift action which hands the drift events to a background thread, so that
+    a slow action (paging someone, writing to a remote sink) doesn't hold up the detector.
+
+    Events wait in a queue of at most max_queue events. The thread takes the
+    first event waiting, gathers any more which arrive in the next window seconds,
+    and calls action once with the list of events. So when many streams change
+    status at once (e.g. a shift across the whole vocabulary) the action is
+    called once, not once per stream.
+
+    If the queue is full the detector waits for the thread to catch up, unless
+    block is False, in which case the event is dropped and counted in dropped.
+    '''
+
+    def __init__(
+            self,
+            action, # Called with a list of DriftEvents
+            window=1.0, # How long to gather events for, in seconds
+            max_queue=10000, # The most events which can be waiting
+            block=True # Wait for room in the queue, rather than dropping events?
+            ):
+        self.action = action
+        self.window = window
+        self.block = block
+        self.queue = queue.Queue(max_queue)
+        self.dropped = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __call__(self, event):
+        try:
+            self.queue.put(event, block=self.block)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                self.queue.task_done()
+                return
+
+            # Gather the events which arrive within the window.
+            events = [event]
+            stop = False
+            deadline = time.monotonic() + self.window
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    event = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if event is None:
+                    stop = True
+                    break
+                events.append(event)
+
+            try:
+                self.action(events)
+            except Exception:
+                # A failing action shouldn't stop later events from being dispatched.
+                traceback.print_exc(file=sys.stderr)
+            for _ in range(len(events) + stop):
+                self.queue.task_done()
+            if stop:
+                return
+
+    def flush(self):
+        '''
+        Wait until every event so far has been passed to the action.
+        '''
+        if not self.closed:
+            self.queue.join()
+
+    def close(self):
+        '''
+        Dispatch the events still waiting, and stop the thread.
+        '''
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.thread.join()
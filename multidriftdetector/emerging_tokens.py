@@ -0,0 +1,100 @@
+import hashlib
+import numpy as np
+
+class CountMinSketch:
+
+    '''
+    Approximate counts of tokens, in a fixed depth x width table of counters.
+
+    Each token is counted in one counter per row, chosen by a hash of the token,
+    and its estimated count is the smallest of those counters. Estimates never
+    undercount, and with probability 1 - exp(-depth) they overcount by at most
+    e/width of the total count.
+    '''
+
+    def __init__(
+            self,
+            width=2048, # The number of counters in each row
+            depth=4 # The number of rows
+            ):
+        self.width = width
+        self.depth = depth
+        self.rows = np.arange(depth)
+        self.counts = np.zeros((depth, width), dtype=np.int64)
+
+    def columns(self, token):
+        # blake2b rather than hash(), so that the columns are the same in every process.
+        digest = hashlib.blake2b(token.encode(), digest_size=4*self.depth).digest()
+        return np.frombuffer(digest, dtype=np.uint32) % self.width
+
+    def add(self, token, count=1):
+        '''
+        Count a token, and return its new estimated count.
+        '''
+        columns = self.columns(token)
+        self.counts[self.rows, columns] += count
+        return int(self.counts[self.rows, columns].min())
+
+    def estimate(self, token):
+        return int(self.counts[self.rows, self.columns(token)].min())
+
+class EmergingTokens:
+
+    '''
+    Finds the tokens outside BOWMachine's vocabulary which are becoming common,
+    in a fixed amount of memory however many distinct tokens there are.
+
+    The number of documents each token occurs in is estimated with a CountMinSketch,
+    and the n_candidates tokens with the highest estimates are kept as heavy hitters.
+    A candidate emerges once it has occurred in min_documents documents, until
+    max_emerged tokens have emerged.
+    '''
+
+    def __init__(
+            self,
+            max_emerged=20, # The most tokens which can emerge
+            n_candidates=100, # The number of heavy hitters to keep
+            min_documents=20, # The number of documents a token must occur in to emerge
+            width=2048, # The width of the sketch
+            depth=4 # The depth of the sketch
+            ):
+        self.max_emerged = max_emerged
+        self.n_candidates = n_candidates
+        self.min_documents = min_documents
+        self.sketch = CountMinSketch(width, depth)
+        self.candidates = {} # token -> estimated number of documents
+        self.emerged = set()
+        self.n_documents = 0
+
+        # A lower bound on the smallest estimate among the candidates, so the
+        # candidates only need to be searched when a token might beat it.
+        self.threshold = 0
+
+    def add_document(self, tokens):
+        '''
+        Count the out of vocabulary tokens of a document.
+        Returns the tokens which have emerged with this document.
+        '''
+        self.n_documents += 1
+        emerged = []
+        for token in set(tokens):
+            estimate = self.sketch.add(token)
+            if token in self.candidates or len(self.candidates) < self.n_candidates:
+                self.candidates[token] = estimate
+            elif estimate > self.threshold:
+                weakest = min(self.candidates, key=self.candidates.get)
+                self.threshold = self.candidates[weakest]
+                if estimate > self.threshold:
+                    del self.candidates[weakest]
+                    self.candidates[token] = estimate
+            if token in self.candidates and token not in self.emerged \
+                    and estimate >= self.min_documents and len(self.emerged) < self.max_emerged:
+                self.emerged.add(token)
+                emerged.append(token)
+        return emerged
+
+    def top(self, n=10):
+        '''
+        The n candidates with the highest estimated number of documents.
+        '''
+        return sorted(self.candidates.items(), key=lambda item: -item[1])[:n]
@@ -0,0 +1,335 @@
+import os
+import sys
+import time
+import pickle
+import threading
+import traceback
+from glob import glob
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from functools import partial
+from multidriftdetector.writers import WriterPool
+from multidriftdetector.multidriftdetector import MultiDriftDetector
+
+class DetectorHost:
+
+    '''
+    Runs the MultiDriftDetectors of many tenants (e.g. one triage model per clinic)
+    in one process. Each tenant has its own directory under root_dir, and its own
+    settings, including its own drift detectors (feature_dd, label_dd and concept_dd).
+    The tenants share one WriterPool, and one thread which flushes them every
+    flush_interval seconds.
+
+    A tenant which hasn't been used for idle_timeout seconds, or the least recently
+    used one once more than max_loaded are loaded, is hibernated: a checkpoint is
+    taken, and the detector is closed and dropped from memory. It's restored from
+    the checkpoint the next time it's used. evict() closes a tenant without taking
+    a checkpoint, so the restore replays the state logs since its last one instead.
+
+    The tenants (and their settings) are kept on disk, so a new host on the same
+    root_dir carries on with the tenants of the last one. A tenant is checkpointed
+    when it's added and after its features or labels are set through the host
+    (rather than with use()), so it can be restored even if the last host wasn't closed.
+
+    The detectors are thread-safe (see MultiDriftDetector), as the flushing thread
+    uses them too. Each drift event is passed to drift_action with its tenant as
+    event.tenant.
+
+    >>> host = DetectorHost(root_dir, idle_timeout=3600)
+    >>> host.add_tenant('clinic1', concept_dd=HDDM_A_test(warning_confidence=0.05, drift_confidence=0.01))
+    >>> host['clinic1'].set_features(feature_names)
+    >>> host['clinic1'].add_instance(instance, instance_id)
+    >>> ...
+    >>> host.close()
+    '''
+
+    # The methods of a tenant's detector which are followed by a checkpoint.
+    checkpoint_after = ['set_features', 'set_labels']
+
+    def __init__(
+            self,
+            root_dir, # The directory with a directory for each tenant
+            drift_action=print, # Called with each DriftEvent, of every tenant
+            writers=None, # The WriterPool shared by the tenants (by default a new one is created)
+            flush_interval=5.0, # How often to flush the tenants, in seconds (None for never)
+            idle_timeout=None, # Hibernate a tenant once it's been idle for this many seconds
+            max_loaded=None, # The most tenants to keep in memory at once
+            clock=time.monotonic # The time in seconds, for idle_timeout
+            ):
+        self.root_dir = os.path.abspath(root_dir)
+        os.makedirs(self.root_dir, exist_ok=True)
+        self.drift_action = drift_action
+        self.own_writers = writers is None # if so, it's closed with the host
+        self.writers = writers if writers is not None else WriterPool()
+        self.flush_interval = flush_interval
+        self.idle_timeout = idle_timeout
+        self.max_loaded = max_loaded
+        self.clock = clock
+
+        self.settings = {} # tenant -> the keyword arguments of its detector
+        self.detectors = OrderedDict() # the loaded tenants, least recently used first
+        self.last_used = {}
+        self.active = defaultdict(int) # tenant -> the number of calls in progress
+        self.busy = set() # the tenants being loaded or unloaded
+
+        # Guards the above, and is notified as calls finish and as tenants are loaded
+        # or unloaded. A tenant is loaded and unloaded outside it (marked as busy
+        # meanwhile), so that one tenant's restore or checkpoint doesn't hold up the others.
+        self.lock = threading.Condition(threading.RLock())
+
+        # The tenants of the last host on root_dir start out hibernated.
+        for path in sorted(glob(os.path.join(self.root_dir, '*', 'tenant.pkl'))):
+            with open(path, 'rb') as f:
+                self.settings[os.path.basename(os.path.dirname(path))] = pickle.load(f)
+
+        self.stopped = threading.Event()
+        self.thread = None
+        if flush_interval is not None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def add_tenant(self, name, **settings):
+        '''
+        Add a tenant, with the keyword arguments of its MultiDriftDetector
+        (other than write_dir, writers, restore and thread_safe, which the host sets).
+        Returns the tenant.
+        '''
+        if name in self.settings:
+            raise ValueError(f'There is already a tenant called {name!r}.')
+        if not name or os.path.basename(name) != name or name in ['.', '..']:
+            raise ValueError(f'A tenant name must be usable as a directory name, not {name!r}.')
+        for setting in ['write_dir', 'writers', 'restore', 'thread_safe']:
+            if setting in settings:
+                raise ValueError(f'The host sets {setting} itself.')
+
+        tenant_dir = os.path.join(self.root_dir, name)
+        os.makedirs(tenant_dir, exist_ok=True)
+        # The drift action isn't saved, as it may not be picklable.
+        saved = { setting: value for setting, value in settings.items() if setting != 'drift_action' }
+        with open(os.path.join(tenant_dir, 'tenant.pkl'), 'wb') as f:
+            pickle.dump(saved, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        with self.lock:
+            self.settings[name] = settings
+            self.busy.add(name)
+        self.open(name, restore=False)
+        return self[name]
+
+    def __getitem__(self, name):
+        if name not in self.settings:
+            raise KeyError(f'There is no tenant called {name!r}.')
+        return Tenant(self, name)
+
+    def __contains__(self, name):
+        return name in self.settings
+
+    @property
+    def tenants(self):
+        return list(self.settings)
+
+    def is_loaded(self, name):
+        return name in self.detectors
+
+    def open(self, name, restore, hold=False):
+        # Make a tenant's detector, which has been marked as busy, then hibernate
+        # others if there are too many. If hold is True, a call is counted as in progress.
+        try:
+            tenant_dir = os.path.join(self.root_dir, name)
+            settings = dict(self.settings[name])
+            tenant_action = settings.pop('drift_action', self.drift_action)
+            # A tenant without a checkpoint (e.g. from a host which died before taking
+            # one) has nothing to restore, so it starts afresh.
+            if restore and not glob(os.path.join(tenant_dir, 'checkpoints', 'checkpoint_*.pkl')):
+                restore = False
+            detector = MultiDriftDetector(
+                tenant_dir,
+                drift_action=partial(self.notify, name, tenant_action),
+                writers=self.writers,
+                restore=restore,
+                thread_safe=True,
+                **settings
+            )
+            if not restore:
+                # So that it can be restored if the host stops before it's unloaded.
+                detector.checkpoint()
+        except BaseException:
+            with self.lock:
+                self.busy.discard(name)
+                self.lock.notify_all()
+            raise
+        with self.lock:
+            self.detectors[name] = detector
+            self.last_used[name] = self.clock()
+            if hold:
+                self.active[name] += 1
+            self.busy.discard(name)
+            self.lock.notify_all()
+
+        if self.max_loaded is not None:
+            for other in list(self.detectors):
+                if len(self.detectors) <= self.max_loaded:
+                    break
+                if other != name:
+                    self.unload(other, checkpoint=True, only_if=lambda: self.active[other] == 0)
+        return detector
+
+    def notify(self, name, drift_action, event):
+        event.tenant = name
+        drift_action(event)
+
+    @contextmanager
+    def use(self, name, touch=True, load=True):
+        '''
+        Hold a tenant in memory, loading it if it's hibernated, for a few calls
+        to its detector. It won't be hibernated until the block ends.
+        If load is False, a hibernated tenant is left on disk, and None is given instead.
+
+        >>> with host.use('clinic1') as detector:
+        ...     detector.add_instance(instance, instance_id)
+        ...     detector.add_prediction(prediction, instance_id)
+        '''
+        with self.lock:
+            if name not in self.settings:
+                raise KeyError(f'There is no tenant called {name!r}.')
+            if load:
+                # Wait for it to finish being loaded or unloaded by another call.
+                self.lock.wait_for(lambda: name not in self.busy)
+            detector = self.detectors.get(name)
+            if detector is None and load:
+                self.busy.add(name)
+            elif detector is not None:
+                self.active[name] += 1
+                if touch:
+                    self.last_used[name] = self.clock()
+                    self.detectors.move_to_end(name)
+        if detector is None and load:
+            detector = self.open(name, restore=True, hold=True)
+        if detector is None:
+            yield None
+            return
+        try:
+            yield detector
+        finally:
+            with self.lock:
+                self.active[name] -= 1
+                self.lock.notify_all()
+
+    def call(self, name, method, *args, **kwargs):
+        # Call a method of a tenant's detector. The tenant is checkpointed after its
+        # features or labels are set, so that a restore doesn't need them set again.
+        with self.use(name) as detector:
+            result = getattr(detector, method)(*args, **kwargs)
+            if method in DetectorHost.checkpoint_after:
+                detector.checkpoint()
+            return result
+
+    def unload(self, name, checkpoint, only_if=None):
+        # Wait for the calls in progress, then close the tenant's detector.
+        # If only_if is given, the tenant is instead only unloaded if only_if()
+        # is true (under the host's lock) once it's no longer busy.
+        with self.lock:
+            self.lock.wait_for(lambda: name not in self.busy and (only_if is not None or self.active[name] == 0))
+            if name not in self.detectors or (only_if is not None and not only_if()):
+                return
+            detector = self.detectors.pop(name)
+            del self.last_used[name]
+            self.busy.add(name)
+        try:
+            if checkpoint or not detector.get_checkpoints():
+                detector.checkpoint()
+            detector.close()
+        finally:
+            with self.lock:
+                self.busy.discard(name)
+                self.lock.notify_all()
+
+    def hibernate(self, name):
+        '''
+        Checkpoint a tenant, and drop it from memory until it's next used.
+        '''
+        self.unload(name, checkpoint=True)
+
+    def evict(self, name):
+        '''
+        Drop a tenant from memory until it's next used, without taking a checkpoint
+        (unless it has none), so it's restored from its last checkpoint and the
+        state logs since. The emerging token counts are as they were at the checkpoint.
+        '''
+        self.unload(name, checkpoint=False)
+
+    def hibernate_idle(self):
+        '''
+        Hibernate the tenants which have been idle for idle_timeout seconds.
+        '''
+        if self.idle_timeout is None:
+            return
+        now = self.clock()
+        for name in list(self.detectors):
+            self.unload(name, checkpoint=True, only_if=lambda:
+                self.active[name] == 0 and now - self.last_used[name] >= self.idle_timeout)
+
+    def flush(self, sync=False):
+        '''
+        Write the buffered rows of every loaded tenant to disk.
+        '''
+        for name in list(self.detectors):
+            # Outside the host's lock, so that the other tenants can be used meanwhile.
+            with self.use(name, touch=False, load=False) as detector:
+                if detector is not None:
+                    detector.flush_files(sync, writers=False)
+        # Then the shared pool, once for every tenant.
+        self.writers.flush(sync)
+        if hasattr(self.drift_action, 'flush'):
+            self.drift_action.flush()
+
+    def run(self):
+        # The flushing thread.
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+                self.hibernate_idle()
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+
+    def close(self):
+        '''
+        Stop the flushing thread, and hibernate every tenant. The WriterPool is
+        closed too, unless it was passed in.
+        '''
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for name in list(self.detectors):
+            self.hibernate(name)
+        if self.own_writers:
+            self.writers.close()
+        if hasattr(self.drift_action, 'close'):
+            self.drift_action.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class Tenant:
+
+    '''
+    A handle on a tenant of a DetectorHost, which can be used as its MultiDriftDetector.
+    Each method call loads the detector if it's hibernated, and holds it in memory
+    until the call returns. (To make several calls at once, see DetectorHost.use.)
+    '''
+
+    def __init__(self, host, name):
+        self.host = host
+        self.name = name
+
+    def __getattr__(self, attr):
+        if callable(getattr(MultiDriftDetector, attr, None)):
+            return partial(self.host.call, self.name, attr)
+        with self.host.use(self.name) as detector:
+            return getattr(detector, attr)
+
+    def __repr__(self):
+        return f'Tenant({self.name!r})'
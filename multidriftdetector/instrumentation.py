@@ -0,0 +1,201 @@
+import json
+import time
+from collections import defaultdict
+from multidriftdetector.datastream import DataStream
+from multidriftdetector.detector_bank import StreamBank
+from multidriftdetector.sharded import ShardedStreams
+
+class LatencyHistogram:
+
+    '''
+    A histogram of latencies in nanoseconds, with buckets whose width grows with
+    the latency (as in HdrHistogram): each power of two is split into 16 buckets,
+    so any percentile is accurate to within about 6%, in a few hundred counters.
+    '''
+
+    sub_buckets = 16
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    @staticmethod
+    def bucket(value):
+        # Values below 2*sub_buckets have a bucket each. Above that, value >> shift
+        # is in [sub_buckets, 2*sub_buckets), and each shift adds sub_buckets buckets.
+        shift = max(value.bit_length() - 5, 0)
+        return LatencyHistogram.sub_buckets * shift + (value >> shift)
+
+    @staticmethod
+    def bucket_value(bucket):
+        # The smallest value in a bucket.
+        shift = max(bucket // LatencyHistogram.sub_buckets - 1, 0)
+        return (bucket - LatencyHistogram.sub_buckets * shift) << shift
+
+    def record(self, value):
+        self.counts[LatencyHistogram.bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        '''
+        The q-th percentile (0 to 100) of the recorded values, in nanoseconds.
+        '''
+        if self.count == 0:
+            return 0
+        rank = q / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(LatencyHistogram.bucket_value(bucket), self.max)
+        return self.max
+
+    def get_stats(self):
+        return {
+            'count': self.count,
+            'mean_ns': self.total / self.count if self.count else 0,
+            'p50_ns': self.percentile(50),
+            'p90_ns': self.percentile(90),
+            'p99_ns': self.percentile(99),
+            'max_ns': self.max,
+        }
+
+class Instrumentation:
+
+    '''
+    Measures where a MultiDriftDetector's time goes:
+    - a LatencyHistogram of each entry point (add_instance, add_prediction, ...),
+    - counters of the records and stream values processed, and the bytes written,
+    - the CPU time spent in the detector of each stream (a StreamBank counts as one stream).
+
+    attach() replaces the detector's methods with timed versions on that detector
+    object only, and detach() removes them again. So a detector which isn't
+    instrumented runs exactly the code it would without this module.
+    attach() should be called after set_features and set_labels, as it times the
+    streams which exist at the time.
+
+    >>> instrumentation = Instrumentation().attach(detector)
+    >>> ...
+    >>> instrumentation.dump('stats.json')
+    '''
+
+    entry_points = [
+        'add_instance', 'add_prediction', 'add_label',
+        'add_instances', 'add_predictions', 'add_labels',
+        'add_sparse_instance', 'add_packed_instances', 'add_oov_tokens',
+        'flush_sparse', 'flush', 'checkpoint',
+    ]
+
+    def __init__(self):
+        self.histograms = defaultdict(LatencyHistogram)
+        self.counters = defaultdict(int)
+        self.stream_time = defaultdict(int) # stream name -> CPU time in nanoseconds
+        self.attached = [] # (object, attribute) of every wrapper
+        self.retyped = [] # the DataStreams given a timed class
+        self.timed_class = None
+
+    def attach(self, detector):
+        for name in Instrumentation.entry_points:
+            self.wrap(detector, name, self.timed(name, getattr(detector, name)))
+        self.wrap(detector, 'count_records', self.counted('records', detector.count_records))
+        self.wrap(detector.writers, 'write', self.counted_bytes(detector.writers.write))
+
+        streams = [detector.loss_stream]
+        for group in ['feature_streams', 'label_streams', 'emerging_streams']:
+            group_streams = getattr(detector, group, {})
+            if isinstance(group_streams, StreamBank):
+                streams.append(group_streams)
+            elif isinstance(group_streams, ShardedStreams):
+                continue # the streams are in other processes
+            else:
+                streams.extend(group_streams.values())
+        for stream in streams:
+            self.time_stream(stream)
+
+        return self
+
+    def detach(self):
+        for obj, name in self.attached:
+            obj.__dict__.pop(name, None)
+        for stream in self.retyped:
+            stream.__class__ = DataStream
+        self.attached = []
+        self.retyped = []
+
+    def wrap(self, obj, name, wrapper):
+        setattr(obj, name, wrapper)
+        self.attached.append((obj, name))
+
+    def timed(self, name, method):
+        histogram = self.histograms[name]
+        clock = time.perf_counter_ns
+        def timed_method(*args, **kwargs):
+            start = clock()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                histogram.record(clock() - start)
+        return timed_method
+
+    def counted(self, counter, method):
+        counters = self.counters
+        def counted_method(n, *args, **kwargs):
+            counters[counter] += n
+            return method(n, *args, **kwargs)
+        return counted_method
+
+    def counted_bytes(self, write):
+        counters = self.counters
+        def counted_write(fpath, text):
+            counters['bytes_written'] += len(text)
+            return write(fpath, text)
+        return counted_write
+
+    def time_stream(self, stream):
+        clock = time.thread_time_ns
+        counters = self.counters
+        stream_time = self.stream_time
+        if isinstance(stream, DataStream):
+            # A DataStream has no __dict__ to put a timed add_value in, so it's
+            # given a subclass with one instead (the same for every stream).
+            if self.timed_class is None:
+                add_value = DataStream.add_value
+                def timed_add_value(stream, *args, **kwargs):
+                    start = clock()
+                    result = add_value(stream, *args, **kwargs)
+                    stream_time[stream.name] += clock() - start
+                    counters['values'] += 1
+                    return result
+                self.timed_class = type('TimedDataStream', (DataStream,),
+                    {'__slots__': (), 'add_value': timed_add_value})
+            stream.__class__ = self.timed_class
+            self.retyped.append(stream)
+        else:
+            name = 'StreamBank(' + ', '.join(stream.names[:3]) + (', ...)' if len(stream.names) > 3 else ')')
+            n_streams = len(stream.names)
+            for method_name in ['add_values', 'add_block']:
+                method = getattr(stream, method_name)
+                def timed_method(values, method=method, rows=method_name == 'add_block'):
+                    start = clock()
+                    result = method(values)
+                    stream_time[name] += clock() - start
+                    counters['values'] += n_streams * (len(values) if rows else 1)
+                    return result
+                self.wrap(stream, method_name, timed_method)
+
+    def get_stats(self):
+        return {
+            'latency': { name: histogram.get_stats() for name, histogram in self.histograms.items()
+                if histogram.count > 0 },
+            'counters': dict(self.counters),
+            'stream_cpu_ns': dict(self.stream_time),
+        }
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.get_stats(), f, indent=2)
@@ -2,12 +2,65 @@ import sys
 import os
 from collections import defaultdict
 import os
+import re
+import json
+import pickle
+import threading
+from glob import glob
+from contextlib import ExitStack, nullcontext
 from wasabi import color, Printer
 import numpy as np
 from copy import copy
+from functools import partial, wraps
 from multidriftdetector.datastream import DataStream
+from multidriftdetector.writers import WriterPool
+from multidriftdetector.state_log import CSVStateLog, ColumnarStateLog
+from multidriftdetector.prediction_store import PredictionStore, encode_id, decode_id
+from multidriftdetector.detector_bank import StreamBank
+from multidriftdetector.sharded import ShardedStreams
+from multidriftdetector.emerging_tokens import EmergingTokens
+from multidriftdetector.status import StatusSets, DetectorStatus
 from tornado_mod.drift_detection.__init__ import *
 
+class CallState(threading.local):
+
+    '''
+    The instance (or batch of instances) being added, for the drift events.
+    Each thread has its own, so that in thread-safe mode an event is stamped
+    with the instance of the call which caused it.
+    '''
+
+    instance_id = None
+    instance_ids = None
+    step = None
+    depth = 0 # How many locked methods the thread is in
+
+def locked(group):
+    '''
+    Decorates a method of MultiDriftDetector to hold the lock of a group of
+    streams while it runs (which does nothing unless thread_safe is True).
+
+    A checkpoint takes every lock, so one which falls due while a method holds
+    its lock is taken once the thread has left the outermost locked method.
+    Otherwise two threads could each hold a lock the other is waiting for.
+    '''
+    def decorator(method):
+        @wraps(method)
+        def locked_method(self, *args, **kwargs):
+            if not self.thread_safe:
+                return method(self, *args, **kwargs)
+            call = self.call
+            call.depth += 1
+            try:
+                with self.locks[group]:
+                    return method(self, *args, **kwargs)
+            finally:
+                call.depth -= 1
+                if call.depth == 0 and self.checkpoint_due:
+                    self.checkpoint(blocking=False)
+        return locked_method
+    return decorator
+
 class MultiDriftDetector:
 
     '''
@@ -19,25 +72,69 @@ class MultiDriftDetector:
     '''
 
     # The drift detection algorithms, used to detect feature drift, label drift, and concept drift, respectively.
+    # (A detector can be given its own instead, see __init__.)
     feature_dd=HDDM_A_test(warning_confidence=0.001, drift_confidence=0.0005)
     label_dd=copy(feature_dd)
     concept_dd=HDDM_A_test(warning_confidence=0.01, drift_confidence=0.005)
 
+    # The most values flush_sparse makes dense at once.
+    sparse_chunk_values = 1 << 20
+
+    # The ways the state of the streams can be recorded under write_dir.
+    state_logs = {
+        'csv': CSVStateLog, # one csv per stream, as read by driftviewer
+        'columnar': ColumnarStateLog # one set of memory-mappable binary files per stream group
+    }
+
     def __init__(
             self,
             write_dir,
-            drift_action=print
+            drift_action=print,
             drift_detector=HDDM_A_test,
             warning_confidence=0.01,
             drift_confidence=0.005,
+            writers=None,
+            storage='csv',
+            checkpoint_every=None,
+            keep_checkpoints=2,
+            restore=False,
+            prediction_store=None,
+            sparse_window=256,
+            thread_safe=False,
+            feature_dd=None,
+            label_dd=None,
+            concept_dd=None,
         ):
         '''
         args:
         - write_dir: the directory to write the state of the detector
-        - drift_action: the action to take if drift is detected
+        - drift_action: the action to take if drift is detected. It's passed a DriftEvent
+          (see datastream.py) whenever the status of a stream changes. To keep a slow
+          action out of the way of the detector, pass a DriftDispatcher (see dispatcher.py).
         - drift_detector: a SuperDetector object for detecting changes in a data stream
         - warning_confidence: the p-value of the no-drift hypothesis at which a drift warning is sent
         - drift_confidence: the p-value of the no-drift hypothesis at which a drift signal is sent
+        - writers: the WriterPool used to write the stream files (by default a new one is created)
+        - storage: how the stream states are recorded, either 'csv' or 'columnar' (see state_log.py)
+        - checkpoint_every: take a checkpoint after this many records have been added (None for never)
+        - keep_checkpoints: how many of the most recent checkpoints to keep on disk
+        - restore: restore the detector from the newest checkpoint in write_dir, rather than starting afresh
+        - prediction_store: the PredictionStore which holds predictions until their labels arrive
+          (by default one with no limit on its size or the age of its entries)
+        - sparse_window: how many instances add_sparse_instance holds before updating the feature streams
+        - thread_safe: allow the detector to be called from several threads at once (see below)
+        - feature_dd, label_dd, concept_dd: the drift detectors copied for this detector's
+          feature, label and loss streams (by default the class's, see above)
+
+        In thread-safe mode each group of streams has a lock of its own: the features
+        (and emerging tokens), the labels, the loss stream, and the prediction queue.
+        So adding an instance's features doesn't wait for a label being added in
+        another thread, while the streams of a group (and the rows of its state log)
+        are still updated one call at a time, in the order the calls take the lock.
+        Checkpoints, flush, close and get_status take every lock, in that order.
+        The drift action may be called from any of the threads, so it should be
+        thread-safe itself (a DriftDispatcher is), and set_features and set_labels
+        should be called before the detector is shared between threads.
         '''
 
         # only hddm uses drift_confidence and warning_confidence
@@ -48,175 +145,690 @@ class MultiDriftDetector:
         self.drift_detector = drift_detector
         self.warning_confidence = warning_confidence
         self.drift_confidence = drift_confidence
+        self.writers = writers if writers is not None else WriterPool()
+        self.StateLog = MultiDriftDetector.state_logs[storage]
+        self.checkpoint_every = checkpoint_every
+        self.keep_checkpoints = keep_checkpoints
+        self.records_since_checkpoint = 0
+        self.checkpoint_due = False
+        self.checkpoint_count = 0
+        self.sparse_window = sparse_window
+        self.sparse_instances = []
+        self.checked_columns = None # see check_columns
+
+        # Override the class's detectors for this detector only.
+        for name, detector in [('feature_dd', feature_dd), ('label_dd', label_dd), ('concept_dd', concept_dd)]:
+            if detector is not None:
+                setattr(self, name, detector)
+
+        # The streams of each group with a warning or drift, kept up to date by notify.
+        self.status_sets = { group: StatusSets() for group in ['features', 'labels', 'emerging'] }
+
+        # The instance (or batch of instances) being added, for the drift events.
+        self.call = CallState()
+
+        # The locks of the groups of streams, in the order they're taken.
+        self.thread_safe = thread_safe
+        lock = threading.RLock if thread_safe else nullcontext
+        self.locks = { group: lock() for group in ['features', 'labels', 'loss', 'queue'] }
+        self.records_lock = threading.Lock()
+        self.checkpoint_lock = threading.Lock()
 
         # Set up the directory for recording detector state
         root = self.root_dir = os.path.abspath(write_dir)
         fdir = self.feature_dir = os.path.join(root, 'features')
         pdir = self.predictions_dir = os.path.join(root, 'predictions')
         adir = self.accuracy_dir = os.path.join(root, 'accuracy')
+        edir = self.emerging_dir = os.path.join(root, 'emerging')
         prec_dir = self.precision_dir = os.path.join(root, 'precision')
         rec_dir = self.recall_dir = os.path.join(root, 'recall')
-        for xdir in [fdir, pdir, adir, prec_dir, rec_dir]:
+        cdir = self.checkpoint_dir = os.path.join(root, 'checkpoints')
+        for xdir in [fdir, pdir, adir, edir, prec_dir, rec_dir, cdir]:
             if not os.path.exists(xdir):
                 os.makedirs(xdir)
 
         # Create the record of model loss
-        self.loss_file = os.path.join(adir, 'accuracy.csv')
-        with open(self.loss_file, 'w') as f:
-            f.write('value,status,description\n')
+        self.loss_log = self.StateLog(adir, ['accuracy'], self.writers, resume=restore)
         self.loss_stream = DataStream(
-            drift_action = self.drift_action,
-            detector = copy(MultiDriftDetector.concept_dd),
+            drift_action = partial(self.notify, 'accuracy'),
+            detector = copy(self.concept_dd),
             name = 'Concept Drift',
             bidirectional=False # only detect increases in loss
         )
 
-        # The prediction queue for matching predictions with labels
-        self.prediction_queue = {}
+        # The prediction queue for matching predictions with labels.
+        # Changes to the queue are journaled so that it can be restored. The journal
+        # is started afresh at each checkpoint, which names the journal to replay.
+        self.prediction_queue = prediction_store if prediction_store is not None else PredictionStore()
+        self.queue_file = os.path.join(root, 'prediction_queue.jsonl')
+        if restore:
+            self.restore()
+        else:
+            self.writers.init_file(self.queue_file, '')
+        self.remove_old_journals()
 
-    def init_file(self, fpath):
+    def flush(self, sync=False):
         '''
-        Initialise the file (at fpath) which records the state of a given stream.
-        Each stream has a csv with columns value, status, description.
+        Write any buffered rows to the stream files. If sync is True the files
+        are also fsynced, for callers who need the rows to survive a crash.
         '''
-        with open(fpath, 'w') as f:
-            f.write('value,status,description\n')
+        self.flush_files(sync)
+        # Outside the locks, as the drift action might be waiting for one.
+        if hasattr(self.drift_action, 'flush'):
+            self.drift_action.flush()
 
-    def append_file(self, fpath, value, status, description):
+    def flush_files(self, sync=False, writers=True):
         '''
-        When a new value is added to a data stream, append it to that stream's csv file.
+        Write out the rows buffered by the detector. If writers is False, the rows in
+        the WriterPool are left to whoever flushes it (e.g. a DetectorHost, which
+        flushes its shared pool once for all its tenants).
         '''
-        with open(fpath, 'a') as f:
-            f.write(f'{value},{status},"{description}"\n')
+        with self.all_locked():
+            self.flush_sparse()
+            if isinstance(getattr(self, 'feature_streams', None), ShardedStreams):
+                self.feature_streams.flush(sync)
+            if writers:
+                # Only this detector's files, as the pool may be shared with other detectors.
+                self.writers.flush_dir(self.root_dir, sync)
+            self.prediction_queue.flush()
 
-    def set_features(self, feature_names):
+    def close(self):
+        '''
+        Flush and close the stream files.
+        '''
+        with self.all_locked():
+            self.flush_sparse()
+            if isinstance(getattr(self, 'feature_streams', None), ShardedStreams):
+                self.feature_streams.close()
+            for log in self.get_state_logs():
+                log.close()
+            # Only this detector's files, as the pool may be shared with other detectors.
+            self.writers.close_dir(self.root_dir)
+            self.prediction_queue.close()
+        if hasattr(self.drift_action, 'close'):
+            self.drift_action.close()
+
+    def all_locked(self):
+        # Hold the lock of every group, taken in order.
+        stack = ExitStack()
+        for lock in self.locks.values():
+            stack.enter_context(lock)
+        return stack
+
+    def get_state_logs(self):
+        logs = [self.loss_log]
+        if hasattr(self, 'feature_log'):
+            logs.append(self.feature_log)
+        if hasattr(self, 'label_log'):
+            logs.append(self.label_log)
+        if hasattr(self, 'emerging_logs'):
+            logs.extend(self.emerging_logs.values())
+        return logs
+
+    def notify(self, group, event):
+        '''
+        The drift action of every stream. Updates the status sets of the stream's
+        group, and adds the id of the instance which caused the event, then passes
+        it on to drift_action.
+        '''
+        if group in self.status_sets:
+            self.status_sets[group].update(event)
+        if event.instance_id is not None:
+            pass # already known (see sharded.py)
+        elif self.call.instance_ids is None:
+            event.instance_id = self.call.instance_id
+        else:
+            event.instance_id = self.call.instance_ids[event.step if event.step is not None else self.call.step]
+        self.drift_action(event)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def set_features(self, feature_names, vectorized=False):
         '''
         For each of the features in this setting, set up a csv file to record the
         state of that feature stream, and prepare a DataStream object.
+
+        If vectorized is True, the features are instead monitored together by a
+        StreamBank, which gives the same statuses but processes a whole instance
+        with a few array operations. This needs feature_dd to be an HDDM_A_test.
         '''
 
         self.feature_names = feature_names
+        self.checked_columns = None
+        self.status_sets['features'] = StatusSets(feature_names)
+
+        self.feature_streams = self.make_feature_streams(feature_names, vectorized)
 
-        # Set up a DataStream object to monitor each feature.
-        self.feature_streams = {
+        # Create the record of the feature streams
+        self.feature_log = self.StateLog(self.feature_dir, feature_names, self.writers)
+
+        if self.checkpoint_every is not None:
+            self.checkpoint()
+
+    def make_feature_streams(self, feature_names, vectorized=False):
+        '''
+        Make the streams which monitor the features (a DataStream for each feature,
+        or a StreamBank if vectorized), without their state log.
+        '''
+        drift_action = partial(self.notify, 'features')
+        if vectorized:
+            return StreamBank(
+                feature_names,
+                detector = self.feature_dd,
+                drift_action = drift_action,
+                bidirectional=True
+            )
+        # The streams share the one drift action.
+        return {
             feature_name: DataStream(
-                drift_action = self.drift_action,
-                detector = copy(MultiDriftDetector.feature_dd),
+                drift_action = drift_action,
+                detector = copy(self.feature_dd),
                 name = feature_name,
-                bidirectional=True # detected changes in either direction
+                bidirectional=True, # detected changes in either direction
+                single_pass=True # from one set of detector statistics
             ) for feature_name in feature_names
         }
 
-        # Create the header for the feature files
-        for feature_name in feature_names:
-            feature_path = os.path.join(self.feature_dir, feature_name+'.csv')
-            self.init_file(feature_path)
+    @locked('features')
+    def shard_features(self, n_shards):
+        '''
+        Split the feature streams across n_shards worker processes, for when there
+        are too many features for one core to keep up with (see sharded.py).
+        The statuses, drift events and files are the same as without sharding,
+        but the drift events of the features may be passed on a call or two late.
+
+        This needs the csv storage, as each worker writes the csvs of its own
+        features, and the features not to be vectorized (a StreamBank is fast
+        enough without sharding). After a restore, shard the features again.
+        '''
+
+        if not isinstance(self.feature_streams, dict):
+            raise ValueError('Only DataStream features can be sharded, not vectorized or already sharded ones.')
+        if self.StateLog is not CSVStateLog:
+            raise ValueError("Sharded features need storage='csv'.")
 
-    def set_labels(self, label_names):
+        # The workers append to the feature csvs, so the parent's handles on them are closed.
+        self.flush_files()
+        self.writers.close_dir(self.feature_dir)
+        self.feature_streams = ShardedStreams(
+            self.feature_streams,
+            self.feature_dir,
+            n_shards,
+            drift_action = partial(self.notify, 'features'),
+            capacity = self.sparse_window
+        )
+
+    def set_labels(self, label_names, vectorized=False):
         '''
         For each of the label values in this setting, set up a csv file to record the
         state of that label stream, and prepare a DataStream object.
+
+        If vectorized is True, the labels are monitored together by a StreamBank (see set_features).
         '''
 
         self.label_names = label_names
+        self.status_sets['labels'] = StatusSets(label_names)
 
         # Set up a DataStream object to monitor each label value.
-        self.label_streams = {
-            label_name: DataStream(
-                drift_action = self.drift_action,
-                detector = copy(MultiDriftDetector.label_dd),
-                name = label_name,
+        if vectorized:
+            self.label_streams = StreamBank(
+                label_names,
+                detector = self.label_dd,
+                drift_action = partial(self.notify, 'labels'),
                 bidirectional=True
-            ) for label_name in label_names
-        }
+            )
+        else:
+            self.label_streams = {
+                label_name: DataStream(
+                    drift_action = partial(self.notify, 'labels'),
+                    detector = copy(self.label_dd),
+                    name = label_name,
+                    bidirectional=True,
+                    single_pass=True
+                ) for label_name in label_names
+            }
+
+        # Create the record of the label streams
+        self.label_log = self.StateLog(self.predictions_dir, label_names, self.writers)
+
+        if self.checkpoint_every is not None:
+            self.checkpoint()
+
+    @locked('features')
+    def set_emerging_tokens(self, max_streams=20, min_documents=20, n_candidates=100, width=2048, depth=4):
+        '''
+        Monitor the tokens which are out of BOWMachine's vocabulary for any which
+        become common. The tokens are counted by an EmergingTokens (see emerging_tokens.py),
+        whose memory is fixed by n_candidates, width and depth. Once a token has
+        occurred in min_documents documents, up to max_streams such tokens are
+        given a DataStream of their own, recording whether each later instance
+        contains them, under write_dir/emerging/<token>.
+        '''
 
-        # Create the header for the feature files
-        for label_name in label_names:
-            label_path = os.path.join(self.predictions_dir, label_name+'.csv')
-            self.init_file(label_path)
+        self.emerging_tokens = EmergingTokens(max_streams, n_candidates, min_documents, width, depth)
+        self.emerging_streams = {}
+        self.emerging_logs = {}
+        self.status_sets['emerging'] = StatusSets()
 
+    @locked('features')
+    def add_oov_tokens(self, tokens, instance_id, description=''):
+        '''
+        When a new instance arrives, pass the tokens of it which are out of the
+        vocabulary (from BOWMachine.oov_tokens), to update the emerging token streams.
+        '''
+
+        self.call.instance_id = instance_id
+        tokens = set(tokens)
+        for token, stream in self.emerging_streams.items():
+            value = token in tokens
+            self.emerging_logs[token].append([value], [stream.add_value(value)], description)
+
+        # Streams for newly emerged tokens start from the next instance.
+        for token in self.emerging_tokens.add_document(tokens):
+            self.add_emerging_stream(token)
+        self.count_records(1)
+
+    def add_emerging_stream(self, token, resume=False):
+        self.status_sets['emerging'].add_name(token)
+        self.emerging_streams[token] = DataStream(
+            drift_action = partial(self.notify, 'emerging'),
+            detector = copy(self.feature_dd),
+            name = token,
+            bidirectional=True,
+            single_pass=True
+        )
+        group_dir = os.path.join(self.emerging_dir, token)
+        if not os.path.exists(group_dir):
+            os.makedirs(group_dir)
+        self.emerging_logs[token] = self.StateLog(group_dir, [token], self.writers, resume=resume)
+
+    @locked('features')
     def add_instance(self, instance, instance_id, description=''):
         '''
         When a new instance arrives (ie, referral doc), update the DataStream and
-        csv file for each of the data streams.
+        state log for each of the data streams.
+
+        instance can be a list, a NumPy array, a pandas Series (indexed by feature
+        name), or a single row of a pandas DataFrame or a scipy sparse matrix.
+        For several instances at once, use add_instances.
         '''
 
-        for feature_name, value in zip(self.feature_names, instance):
-            feature_stream = self.feature_streams[feature_name]
-            status = feature_stream.add_value(bool(value))
-            feature_path = os.path.join(self.feature_dir, feature_name+'.csv')
-            self.append_file(feature_path, value, status, description)
+        self.flush_sparse()
+        self.call.instance_id = instance_id
 
+        values = self.as_array(instance)
+        if len(values.shape) > 2 or (len(values.shape) == 2 and values.shape[0] != 1):
+            raise ValueError(f'Expected a single instance, not one of shape {values.shape} (see add_instances).')
+        if hasattr(values, 'toarray'):
+            values = values.toarray()
+        values = values.reshape(-1)
 
+        if isinstance(self.feature_streams, ShardedStreams):
+            # The shards update the streams and write their files themselves.
+            self.feature_streams.add_block(values[None], [instance_id], [description])
+            self.count_records(1)
+            return
+
+        if isinstance(self.feature_streams, StreamBank):
+            statuses = self.feature_streams.add_values(values)
+        else:
+            statuses = [
+                self.feature_streams[feature_name].add_value(value)
+                for feature_name, value in zip(self.feature_names, values.astype(bool).tolist())
+            ]
+        self.feature_log.append(values, statuses, description)
+        self.count_records(1)
+
+
+    @locked('labels')
     def add_prediction(self, prediction, instance_id, description=''):
         '''
-        When the model makes a new prediction, update the DataStream and csv file
+        When the model makes a new prediction, update the DataStream and state log
         corresponding to the label value which the model is predicting. Then add
         the prediction to the prediction_queue so it can be matched with a true label later.
         '''
 
+        # Checked before any stream is updated (see encode_id).
+        journal_id = encode_id(instance_id)
+        self.call.instance_id = instance_id
+
         # Which is the label that the model is predicting?
         label = self.label_names[np.argmax(prediction)]
         confidence = np.max(prediction)
 
-        for label_name in self.label_names:
-            value = label_name == label
-            label_stream = self.label_streams[label_name]
-            status = label_stream.add_value(value)
-            label_path = os.path.join(self.predictions_dir, label_name+'.csv')
-            self.append_file(label_path, value, status, description)
+        if isinstance(self.label_streams, StreamBank):
+            values = [ label_name == label for label_name in self.label_names ]
+            statuses = self.label_streams.add_values(values)
+        else:
+            values = []
+            statuses = []
+            for label_name in self.label_names:
+                value = label_name == label
+                label_stream = self.label_streams[label_name]
+                statuses.append(label_stream.add_value(value))
+                values.append(value)
+        self.label_log.append(values, statuses, description)
 
-        self.prediction_queue[instance_id] = (label, confidence)
+        self.add_to_prediction_queue(instance_id, label, confidence, journal_id)
+        self.count_records(1)
 
+    @locked('loss')
     def add_label(self, label, instance_id, description=''):
         '''
         When a new label arrives (ie priority label), match it with a model prediction
         from the prediction_queue, determine if the prediction was correct or not,
-        and then update the loss DataStream and csv file.
+        and then update the loss DataStream and state log.
         '''
 
-        # retrieve from queue with confidence
-        (prediction, confidence) = self.prediction_queue[instance_id]
+        self.call.instance_id = instance_id
+
+        # retrieve from queue with confidence. If the prediction has been evicted
+        # from the queue (or was never made) then the label can't be used.
+        entry = self.get_from_prediction_queue(instance_id)
+        if entry is None:
+            return
+        (prediction, confidence) = entry
 
         value = label == prediction
 
-        if MultiDriftDetector.concept_dd.DETECTOR_NAME == 'CDDM':
+        if self.concept_dd.DETECTOR_NAME == 'CDDM':
             status = self.loss_stream.add_value(value, confidence)
         else:
             status = self.loss_stream.add_value(value)
 
-        self.append_file(self.loss_file, value, status, description)
+        self.loss_log.append([value], [status], description)
+        self.count_records(1)
+
+    @locked('features')
+    def add_instances(self, instances, instance_ids, descriptions=None):
+        '''
+        Batch version of add_instance. instances is a 2-D array with one row per
+        instance and one column per feature (in the order of feature_names).
+        It can also be a pandas DataFrame with the features as columns, or a scipy
+        sparse matrix, whose rows are added with add_sparse_instance if the features
+        are vectorized, and are otherwise made dense a few rows at a time.
+
+        Each feature stream is fed its whole column in one pass and the state log
+        is written with a single append per stream, so the statuses and recorded
+        rows are the same as calling add_instance once per row. The only difference is that
+        drift_action messages are grouped by stream rather than by instance.
+        '''
+
+        self.flush_sparse()
+
+        instances = self.as_array(instances)
+        if descriptions is None:
+            descriptions = [''] * instances.shape[0]
+
+        if hasattr(instances, 'indptr') and not isinstance(self.feature_streams, StreamBank):
+            # Every DataStream sees every value anyway.
+            chunk = max(1, MultiDriftDetector.sparse_chunk_values // len(self.feature_names))
+            for start in range(0, instances.shape[0], chunk):
+                end = start + chunk
+                self.add_instances(instances[start:end].toarray(), instance_ids[start:end], descriptions[start:end])
+            return
+
+        if hasattr(instances, 'indptr'):
+            # Each row is passed on as views of the matrix's buffers.
+            for i, description in enumerate(descriptions):
+                row = slice(instances.indptr[i], instances.indptr[i+1])
+                self.add_sparse_instance(
+                    (instances.indices[row], instances.data[row]), instance_ids[i], description)
+            self.flush_sparse()
+            return
+
+        if isinstance(self.feature_streams, ShardedStreams):
+            self.feature_streams.add_block(instances, list(instance_ids), descriptions)
+            self.count_records(len(instances))
+            return
+
+        # The columns are views of instances, rather than lists of values.
+        columns = instances.T
+        self.call.instance_ids = list(instance_ids)
+        if isinstance(self.feature_streams, StreamBank):
+            status_columns = self.feature_streams.add_block(instances)
+        else:
+            status_columns = []
+            for feature_name, values in zip(self.feature_names, columns.astype(bool).tolist()):
+                status_columns.append(self.add_column(self.feature_streams[feature_name], values))
+        self.call.instance_ids = None
+        self.feature_log.append_columns(columns, status_columns, descriptions)
+        self.count_records(len(instances))
+
+    def add_column(self, stream, values):
+        # Add the values of a batch to a DataStream, one at a time, keeping track
+        # of which instance each is from.
+        statuses = []
+        for step, value in enumerate(values):
+            self.call.step = step
+            statuses.append(stream.add_value(value))
+        return statuses
+
+    @locked('features')
+    def add_packed_instances(self, bits, instance_ids, descriptions=None):
+        '''
+        Batch version of add_instance for presence bits, such as BOWMachine gives
+        with packed=True. bits[i] is np.packbits(instance > 0) of the i-th instance,
+        and the presence (1 or 0) of each feature is recorded as its value.
+
+        The bits are unpacked sparse_window instances at a time, so a large batch
+        is never held unpacked.
+        '''
+
+        bits = np.asarray(bits, dtype=np.uint8)
+        n_features = len(self.feature_names)
+        if bits.shape[1] != (n_features + 7) // 8:
+            raise ValueError(f'Expected {(n_features + 7) // 8} bytes for {n_features} features, but got {bits.shape[1]}.')
+        if descriptions is None:
+            descriptions = [''] * len(bits)
+
+        for start in range(0, len(bits), self.sparse_window):
+            end = start + self.sparse_window
+            self.add_instances(
+                np.unpackbits(bits[start:end], axis=1, count=n_features),
+                instance_ids[start:end],
+                descriptions[start:end]
+            )
+
+    def as_array(self, instances):
+        '''
+        Get the feature values in instances as a NumPy array, or a scipy CSR matrix
+        if instances is sparse, without copying them where possible.
+        '''
+        if hasattr(instances, 'tocsr'):
+            instances = instances.tocsr()
+        else:
+            if hasattr(instances, 'to_numpy'):
+                self.check_columns(instances.columns if hasattr(instances, 'columns') else instances.index)
+                instances = instances.to_numpy()
+            instances = np.asarray(instances)
+        if instances.shape[-1] != len(self.feature_names):
+            raise ValueError(f'Expected {len(self.feature_names)} features, but got {instances.shape[-1]}.')
+        return instances
+
+    def check_columns(self, columns):
+        '''
+        Check that the columns of a pandas DataFrame are feature_names, in order.
+        Each batch from BOWMachine shares the same columns, so they're only checked once.
+        The rows of a DataFrame each have their own index, so Index.is_ is used to
+        recognise them as the columns already checked (which they're views of).
+        '''
+        checked = self.checked_columns
+        if checked is not None and (columns is checked or columns.is_(checked)):
+            return
+        if list(columns) != list(self.feature_names):
+            raise ValueError('The columns do not match feature_names.')
+        self.checked_columns = columns
+
+    @locked('features')
+    def add_sparse_instance(self, instance, instance_id, description=''):
+        '''
+        Sparse version of add_instance, for bag-of-words features where most values are zero.
+        instance is either a pair (indices, values) giving the non-zero features
+        (indices into feature_names), or a scipy sparse matrix with a single row.
+
+        The instance is only held, so the cost of adding it depends on its number of
+        non-zero values rather than the number of features. The streams are brought up
+        to date once sparse_window instances are held, or when the status is asked for,
+        or the detector is flushed: every stream is caught up over all the held
+        instances at once, by StreamBank.add_block. The statuses and recorded rows
+        are the same as calling add_instance for each instance, but drift_action
+        messages are delayed until the streams are caught up.
+
+        Every stream still records every zero, with its status at that row, so the
+        features must be vectorized (see set_features): a StreamBank updates every
+        stream over a run of instances with array operations, where DataStreams
+        would have to be given the zeros one at a time.
+        '''
 
+        if not isinstance(self.feature_streams, StreamBank):
+            raise ValueError('Sparse instances can only be added to vectorized features '
+                '(see set_features); use add_instance or add_instances otherwise.')
+        if hasattr(instance, 'indices'):
+            indices, values = instance.indices, instance.data
+        else:
+            indices, values = instance
+        self.sparse_instances.append((np.asarray(indices), np.asarray(values), instance_id, description))
+        if len(self.sparse_instances) >= self.sparse_window:
+            self.flush_sparse()
 
-    def get_status(self):
+    @locked('features')
+    def flush_sparse(self):
+        '''
+        Catch the feature streams up with the instances held by add_sparse_instance.
+        '''
+
+        if len(self.sparse_instances) == 0:
+            return
+        held, self.sparse_instances = self.sparse_instances, []
+
+        # Zeros are recorded with the same type as the non-zero values.
+        indices, values, instance_ids, descriptions = zip(*held)
+        dtype = np.concatenate([np.zeros(0, dtype=np.int64)] + list(values)).dtype
+
+        # The instances are made dense a few rows at a time, so that a large
+        # vocabulary doesn't need a dense copy of the whole window at once.
+        n_features = len(self.feature_names)
+        chunk = max(1, MultiDriftDetector.sparse_chunk_values // n_features)
+        for start in range(0, len(held), chunk):
+            end = min(start + chunk, len(held))
+            instances = np.zeros((end - start, n_features), dtype=dtype)
+            for i in range(start, end):
+                instances[i - start, indices[i]] = values[i]
+            self.add_instances(instances, instance_ids[start:end], descriptions[start:end])
+
+    @locked('labels')
+    def add_predictions(self, predictions, instance_ids, descriptions=None):
+        '''
+        Batch version of add_prediction. predictions is a 2-D array of softmax
+        outputs with one row per instance, and instance_ids gives the id of each row.
+        '''
+
+        predictions = np.asarray(predictions)
+        if descriptions is None:
+            descriptions = [''] * len(predictions)
+        journal_ids = [ encode_id(instance_id) for instance_id in instance_ids ]
+
+        # Which are the labels that the model is predicting?
+        label_indices = np.argmax(predictions, axis=1)
+        confidences = np.max(predictions, axis=1)
+
+        self.call.instance_ids = list(instance_ids)
+        if isinstance(self.label_streams, StreamBank):
+            block = label_indices[:, None] == np.arange(len(self.label_names))
+            columns = block.T.tolist()
+            status_columns = self.label_streams.add_block(block)
+        else:
+            columns = []
+            status_columns = []
+            for k, label_name in enumerate(self.label_names):
+                values = (label_indices == k).tolist()
+                status_columns.append(self.add_column(self.label_streams[label_name], values))
+                columns.append(values)
+        self.call.instance_ids = None
+        self.label_log.append_columns(columns, status_columns, descriptions)
+
+        for instance_id, k, confidence, journal_id in zip(instance_ids, label_indices, confidences, journal_ids):
+            self.add_to_prediction_queue(instance_id, self.label_names[k], confidence, journal_id)
+        self.count_records(len(predictions))
+
+    @locked('loss')
+    def add_labels(self, labels, instance_ids, descriptions=None):
+        '''
+        Batch version of add_label. labels[i] is the true label of instance_ids[i].
+
+        The ids are all checked before any label is added, so a bad one fails the
+        whole batch. If a label fails part way through anyway, the labels before it
+        are still recorded before the error is raised.
+        '''
+
+        if descriptions is None:
+            descriptions = [''] * len(labels)
+        journal_ids = [ encode_id(instance_id) for instance_id in instance_ids ]
+
+        use_conf = self.concept_dd.DETECTOR_NAME == 'CDDM'
+        values = []
+        statuses = []
+        kept_descriptions = []
+        try:
+            for label, instance_id, journal_id, description in zip(labels, instance_ids, journal_ids, descriptions):
+                entry = self.get_from_prediction_queue(instance_id, journal_id)
+                if entry is None:
+                    continue
+                (prediction, confidence) = entry
+                self.call.instance_id = instance_id
+                value = label == prediction
+                if use_conf:
+                    status = self.loss_stream.add_value(value, confidence)
+                else:
+                    status = self.loss_stream.add_value(value)
+                values.append(value)
+                statuses.append(status)
+                kept_descriptions.append(description)
+        finally:
+            self.loss_log.append_columns([values], [statuses], kept_descriptions)
+            self.count_records(len(values))
+
+
+    def get_status(self, display=True):
         '''
         Print the overall status of the detector. That is,
         - the real drift status
         - the feature drift status
         - the label drift status
+
+        The statuses are also returned, as a DetectorStatus (see status.py).
+        The streams with a warning or drift are tracked as their statuses change,
+        so this doesn't need to look at every stream.
         '''
 
+        # Bring the feature streams up to date first.
+        with self.all_locked():
+            self.flush_sparse()
+            if isinstance(getattr(self, 'feature_streams', None), ShardedStreams):
+                self.feature_streams.join()
+            status = DetectorStatus(self.loss_stream.get_status(), self.status_sets)
+        if not display:
+            return status
+
         # use a wasabi Printer for nice outputs
         msg = Printer()
 
         # Display concept drift status
-        concept_status = self.loss_stream.get_status()
-        if concept_status == 'DRIFT':
+        if status.concept == 'DRIFT':
             msg.fail('Concept drift detected.')
-        elif concept_status == 'WARNING':
+        elif status.concept == 'WARNING':
             msg.warn('Concept drift suspected.')
         else:
             msg.good('Loss distribution normal.')
 
         # Display feature drift status
-        warn_features = []
-        drift_features = []
-        for feature in self.feature_names:
-            feature_status = self.feature_streams[feature].get_status()
-            if feature_status == 'DRIFT':
-                drift_features.append(feature)
-            elif feature_status == 'WARN':
-                warn_features.append(feature)
+        warn_features = status.warning['features']
+        drift_features = status.drift['features']
         if len(warn_features) > 0:
             msg.warn('Feature drift suspected on the following: '+', '.join(warn_features))
         if len(drift_features) > 0:
@@ -225,14 +837,8 @@ class MultiDriftDetector:
             msg.good('Feature distribution normal.')
 
         # Display label drift status
-        warn_labels = []
-        drift_labels = []
-        for label in self.label_names:
-            label_status = self.label_streams[label].get_status()
-            if label_status == 'DRIFT':
-                drift_labels.append(label)
-            elif label_status == 'WARN':
-                warn_labels.append(label)
+        warn_labels = status.warning['labels']
+        drift_labels = status.drift['labels']
         if len(warn_labels) > 0:
             msg.warn('Label drift suspected on the following: '+', '.join(warn_labels))
         if len(drift_labels) > 0:
@@ -240,18 +846,258 @@ class MultiDriftDetector:
         if len(drift_labels)==0 and len(warn_labels)==0:
             msg.good('Label distribution normal.')
 
+        return status
+
     '''
-    TODO: Implement these so that the model can be interrupted and restored
+    Checkpointing, so that the detector can be interrupted and restored.
+
+    A checkpoint is a pickle of every DataStream (and so its detector's statistics),
+    the prediction queue, and the offsets which the state logs and the prediction
+    queue journal had reached. Restoring loads the newest checkpoint and replays
+    only what was written after those offsets.
     '''
 
-    def read_prediction_queue(self):
-        pass
+    def read_prediction_queue(self, offset=0):
+        '''
+        Replay the prediction queue journal from offset (in bytes) onto the
+        prediction queue. Returns the confidences of the predictions which were
+        taken from the queue, in order, as the loss stream needs these for CDDM.
+        '''
+        confidences = []
+        with open(self.queue_file, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                event = json.loads(line)
+                if event[0] == 'add':
+                    _, instance_id, prediction, confidence, added = event
+                    self.prediction_queue.put(decode_id(instance_id), prediction, confidence, added)
+                else:
+                    _, instance_id, confidence = event
+                    self.prediction_queue.pop(decode_id(instance_id))
+                    confidences.append(confidence)
+        return confidences
+
+    @locked('queue')
+    def add_to_prediction_queue(self, instance_id, prediction, confidence, journal_id=None):
+        # journal_id is encode_id(instance_id), if the caller already has it.
+        if journal_id is None:
+            journal_id = encode_id(instance_id)
+        added = self.prediction_queue.clock()
+        self.prediction_queue.put(instance_id, prediction, confidence, added)
+        self.writers.write(self.queue_file, json.dumps(
+            ['add', journal_id, prediction, float(confidence), added], default=to_json) + '\n')
+
+    @locked('queue')
+    def get_from_prediction_queue(self, instance_id, journal_id=None):
+        '''
+        Take the (prediction, confidence) for an instance off the queue,
+        or return None if it isn't there.
+        '''
+        entry = self.prediction_queue.pop(instance_id)
+        if entry is not None:
+            if journal_id is None:
+                journal_id = encode_id(instance_id)
+            self.writers.write(self.queue_file, json.dumps(
+                ['get', journal_id, float(entry[1])], default=to_json) + '\n')
+        return entry
+
+    def count_records(self, n_records):
+        '''
+        Keep track of how many records have been added, and take a checkpoint
+        every checkpoint_every records.
+        '''
+        if self.checkpoint_every is None:
+            return
+        with self.records_lock:
+            self.records_since_checkpoint += n_records
+            if self.records_since_checkpoint >= self.checkpoint_every:
+                self.checkpoint_due = True
+        # In thread-safe mode, it's taken as the locked method returns (see locked).
+        # Records can also be added while a checkpoint is being written (by flush_sparse),
+        # in which case that checkpoint includes them, so this doesn't wait for it.
+        if self.checkpoint_due and not self.thread_safe:
+            self.checkpoint(blocking=False)
+
+    def checkpoint(self, blocking=True):
+        '''
+        Save the state of the detector to write_dir/checkpoints.
+        If blocking is False and a checkpoint is already being taken, return without taking one.
+        '''
+        # If another thread is already taking a checkpoint, it'll include the records so far.
+        if not self.checkpoint_lock.acquire(blocking):
+            return
+        try:
+            with self.all_locked():
+                self.write_checkpoint()
+        finally:
+            self.checkpoint_lock.release()
+
+    def write_checkpoint(self):
+
+        # The logs need to be on disk for their offsets to be right.
+        self.flush_files()
+
+        # The checkpoint holds the queue itself, so the changes to it after the
+        # checkpoint are journaled to a new file.
+        self.checkpoint_count += 1
+        queue_file = os.path.join(self.root_dir, f'prediction_queue_{self.checkpoint_count:08d}.jsonl')
+        state = {
+            'loss_stream': self.loss_stream,
+            'prediction_queue': self.prediction_queue.entries,
+            'journal': os.path.basename(queue_file),
+            'offsets': {
+                'accuracy': self.loss_log.get_offsets(),
+                'prediction_queue': 0,
+            }
+        }
+        if hasattr(self, 'feature_names'):
+            state['feature_names'] = self.feature_names
+            state['feature_streams'] = self.feature_streams
+            if isinstance(self.feature_streams, ShardedStreams):
+                # Checkpointed as the DataStreams themselves, so that it restores unsharded.
+                state['feature_streams'] = self.feature_streams.gather()
+            state['offsets']['features'] = self.feature_log.get_offsets()
+        if hasattr(self, 'label_names'):
+            state['label_names'] = self.label_names
+            state['label_streams'] = self.label_streams
+            state['offsets']['predictions'] = self.label_log.get_offsets()
+        if hasattr(self, 'emerging_tokens'):
+            state['emerging_tokens'] = self.emerging_tokens
+            state['emerging_streams'] = self.emerging_streams
+            state['offsets']['emerging'] = {
+                token: log.get_offsets() for token, log in self.emerging_logs.items() }
+
+        # Write to a temporary file first so that a checkpoint is never half written.
+        path = os.path.join(self.checkpoint_dir, f'checkpoint_{self.checkpoint_count:08d}.pkl')
+        with open(path+'.tmp', 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        self.writers.init_file(queue_file, '')
+        os.replace(path+'.tmp', path)
+        sync_dir(self.checkpoint_dir)
+        with self.records_lock:
+            self.records_since_checkpoint = 0
+            self.checkpoint_due = False
 
-    def add_to_prediction_queue(self, instance_id, prediction, confidence):
-        pass
+        # The old journal is only needed to restore from an older checkpoint.
+        old_queue_file, self.queue_file = self.queue_file, queue_file
+        self.writers.close_file(old_queue_file)
+        os.remove(old_queue_file)
 
-    def get_from_prediction_queue(self, instance_id):
-        pass
+        # Delete the old checkpoints.
+        for old_path in self.get_checkpoints()[:-self.keep_checkpoints]:
+            os.remove(old_path)
+
+    def remove_old_journals(self):
+        # Remove the journals other than the current one, e.g. one started by a
+        # checkpoint which didn't get written, or left by an earlier run.
+        for fpath in glob(os.path.join(self.root_dir, 'prediction_queue*.jsonl')):
+            if os.path.abspath(fpath) != os.path.abspath(self.queue_file):
+                os.remove(fpath)
+
+    def get_checkpoints(self):
+        return sorted(glob(os.path.join(self.checkpoint_dir, 'checkpoint_*.pkl')))
 
     def restore(self):
-        pass
+        '''
+        Restore the detector from the newest checkpoint, then replay the values
+        written to the state logs, and the prediction queue journal, since it was taken.
+        Drift actions aren't repeated for the replayed values.
+        '''
+
+        checkpoints = self.get_checkpoints()
+        if len(checkpoints) == 0:
+            raise FileNotFoundError(f'There are no checkpoints to restore from in {self.checkpoint_dir}.')
+        with open(checkpoints[-1], 'rb') as f:
+            state = pickle.load(f)
+        self.checkpoint_count = int(re.search(r'checkpoint_(\d+)', checkpoints[-1]).group(1))
+        offsets = state['offsets']
+
+        self.prediction_queue.entries = state['prediction_queue']
+        # Checkpoints from before the journal was rotated don't name it.
+        self.queue_file = os.path.join(self.root_dir, state.get('journal', 'prediction_queue.jsonl'))
+        confidences = self.read_prediction_queue(offsets['prediction_queue'])
+
+        self.loss_stream = state['loss_stream']
+        self.replay(self.loss_log, offsets['accuracy'], {'accuracy': self.loss_stream}, 'accuracy', confidences)
+
+        if 'feature_names' in state:
+            self.feature_names = state['feature_names']
+            self.feature_streams = state['feature_streams']
+            self.feature_log = self.StateLog(
+                self.feature_dir, self.feature_names, self.writers, resume=True)
+            self.status_sets['features'] = StatusSets(self.feature_names)
+            self.replay(self.feature_log, offsets['features'], self.feature_streams, 'features')
+
+        if 'label_names' in state:
+            self.label_names = state['label_names']
+            self.label_streams = state['label_streams']
+            self.label_log = self.StateLog(
+                self.predictions_dir, self.label_names, self.writers, resume=True)
+            self.status_sets['labels'] = StatusSets(self.label_names)
+            self.replay(self.label_log, offsets['predictions'], self.label_streams, 'labels')
+
+        # The emerging token counts are as they were at the checkpoint, as the
+        # tokens of the instances since then aren't recorded.
+        if 'emerging_tokens' in state:
+            self.emerging_tokens = state['emerging_tokens']
+            self.emerging_streams = {}
+            self.emerging_logs = {}
+            self.status_sets['emerging'] = StatusSets()
+            for token, stream in state['emerging_streams'].items():
+                self.add_emerging_stream(token, resume=True)
+                self.emerging_streams[token] = stream
+                self.replay(self.emerging_logs[token], offsets['emerging'][token], {token: stream}, 'emerging')
+
+    def replay(self, log, offsets, streams, group, confidences=None):
+        '''
+        Feed the values written to a state log since offsets back into its streams.
+        streams is either a StreamBank or a dict of DataStreams, and group is
+        which of the detector's groups of streams they are.
+
+        The drift actions aren't repeated, so the status sets of the group are set
+        from the streams afterwards.
+        '''
+        columns = log.read_tail(offsets)
+
+        if isinstance(streams, StreamBank):
+            streams.drift_action = lambda message: None
+            streams.add_block(np.array(columns).reshape(len(log.names), -1).T)
+            streams.drift_action = partial(self.notify, group)
+        else:
+            self.replay_streams(log, columns, streams, group, confidences)
+        if group in self.status_sets:
+            self.status_sets[group].reset(
+                (name, streams[name].get_status()) for name in log.names)
+
+    def replay_streams(self, log, columns, streams, group, confidences):
+        # Replay a dict of DataStreams, one stream at a time.
+        use_conf = confidences is not None and \
+            self.concept_dd.DETECTOR_NAME == 'CDDM'
+        for stream, values in zip([ streams[name] for name in log.names ], columns):
+            stream.drift_action = lambda message: None
+            if use_conf:
+                for value, confidence in zip(values, confidences):
+                    stream.add_value(bool(value), confidence)
+            else:
+                for value in values:
+                    stream.add_value(bool(value))
+            stream.drift_action = partial(self.notify, group)
+
+def to_json(obj):
+    # Labels may be numpy scalars, which json can't encode directly.
+    return obj.item()
+
+def sync_dir(directory):
+    # fsync a directory, so that a file renamed into it stays renamed after a crash.
+    # Directories can't be opened to fsync them on Windows.
+    if os.name != 'posix':
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,163 @@
+import json
+import time
+import pickle
+import base64
+import shelve
+from collections import OrderedDict
+import numpy as np
+
+def encode_id(instance_id):
+    '''
+    Encode an instance id as json, for the prediction queue journal and the spill index.
+
+    An instance id can be any hashable, picklable value which is equal to itself
+    after pickling. Strings, ints, floats and None (and NumPy scalars) are kept as
+    they are, and anything else (e.g. a tuple or a uuid.UUID) is pickled, so that
+    it's decoded as an equal id. Raises TypeError for an id which can't be used.
+    '''
+    if isinstance(instance_id, np.generic):
+        instance_id = instance_id.item()
+    hash(instance_id)
+    if instance_id is None or type(instance_id) in (str, int, float):
+        return instance_id
+    try:
+        return {'pickle': base64.b64encode(pickle.dumps(instance_id)).decode('ascii')}
+    except Exception as e:
+        raise TypeError(f'The instance id {instance_id!r} can\'t be pickled.') from e
+
+def decode_id(encoded):
+    # The inverse of encode_id.
+    if isinstance(encoded, dict):
+        return pickle.loads(base64.b64decode(encoded['pickle']))
+    return encoded
+
+class PredictionStore:
+
+    '''
+    Holds the model's predictions until their true labels arrive, so that they
+    can be matched up to track the model's accuracy.
+
+    An entry is deleted as soon as it is matched with its label. Many predictions
+    never get a label though, so entries can also be evicted:
+    - once there are more than max_size entries, the oldest are evicted,
+    - once an entry is older than max_age seconds, it is evicted.
+    Evicted entries are dropped, unless spill_path is given, in which case they
+    are moved to an on-disk index at spill_path and can still be matched from there.
+    A spilled entry is dropped once it has been on disk for spill_max_age seconds
+    (by default max_age). The index is swept for these every tenth of spill_max_age.
+
+    The counters hits, misses, evictions, spill_hits and spill_expired record how
+    the store has been used.
+    '''
+
+    def __init__(
+            self,
+            max_size=None, # The maximum number of entries to keep in memory (None for no limit)
+            max_age=None, # The maximum age of an entry in seconds (None for no limit)
+            spill_path=None, # Where to keep evicted entries on disk (None to drop them)
+            spill_max_age=None, # How long to keep an entry on disk in seconds (by default max_age, None for no limit)
+            clock=time.time # Where the time entries are added is taken from
+            ):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.spill_path = spill_path
+        self.spill_max_age = spill_max_age if spill_max_age is not None else max_age
+        self.clock = clock
+        self.entries = OrderedDict() # instance_id -> (prediction, confidence, time added)
+        # spill_key(instance_id) -> (prediction, confidence, time added, time spilled)
+        self.spill = shelve.open(spill_path) if spill_path is not None else None
+        self.next_sweep = None # when to next drop the expired spilled entries
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.spill_hits = 0
+        self.spill_expired = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, instance_id):
+        return instance_id in self.entries
+
+    @staticmethod
+    def spill_key(instance_id):
+        return json.dumps(encode_id(instance_id))
+
+    def put(self, instance_id, prediction, confidence, added=None):
+        '''
+        Add the prediction for an instance. added is the time it was made
+        (by default, now).
+        '''
+        if added is None:
+            added = self.clock()
+        self.entries[instance_id] = (prediction, confidence, added)
+        self.entries.move_to_end(instance_id)
+        self.evict()
+
+    def pop(self, instance_id):
+        '''
+        Remove and return the (prediction, confidence) for an instance,
+        or None if there is no prediction for it.
+        '''
+        entry = self.entries.pop(instance_id, None)
+        if entry is None and self.spill is not None:
+            entry = self.spill.pop(PredictionStore.spill_key(instance_id), None)
+            if entry is not None:
+                self.spill_hits += 1
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[:2]
+
+    def evict(self):
+        '''
+        Evict the entries which are too old, or which don't fit under max_size.
+        '''
+        if self.max_age is not None:
+            oldest_allowed = self.clock() - self.max_age
+            while self.entries and next(iter(self.entries.values()))[2] < oldest_allowed:
+                self.evict_oldest()
+        if self.max_size is not None:
+            while len(self.entries) > self.max_size:
+                self.evict_oldest()
+        if self.spill is not None and self.spill_max_age is not None:
+            now = self.clock()
+            if self.next_sweep is None or now >= self.next_sweep:
+                self.sweep_spill(now)
+
+    def sweep_spill(self, now):
+        # Drop the spilled entries which have been on disk for spill_max_age seconds.
+        # This reads the whole index, so it's only done every tenth of spill_max_age.
+        oldest_allowed = now - self.spill_max_age
+        for key in list(self.spill.keys()):
+            if self.spill[key][-1] < oldest_allowed:
+                del self.spill[key]
+                self.spill_expired += 1
+        self.next_sweep = now + self.spill_max_age / 10
+
+    def evict_oldest(self):
+        instance_id, entry = self.entries.popitem(last=False)
+        self.evictions += 1
+        if self.spill is not None:
+            self.spill[PredictionStore.spill_key(instance_id)] = entry + (self.clock(),)
+
+    def get_stats(self):
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'spill_hits': self.spill_hits,
+            'spill_expired': self.spill_expired,
+        }
+
+    def flush(self):
+        if self.spill is not None:
+            self.spill.sync()
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
@@ -0,0 +1,285 @@
+import time
+import queue
+import traceback
+from collections import deque
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from multidriftdetector.writers import WriterPool
+from multidriftdetector.state_log import CSVStateLog
+
+class ShardedStreams:
+
+    '''
+    The feature streams of a MultiDriftDetector, split across n_shards worker
+    processes. Each worker owns the DataStreams of a contiguous range of the
+    features, and writes their csv files under feature_dir itself.
+
+    The parent writes each block of instances once, into a buffer of capacity rows
+    in shared memory, and sends each worker a short message saying where it is.
+    The workers read their own columns from the buffer, and send back the drift
+    events of their streams on a result queue. Rows of the buffer are reused once
+    every worker is done with them.
+
+    The statuses and files are the same as with the streams in one process. The
+    drift events are the same too, and in the same order as each other, but they're passed to
+    drift_action once every worker has finished the call they came from, which
+    can be during a later call (or join, which waits for the workers to catch up).
+
+    If a worker fails (or dies), the call waiting on it raises a RuntimeError, as do
+    any later calls which need every worker. close() still stops the other workers
+    (closing their files) and frees the shared memory.
+    '''
+
+    # Rows of the buffer are this many bytes per feature, so any numeric dtype fits.
+    item_bytes = 8
+
+    # How often to check that the workers are alive while waiting on them, and how
+    # long close waits for a worker to stop before terminating it, in seconds.
+    poll_seconds = 1.0
+    close_seconds = 30.0
+
+    def __init__(
+            self,
+            streams, # The DataStreams to split, keyed by feature name, in feature order
+            feature_dir, # Where the feature csvs are
+            n_shards, # The number of worker processes
+            drift_action, # Called with each DriftEvent
+            capacity=256 # The number of rows in the shared buffer
+            ):
+        self.names = list(streams)
+        self.drift_action = drift_action
+        self.capacity = capacity
+        self.row_bytes = len(self.names) * ShardedStreams.item_bytes
+        self.shm = SharedMemory(create=True, size=capacity * self.row_bytes)
+
+        # The blocks sent but not yet finished by every worker: (seq, start row, n rows).
+        self.in_flight = deque()
+        self.remaining = {} # seq -> the number of workers still working on it
+        self.events = {} # seq -> [(sort key, event)]
+        self.ends_call = {} # seq -> is it the last block of an add_block call?
+        self.call_events = [] # the events of the finished blocks of the current call
+        self.replies = {}
+        self.failed = {} # k -> why the worker failed
+        self.head = 0
+        self.seq = 0
+
+        # spawn rather than fork, as the parent may have threads (e.g. a DriftDispatcher's).
+        context = get_context('spawn')
+        self.results = context.Queue()
+        self.commands = []
+        self.workers = []
+        bounds = np.linspace(0, len(self.names), n_shards + 1).astype(int)
+        for k in range(n_shards):
+            names = self.names[bounds[k]:bounds[k+1]]
+            commands = context.Queue()
+            worker = context.Process(
+                target=run_shard,
+                args=(k, bounds[k], [ streams[name] for name in names ], names, feature_dir,
+                    self.shm.name, capacity, len(self.names), commands, self.results),
+                daemon=True
+            )
+            worker.start()
+            self.commands.append(commands)
+            self.workers.append(worker)
+
+    def add_block(self, block, instance_ids, descriptions):
+        '''
+        Send a block of instances (one row per instance) to the workers.
+        '''
+        self.check_workers(poll=False)
+        block = np.asarray(block)
+        if block.dtype.hasobject or block.dtype.itemsize > ShardedStreams.item_bytes:
+            block = block.astype(np.float64)
+        for start in range(0, len(block), self.capacity):
+            end = start + self.capacity
+            self.send(block[start:end], instance_ids[start:end], descriptions[start:end],
+                first_step=start, ends_call=end >= len(block))
+
+    def send(self, rows, instance_ids, descriptions, first_step, ends_call):
+        n = len(rows)
+        start = self.head if self.head + n <= self.capacity else 0
+
+        # Wait for the workers to finish with the rows to be overwritten.
+        while any(start < s + m and s < start + n for _, s, m in self.in_flight):
+            self.receive()
+
+        np.ndarray(rows.shape, rows.dtype, self.shm.buf, start * self.row_bytes)[:] = rows
+        self.head = start + n
+        seq = self.seq
+        self.seq += 1
+        self.in_flight.append((seq, start, n))
+        self.remaining[seq] = len(self.workers)
+        self.events[seq] = []
+        self.ends_call[seq] = ends_call
+        message = ('block', seq, start, n, first_step, rows.dtype.str, list(instance_ids), list(descriptions))
+        for commands in self.commands:
+            commands.put(message)
+        self.poll()
+
+    def receive(self, block=True):
+        # Handle one message from the workers. While waiting, check every so often
+        # that they're all still running, as a dead worker won't send what's waited for.
+        while True:
+            self.check_workers(poll=False)
+            try:
+                message = self.results.get(block, ShardedStreams.poll_seconds)
+                break
+            except queue.Empty:
+                if not block:
+                    raise
+                self.check_workers()
+        if message[0] == 'error':
+            self.failed[message[1]] = message[2]
+            self.check_workers(poll=False)
+        if message[0] == 'reply':
+            self.replies[message[1]] = message[2]
+            return
+        _, k, seq, events = message
+        self.events[seq].extend(events)
+        self.remaining[seq] -= 1
+
+        # Pass on the events of each call once all its blocks are finished, in
+        # the order the streams would have raised them in one process.
+        while self.in_flight and self.remaining[self.in_flight[0][0]] == 0:
+            seq, _, _ = self.in_flight.popleft()
+            del self.remaining[seq]
+            self.call_events.extend(self.events.pop(seq))
+            if self.ends_call.pop(seq):
+                events, self.call_events = self.call_events, []
+                for _, event in sorted(events, key=lambda item: item[0]):
+                    self.drift_action(event)
+
+    def check_workers(self, poll=True):
+        # Raise a RuntimeError if any worker has failed, or (if poll is True) died.
+        for k, worker in enumerate(self.workers if poll else []):
+            if k not in self.failed and not worker.is_alive():
+                self.failed[k] = f'The worker process exited with code {worker.exitcode}.'
+        if self.failed:
+            k = min(self.failed)
+            raise RuntimeError(f'Feature shard {k} failed:\n{self.failed[k]}')
+
+    def poll(self):
+        # Handle the messages which have already arrived, without waiting.
+        while True:
+            try:
+                self.receive(block=False)
+            except queue.Empty:
+                return
+
+    def join(self):
+        '''
+        Wait until the workers have finished every block, and their events are passed on.
+        '''
+        while self.in_flight:
+            self.receive()
+
+    def request(self, *command):
+        # Send every worker a command, and return their replies in order.
+        self.replies = {}
+        for commands in self.commands:
+            commands.put(command)
+        while len(self.replies) < len(self.workers):
+            self.receive()
+        return [ self.replies[k] for k in range(len(self.workers)) ]
+
+    def flush(self, sync=False):
+        self.request('flush', sync)
+
+    def gather(self):
+        '''
+        Get a copy of every DataStream, keyed by feature name, in feature order.
+        '''
+        streams = {}
+        for shard in self.request('streams'):
+            streams.update(shard)
+        return streams
+
+    def close(self):
+        '''
+        Wait for the workers to finish, close their files, and stop them.
+        If a worker has failed, the others are only told to close their files.
+        '''
+        if not self.workers:
+            return
+        try:
+            if not self.failed:
+                self.request('close')
+            else:
+                for k, commands in enumerate(self.commands):
+                    if k not in self.failed:
+                        commands.put(('close',))
+        finally:
+            self.stop_workers()
+            self.shm.close()
+            self.shm.unlink()
+
+    def stop_workers(self):
+        # Join the workers, reading their messages meanwhile (a worker can't exit
+        # until what it sent has been read), and terminate any which don't stop in time.
+        workers, self.workers = self.workers, []
+        deadline = time.monotonic() + ShardedStreams.close_seconds
+        while any( worker.is_alive() for worker in workers ) and time.monotonic() < deadline:
+            try:
+                self.results.get(timeout=0.05)
+            except queue.Empty:
+                pass
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+def run_shard(k, offset, streams, names, feature_dir, shm_name, capacity, n_features, commands, results):
+    '''
+    The loop of a worker process, which owns the streams of features offset
+    to offset+len(streams).
+    '''
+    try:
+        shm = SharedMemory(shm_name)
+        row_bytes = n_features * ShardedStreams.item_bytes
+        log = CSVStateLog(feature_dir, names, WriterPool(), resume=True)
+        events = []
+        for stream in streams:
+            stream.drift_action = events.append
+        columns_slice = slice(offset, offset + len(streams))
+
+        while True:
+            command = commands.get()
+
+            if command[0] == 'block':
+                _, seq, start, n, first_step, dtype, instance_ids, descriptions = command
+                block = np.ndarray((n, n_features), np.dtype(dtype), shm.buf, start * row_bytes)
+                columns = block[:, columns_slice].T
+
+                # As MultiDriftDetector.add_column, with each event keyed by its
+                # feature and step within the call, so that the parent can put the events
+                # of every worker in the order they'd have been raised in one process.
+                keyed_events = []
+                status_columns = []
+                for j, (stream, values) in enumerate(zip(streams, columns.astype(bool).tolist())):
+                    statuses = []
+                    for step, value in enumerate(values):
+                        statuses.append(stream.add_value(value))
+                        for event in events:
+                            event.instance_id = instance_ids[step]
+                            keyed_events.append(((offset + j, first_step + step), event))
+                        events.clear()
+                    status_columns.append(statuses)
+                log.append_columns(columns, status_columns, descriptions)
+                del block, columns
+                results.put(('done', k, seq, keyed_events))
+
+            elif command[0] == 'flush':
+                log.flush(command[1])
+                results.put(('reply', k, None))
+
+            elif command[0] == 'streams':
+                results.put(('reply', k, dict(zip(names, streams))))
+
+            elif command[0] == 'close':
+                log.close()
+                shm.close()
+                results.put(('reply', k, None))
+                return
+    except Exception:
+        results.put(('error', k, traceback.format_exc()))
@@ -0,0 +1,372 @@
+import os
+import sys
+import io
+import csv
+import json
+from glob import glob
+import numpy as np
+from multidriftdetector.writers import WriterPool
+
+'''
+A state log records, for a group of streams (the features, the predicted labels,
+or the accuracy), the value, status and description of every stream at every step.
+
+There are two layouts:
+- CSVStateLog writes one csv per stream, with columns value, status, description.
+  This is what the driftviewer app reads.
+- ColumnarStateLog writes one set of append-only binary files per group, which
+  can be read back with memory mapping rather than parsed:
+    streams.json          the stream names, in column order
+    values.bin            float32 matrix, one row per step and one column per stream
+    status.bin            uint8 matrix of status codes, same shape as values.bin
+    description_ids.bin   uint32, one per step, indexing into descriptions.jsonl
+    descriptions.jsonl    each distinct description once, json encoded, one per line
+'''
+
+# Statuses are stored as these codes in the columnar layout.
+STATUS_NAMES = ['NORMAL', 'WARNING', 'DRIFT']
+STATUS_CODES = { name: code for code, name in enumerate(STATUS_NAMES) }
+
+class CSVStateLog:
+
+    '''
+    Records the state of a group of streams with one csv file per stream.
+    '''
+
+    def __init__(self, group_dir, names, writers, resume=False):
+        '''
+        If resume is True the existing files are appended to rather than truncated.
+        '''
+        self.group_dir = group_dir
+        self.names = list(names)
+        self.writers = writers
+        self.paths = [ os.path.join(group_dir, name+'.csv') for name in self.names ]
+        if not resume:
+            for path in self.paths:
+                self.init_file(path)
+
+    def init_file(self, fpath):
+        '''
+        Initialise the file (at fpath) which records the state of a given stream.
+        Each stream has a csv with columns value, status, description.
+        '''
+        self.writers.init_file(fpath, 'value,status,description\n')
+
+    def append_file(self, fpath, value, status, description):
+        '''
+        When a new value is added to a data stream, append it to that stream's csv file.
+        '''
+        self.writers.write(fpath, f'{value},{status},{quote(description)}\n')
+
+    def append_rows(self, fpath, values, statuses, descriptions):
+        '''
+        Append a batch of values to a stream's csv file in one write.
+        The rows are identical to calling append_file once per value.
+        '''
+        self.write_rows(fpath, values, statuses, [ quote(d) for d in descriptions ])
+
+    def write_rows(self, fpath, values, statuses, fields):
+        # As append_rows, with the descriptions already quoted.
+        self.writers.write(fpath, ''.join(
+            f'{value},{status},{field}\n'
+            for value, status, field in zip(values, statuses, fields)
+        ))
+
+    def append(self, values, statuses, description):
+        '''
+        Record one step of every stream in the group.
+        '''
+        field = quote(description)
+        write = self.writers.write
+        for fpath, value, status in zip(self.paths, values, statuses):
+            write(fpath, f'{value},{status},{field}\n')
+
+    def append_columns(self, columns, status_columns, descriptions):
+        '''
+        Record several steps of every stream in the group. columns[j] and
+        status_columns[j] are the values and statuses of the j-th stream.
+        '''
+        fields = [ quote(d) for d in descriptions ]
+        for fpath, values, statuses in zip(self.paths, columns, status_columns):
+            self.write_rows(fpath, values, statuses, fields)
+
+    def get_offsets(self):
+        '''
+        The current size of each stream's file, from which read_tail can later
+        read back the rows written after this point. The log should be flushed first.
+        '''
+        return [ os.path.getsize(fpath) for fpath in self.paths ]
+
+    def read_tail(self, offsets):
+        '''
+        Read back the values written to each stream since get_offsets returned offsets.
+
+        A final row which wasn't completely written, and any rows beyond the length
+        of the shortest stream (e.g. if the process died part way through a flush),
+        are truncated from the files so that the streams line up again.
+        '''
+        tails = []
+        for fpath, offset in zip(self.paths, offsets):
+            with open(fpath, 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+            tails.append((data, record_ends(data)))
+        n_rows = min(( len(ends) for _, ends in tails ), default=0)
+
+        columns = []
+        for fpath, offset, (data, ends) in zip(self.paths, offsets, tails):
+            length = int(ends[n_rows-1]) if n_rows > 0 else 0
+            if os.path.getsize(fpath) != offset + length:
+                os.truncate(fpath, offset + length)
+            rows = csv.reader(io.StringIO(data[:length].decode(), newline=''))
+            columns.append([ parse_value(row[0]) for row in rows ])
+        return columns
+
+    def flush(self, sync=False):
+        # Only this group's files, as the pool may be shared with other detectors.
+        self.writers.flush_dir(self.group_dir, sync)
+
+    def close(self):
+        self.writers.close_dir(self.group_dir)
+
+class ColumnarStateLog:
+
+    '''
+    Records the state of a group of streams in one set of append-only binary files.
+    See the top of this module for the layout. The files are written through
+    writers (a WriterPool), as the csvs are.
+    '''
+
+    def __init__(self, group_dir, names, writers=None, resume=False):
+        '''
+        If resume is True the existing files are appended to rather than truncated.
+        If writers is None, the log has a WriterPool of its own.
+        '''
+        self.group_dir = group_dir
+        self.names = list(names)
+        self.writers = writers if writers is not None else WriterPool()
+        self.description_ids = {}
+        self.n_steps = 0
+        self.values_path = os.path.join(group_dir, 'values.bin')
+        self.status_path = os.path.join(group_dir, 'status.bin')
+        self.description_ids_path = os.path.join(group_dir, 'description_ids.bin')
+        self.descriptions_path = os.path.join(group_dir, 'descriptions.jsonl')
+
+        if resume:
+            self.truncate_partial()
+        else:
+            with open(os.path.join(group_dir, 'streams.json'), 'w') as f:
+                json.dump({'names': self.names}, f)
+            # The description table first, so that a flush writes it out before the
+            # description ids (ColumnarLog ignores any steps whose description is missing).
+            self.writers.init_file(self.descriptions_path, '')
+            for fpath in [self.values_path, self.status_path, self.description_ids_path]:
+                self.writers.init_file(fpath, b'')
+
+    def truncate_partial(self):
+        '''
+        Reload the description table and cut any partially written step from the
+        end of the files, so that appending can continue from a complete step.
+        '''
+        log = ColumnarLog(self.group_dir)
+        self.n_steps = n_steps = len(log)
+        self.description_ids = { d: i for i, d in enumerate(log.descriptions) }
+        n_streams = len(self.names)
+        for fname, size in [('values.bin', 4*n_streams*n_steps),
+                ('status.bin', n_streams*n_steps), ('description_ids.bin', 4*n_steps),
+                ('descriptions.jsonl', log.descriptions_size)]:
+            os.truncate(os.path.join(self.group_dir, fname), size)
+
+    def get_description_id(self, description):
+        '''
+        Intern a description, adding it to the description table if it's new.
+        '''
+        description_id = self.description_ids.get(description)
+        if description_id is None:
+            description_id = self.description_ids[description] = len(self.description_ids)
+            self.writers.write(self.descriptions_path, json.dumps(description) + '\n')
+        return description_id
+
+    def append(self, values, statuses, description):
+        '''
+        Record one step of every stream in the group.
+        '''
+        description_id = self.get_description_id(description)
+        self.writers.write(self.values_path, np.asarray(values, dtype=np.float32).tobytes())
+        self.writers.write(self.status_path, bytes([ STATUS_CODES[status] for status in statuses ]))
+        self.writers.write(self.description_ids_path, np.uint32(description_id).tobytes())
+        self.n_steps += 1
+
+    def append_columns(self, columns, status_columns, descriptions):
+        '''
+        Record several steps of every stream in the group. columns[j] and
+        status_columns[j] are the values and statuses of the j-th stream.
+        '''
+        values = np.array(columns, dtype=np.float32).T
+        status_columns = np.asarray(status_columns)
+        codes = np.zeros(status_columns.shape, dtype=np.uint8)
+        for code, name in enumerate(STATUS_NAMES):
+            codes[status_columns == name] = code
+        description_ids = np.array(
+            [ self.get_description_id(d) for d in descriptions ], dtype=np.uint32)
+
+        self.writers.write(self.values_path, np.ascontiguousarray(values).tobytes())
+        self.writers.write(self.status_path, np.ascontiguousarray(codes.T).tobytes())
+        self.writers.write(self.description_ids_path, description_ids.tobytes())
+        self.n_steps += len(description_ids)
+
+    def get_offsets(self):
+        '''
+        The current number of steps, from which read_tail can later read back
+        the steps written after this point.
+        '''
+        return self.n_steps
+
+    def read_tail(self, offset):
+        '''
+        Read back the values written to each stream since get_offsets returned offset.
+        '''
+        self.flush()
+        return list(np.asarray(ColumnarLog(self.group_dir).values[offset:].T))
+
+    def flush(self, sync=False):
+        # Only this group's files, as the pool may be shared with other detectors.
+        self.writers.flush_dir(self.group_dir, sync)
+
+    def close(self):
+        self.writers.close_dir(self.group_dir)
+
+class ColumnarLog:
+
+    '''
+    A read-only, memory-mapped view of a group written by ColumnarStateLog.
+    - values: float32 array of shape (n_steps, n_streams)
+    - status: uint8 array of status codes, of shape (n_steps, n_streams)
+    - description_ids: uint32 array of shape (n_steps,)
+    - descriptions: the interned description table
+    '''
+
+    def __init__(self, group_dir):
+        with open(os.path.join(group_dir, 'streams.json')) as f:
+            self.names = json.load(f)['names']
+        # Only complete lines of the description table are read.
+        self.descriptions = []
+        self.descriptions_size = 0
+        with open(os.path.join(group_dir, 'descriptions.jsonl'), 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                self.descriptions.append(json.loads(line))
+                self.descriptions_size += len(line)
+
+        # A partially written final step (e.g. after a crash) is ignored.
+        n_streams = len(self.names)
+        n_steps = min(
+            os.path.getsize(os.path.join(group_dir, 'values.bin')) // (4*n_streams),
+            os.path.getsize(os.path.join(group_dir, 'status.bin')) // n_streams,
+            os.path.getsize(os.path.join(group_dir, 'description_ids.bin')) // 4,
+        ) if n_streams > 0 else 0
+        if n_steps > 0:
+            description_ids = np.fromfile(
+                os.path.join(group_dir, 'description_ids.bin'), dtype=np.uint32, count=n_steps)
+            # Don't include steps whose description didn't make it to disk.
+            unknown = np.nonzero(description_ids >= len(self.descriptions))[0]
+            if len(unknown) > 0:
+                n_steps = unknown[0]
+
+        self.values = ColumnarLog.map(group_dir, 'values.bin', np.float32, (n_steps, n_streams))
+        self.status = ColumnarLog.map(group_dir, 'status.bin', np.uint8, (n_steps, n_streams))
+        self.description_ids = ColumnarLog.map(group_dir, 'description_ids.bin', np.uint32, (n_steps,))
+
+    @staticmethod
+    def map(group_dir, fname, dtype, shape):
+        if shape[0] == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(os.path.join(group_dir, fname), dtype=dtype, mode='r', shape=shape)
+
+    def __len__(self):
+        return len(self.values)
+
+    def stream(self, name):
+        '''
+        Get the values, statuses and descriptions of a single stream.
+        '''
+        j = self.names.index(name)
+        statuses = np.array(STATUS_NAMES)[self.status[:, j]]
+        descriptions = np.array(self.descriptions, dtype=object)[self.description_ids]
+        return np.asarray(self.values[:, j]), statuses, descriptions
+
+def is_columnar(group_dir):
+    '''
+    Has this group been written in the columnar layout?
+    '''
+    return os.path.exists(os.path.join(group_dir, 'streams.json'))
+
+def get_stream_names(group_dir):
+    '''
+    The names of the streams in a group, in column order if it's columnar
+    (the csv layout has no column order, so these are sorted).
+    '''
+    if is_columnar(group_dir):
+        with open(os.path.join(group_dir, 'streams.json')) as f:
+            return json.load(f)['names']
+    paths = sorted(glob(os.path.join(group_dir, '*.csv')))
+    return [ os.path.splitext(os.path.basename(path))[0] for path in paths ]
+
+def convert_csv_log(write_dir):
+    '''
+    Convert the csv files written by a MultiDriftDetector under write_dir
+    into the columnar layout. The csv files are left in place.
+    '''
+    for group in ['features', 'predictions', 'accuracy']:
+        group_dir = os.path.join(os.path.abspath(write_dir), group)
+        paths = sorted(glob(os.path.join(group_dir, '*.csv')))
+        if len(paths) == 0:
+            continue
+        names = [ os.path.splitext(os.path.basename(path))[0] for path in paths ]
+
+        columns = []
+        status_columns = []
+        for path in paths:
+            with open(path, newline='') as f:
+                rows = list(csv.DictReader(f))
+            columns.append([ parse_value(row['value']) for row in rows ])
+            status_columns.append([ row['status'] for row in rows ])
+        # Every stream in a group gets the same description at each step.
+        descriptions = [ row['description'] for row in rows ]
+
+        if len(set(map(len, columns))) > 1:
+            raise ValueError(f'The streams in {group_dir} have different lengths.')
+
+        log = ColumnarStateLog(group_dir, names)
+        if len(descriptions) > 0:
+            log.append_columns(columns, status_columns, descriptions)
+        log.close()
+
+def quote(description):
+    # Descriptions are written as quoted csv fields, so they can contain
+    # commas, newlines and quotes (which are doubled).
+    return '"' + str(description).replace('"', '""') + '"'
+
+def record_ends(data):
+    '''
+    The offset just after each complete row of csv data (bytes). A newline inside a
+    quoted description doesn't end a row, and neither does a final row without a newline.
+    '''
+    chars = np.frombuffer(data, dtype=np.uint8)
+    in_quotes = np.logical_xor.accumulate(chars == ord('"'))
+    return np.flatnonzero((chars == ord('\n')) & ~in_quotes) + 1
+
+def parse_value(value):
+    # Values are written as numbers, or as True/False for label and accuracy streams.
+    if value == 'True':
+        return 1.0
+    if value == 'False':
+        return 0.0
+    return float(value)
+
+if __name__ == '__main__':
+
+    if len(sys.argv) != 2:
+        raise ValueError('There should be one command line argument specifying the drift detector status directory.')
+    convert_csv_log(sys.argv[1])
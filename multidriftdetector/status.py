@@ -0,0 +1,63 @@
+class StatusSets:
+
+    '''
+    Which streams of a group (e.g. the features) have the status WARNING, and
+    which have DRIFT.
+
+    The sets are updated from the drift events as statuses change, rather than
+    by scanning every stream, so asking for them takes time in proportion to the
+    size of the answer rather than the number of streams.
+    '''
+
+    def __init__(self, names=()):
+        self.position = {}
+        self.streams = {'WARNING': set(), 'DRIFT': set()}
+        for name in names:
+            self.add_name(name)
+
+    def add_name(self, name):
+        # Streams are listed in the order they were added to the group.
+        self.position[name] = len(self.position)
+
+    def update(self, event):
+        if event.old_status in self.streams:
+            self.streams[event.old_status].discard(event.stream)
+        if event.new_status in self.streams:
+            self.streams[event.new_status].add(event.stream)
+
+    def reset(self, statuses):
+        '''
+        Set the sets from the status of every stream, given as (name, status) pairs.
+        '''
+        for streams in self.streams.values():
+            streams.clear()
+        for name, status in statuses:
+            if status in self.streams:
+                self.streams[status].add(name)
+
+    def get(self, status):
+        return sorted(self.streams[status], key=self.position.get)
+
+    def count(self, status):
+        return len(self.streams[status])
+
+class DetectorStatus:
+
+    '''
+    The status of a MultiDriftDetector at one point in time:
+    - concept: the status of the loss stream ('NORMAL', 'WARNING' or 'DRIFT')
+    - warning[group], drift[group]: the streams of each group ('features',
+      'labels' and 'emerging') with the status WARNING or DRIFT
+    '''
+
+    def __init__(self, concept, status_sets):
+        self.concept = concept
+        self.warning = { group: sets.get('WARNING') for group, sets in status_sets.items() }
+        self.drift = { group: sets.get('DRIFT') for group, sets in status_sets.items() }
+
+    def is_normal(self):
+        return self.concept == 'NORMAL' and \
+            not any(self.warning.values()) and not any(self.drift.values())
+
+    def __repr__(self):
+        return f'DetectorStatus(concept={self.concept!r}, warning={self.warning!r}, drift={self.drift!r})'
@@ -0,0 +1,360 @@
+import os
+import sys
+import json
+import time
+import socket
+from glob import glob
+import numpy as np
+from multidriftdetector.bidirectional_hddm import BidirectionalHDDM
+from multidriftdetector.datastream import DriftEvent, STATUS_NAMES, DIRECTION_NAMES, \
+    NORMAL, WARNING, DRIFT, INCREASE, DECREASE
+from multidriftdetector.status import StatusSets, DetectorStatus
+
+'''
+Mergeable summaries of a MultiDriftDetector's streams, for when the instances
+are split across several nodes, each running a detector of its own.
+
+Every HDDM_A_test statistic is a count: how many values a stream has seen (n)
+and how many of them were False (c). So each node only needs to export, for
+each window of time, the counts of each stream over that window. Counts add up,
+so an aggregator can sum the windows of every node, and run the Hoeffding
+tests over the totals, to decide whether the stream as a whole has drifted
+without any raw values leaving the nodes.
+
+Under a shared directory:
+    nodes/<node>/window_<window>.json   a node's counts for one window
+    nodes/<node>/closed                 the node has exported its last window
+    aggregate.json                      the aggregator's statuses, as of the last window it merged
+
+The aggregator tests at the end of each window rather than after each value,
+so it can be a window later to raise a drift than a single detector would be.
+'''
+
+# The groups of streams which are summarised, and the detector's state log of each.
+# (The emerging token streams are left out, as each node finds its own tokens.)
+GROUP_LOGS = {
+    'features': 'feature_log',
+    'labels': 'label_log',
+    'accuracy': 'loss_log',
+}
+
+def write_json(path, obj):
+    # Write to a temporary file first, so that a reader never sees half a file.
+    with open(path+'.tmp', 'w') as f:
+        json.dump(obj, f)
+    os.replace(path+'.tmp', path)
+
+def offsets_reach(offsets, saved):
+    # Whether the logs, at offsets, still reach the saved offsets of the same streams.
+    if isinstance(offsets, list):
+        return len(offsets) == len(saved) and all( s <= o for o, s in zip(offsets, saved) )
+    return saved <= offsets
+
+class SummaryExporter:
+
+    '''
+    Exports the counts of a MultiDriftDetector's streams to a shared directory,
+    once per window of window_seconds.
+
+    Call export() periodically (at least once a window). It reads the values written
+    to the detector's state logs since the last export, and adds their counts to the
+    file of the current window, so several exports in one window add up. A window's
+    file is complete once the node has written a later one, or close() has been called.
+    The offsets read up to are saved in the window's file too, so that an exporter
+    of a restored detector carries on from the last export.
+
+    >>> exporter = SummaryExporter(detector, shared_dir, node='node1')
+    >>> ...
+    >>> exporter.export()
+    >>> ...
+    >>> exporter.close()
+    '''
+
+    def __init__(
+            self,
+            detector, # The MultiDriftDetector whose streams are summarised
+            shared_dir, # The directory shared with the other nodes and the aggregator
+            node=None, # The name of this node (by default the host name and process id)
+            window_seconds=60, # The length of a window
+            clock=time.time # The time in seconds, which windows are counted from
+            ):
+        self.detector = detector
+        self.node = node if node is not None else f'{socket.gethostname()}-{os.getpid()}'
+        self.node_dir = os.path.join(os.path.abspath(shared_dir), 'nodes', self.node)
+        os.makedirs(self.node_dir, exist_ok=True)
+        self.window_seconds = window_seconds
+        self.clock = clock
+        self.window = None
+        self.counts = {}
+
+        # Only the values written from now on are counted, unless the node's last
+        # exporter saved the offsets it had read up to, and the logs still reach them
+        # (i.e. the detector was restored), in which case it carries on from there.
+        saved = self.load_offsets()
+        with detector.all_locked():
+            detector.flush_files()
+            self.offsets = {}
+            for group, log in self.get_logs().items():
+                offsets = log.get_offsets()
+                if group in saved and offsets_reach(offsets, saved[group]):
+                    offsets = saved[group]
+                self.offsets[group] = offsets
+
+    def get_logs(self):
+        return { group: getattr(self.detector, name)
+            for group, name in GROUP_LOGS.items() if hasattr(self.detector, name) }
+
+    def load_offsets(self):
+        # The offsets saved with the node's last window, if any.
+        paths = sorted(glob(os.path.join(self.node_dir, 'window_*.json')))
+        if not paths:
+            return {}
+        with open(paths[-1]) as f:
+            return json.load(f).get('offsets', {})
+
+    def export(self):
+        '''
+        Add the counts of the values written since the last export to the
+        current window's file. Returns the window.
+        '''
+        window = int(self.clock() // self.window_seconds)
+        detector = self.detector
+
+        # Hold every lock, so that the logs are read back up to the same step.
+        with detector.all_locked():
+            detector.flush_files()
+            tails = {}
+            for group, log in self.get_logs().items():
+                tails[group] = (log.names, log.read_tail(self.offsets.get(group, 0)))
+                self.offsets[group] = log.get_offsets()
+
+        path = os.path.join(self.node_dir, f'window_{window:012d}.json')
+        if window != self.window:
+            # Carry on from the counts already exported for the window, if any
+            # (e.g. by this node before a restart).
+            self.window = window
+            self.counts = {}
+            if os.path.exists(path):
+                with open(path) as f:
+                    for group, counts in json.load(f)['groups'].items():
+                        self.counts[group] = { name: (n, c)
+                            for name, n, c in zip(counts['names'], counts['n'], counts['c']) }
+        for group, (names, columns) in tails.items():
+            counts = self.counts.setdefault(group, {})
+            for name, values in zip(names, columns):
+                n, c = counts.get(name, (0, 0))
+                values = np.asarray(values, dtype=float)
+                # A stream counts its False values (see BidirectionalHDDM.detect).
+                counts[name] = (n + len(values), c + int(np.count_nonzero(values == 0)))
+
+        write_json(path, {
+            'node': self.node,
+            'window': window,
+            'window_seconds': self.window_seconds,
+            'groups': { group: {
+                'names': list(counts),
+                'n': [ n for n, _ in counts.values() ],
+                'c': [ c for _, c in counts.values() ],
+            } for group, counts in self.counts.items() },
+            # Saved with the counts, so that after a restart the next exporter
+            # counts the rows written since, and nothing is counted twice.
+            'offsets': self.offsets,
+        })
+        return window
+
+    def close(self):
+        '''
+        Export the last counts, and mark the node's windows as complete.
+        '''
+        self.export()
+        with open(os.path.join(self.node_dir, 'closed'), 'w'):
+            pass
+
+class WindowedHDDM(BidirectionalHDDM):
+
+    '''
+    A BidirectionalHDDM which is given the counts of a window at a time (with
+    detect_counts), rather than one value at a time.
+    '''
+
+    __slots__ = []
+
+    # The statistics, which are all counts (the bounds come from the confidences).
+    count_fields = BidirectionalHDDM.__slots__[1:]
+
+class SummaryAggregator:
+
+    '''
+    Merges the windows exported by every node under a shared directory, and
+    tests each stream's totals for drift, in the same way as the nodes' detectors
+    (with the MultiDriftDetector's feature_dd, label_dd and concept_dd confidences).
+
+    poll() merges each window which every node has finished, in order. A node which
+    appears after a window has been merged only counts from its next window.
+    Each change in a stream's status is passed to drift_action as a DriftEvent,
+    with the window it came from as its step.
+
+    >>> aggregator = SummaryAggregator(shared_dir)
+    >>> aggregator.run(interval=10)
+    '''
+
+    def __init__(
+            self,
+            shared_dir, # The directory the nodes export their windows to
+            drift_action=print, # Called with each DriftEvent
+            detectors=None # The HDDM_A_test of each group (by default the MultiDriftDetector's)
+            ):
+        if detectors is None:
+            from multidriftdetector.multidriftdetector import MultiDriftDetector
+            detectors = {
+                'features': MultiDriftDetector.feature_dd,
+                'labels': MultiDriftDetector.label_dd,
+                'accuracy': MultiDriftDetector.concept_dd,
+            }
+        self.shared_dir = os.path.abspath(shared_dir)
+        self.nodes_dir = os.path.join(self.shared_dir, 'nodes')
+        self.drift_action = drift_action
+        self.detectors = detectors
+        self.last_window = None # the last window merged
+
+        # name -> [WindowedHDDM, status code] for each group
+        self.streams = { group: {} for group in GROUP_LOGS }
+        self.status_sets = { group: StatusSets() for group in ['features', 'labels'] }
+
+        # Carry on from where a previous aggregator stopped.
+        path = os.path.join(self.shared_dir, 'aggregate.json')
+        if os.path.exists(path):
+            self.load(path)
+
+    def get_windows(self):
+        # node -> (the windows it has exported, whether it's closed)
+        nodes = {}
+        for node_dir in glob(os.path.join(self.nodes_dir, '*')):
+            paths = glob(os.path.join(node_dir, 'window_*.json'))
+            windows = sorted( int(os.path.basename(path)[7:-5]) for path in paths )
+            nodes[os.path.basename(node_dir)] = (windows, os.path.exists(os.path.join(node_dir, 'closed')))
+        return nodes
+
+    def poll(self):
+        '''
+        Merge the windows which every node has finished, since the last one merged.
+        Returns the windows merged.
+        '''
+        nodes = self.get_windows()
+        windows = sorted(set( w for node_windows, _ in nodes.values() for w in node_windows
+            if self.last_window is None or w > self.last_window ))
+
+        merged = []
+        for window in windows:
+            if not all(closed or (node_windows and node_windows[-1] > window)
+                    for node_windows, closed in nodes.values()):
+                break
+            self.merge(window, [ node for node, (node_windows, _) in nodes.items() if window in node_windows ])
+            self.last_window = window
+            merged.append(window)
+        if merged:
+            self.save()
+        return merged
+
+    def merge(self, window, nodes):
+        # Sum the counts of each stream over the nodes, then test the totals.
+        totals = { group: {} for group in GROUP_LOGS }
+        for node in nodes:
+            with open(os.path.join(self.nodes_dir, node, f'window_{window:012d}.json')) as f:
+                summary = json.load(f)
+            for group, counts in summary['groups'].items():
+                group_totals = totals.setdefault(group, {})
+                for name, n, c in zip(counts['names'], counts['n'], counts['c']):
+                    total_n, total_c = group_totals.get(name, (0, 0))
+                    group_totals[name] = (total_n + n, total_c + c)
+
+        for group, group_totals in totals.items():
+            for name, (n, c) in group_totals.items():
+                self.update(group, name, n, c, window)
+
+    def update(self, group, name, n, c, window):
+        streams = self.streams[group]
+        if name not in streams:
+            streams[name] = [WindowedHDDM(self.detectors[group]), NORMAL]
+            if group in self.status_sets:
+                self.status_sets[group].add_name(name)
+        stream = streams[name]
+
+        # As DataStream.add_value: once drift is found the stream isn't updated.
+        if stream[1] == DRIFT:
+            return
+        warning_increase, drift_increase, warning_decrease, drift_decrease = \
+            stream[0].detect_counts(n, c, bidirectional=group != 'accuracy')
+        if group == 'accuracy':
+            # Only increases in loss are signalled.
+            warning_decrease = drift_decrease = False
+
+        if drift_increase or drift_decrease:
+            new_status = DRIFT
+            direction = INCREASE if drift_increase else DECREASE
+        elif warning_increase or warning_decrease:
+            new_status = WARNING
+            direction = INCREASE if warning_increase else DECREASE
+        else:
+            new_status = NORMAL
+            direction = NORMAL
+
+        if new_status != stream[1]:
+            event = DriftEvent(name, STATUS_NAMES[stream[1]], STATUS_NAMES[new_status],
+                DIRECTION_NAMES[direction], step=window)
+            stream[1] = new_status
+            if group in self.status_sets:
+                self.status_sets[group].update(event)
+            self.drift_action(event)
+
+    def get_status(self):
+        '''
+        The statuses of the merged streams, as a DetectorStatus (see status.py).
+        '''
+        concept = self.streams['accuracy'].get('accuracy', [None, NORMAL])[1]
+        return DetectorStatus(STATUS_NAMES[concept], self.status_sets)
+
+    def save(self):
+        write_json(os.path.join(self.shared_dir, 'aggregate.json'), {
+            'last_window': self.last_window,
+            'streams': { group: { name: {
+                'status': STATUS_NAMES[status],
+                'counts': [ getattr(detector, field) for field in WindowedHDDM.count_fields ],
+            } for name, (detector, status) in streams.items() } for group, streams in self.streams.items() },
+        })
+
+    def load(self, path):
+        with open(path) as f:
+            state = json.load(f)
+        self.last_window = state['last_window']
+        for group, streams in state['streams'].items():
+            for name, stream in streams.items():
+                detector = WindowedHDDM(self.detectors[group])
+                for field, value in zip(WindowedHDDM.count_fields, stream['counts']):
+                    setattr(detector, field, value)
+                self.streams[group][name] = [detector, STATUS_NAMES.index(stream['status'])]
+                if group in self.status_sets:
+                    self.status_sets[group].add_name(name)
+        for group, sets in self.status_sets.items():
+            sets.reset( (name, STATUS_NAMES[status]) for name, (_, status) in self.streams[group].items() )
+
+    def run(self, interval=10, until_closed=False):
+        '''
+        Poll every interval seconds. If until_closed is True, return once every
+        node has closed and its windows have been merged.
+        '''
+        while True:
+            self.poll()
+            if until_closed:
+                nodes = self.get_windows()
+                if nodes and all( closed and (not node_windows or node_windows[-1] <= self.last_window)
+                        for node_windows, closed in nodes.values() ):
+                    return
+            time.sleep(interval)
+
+if __name__ == '__main__':
+
+    if len(sys.argv) not in [2, 3]:
+        raise ValueError('The command line arguments should be the shared directory, and optionally the poll interval in seconds.')
+    aggregator = SummaryAggregator(sys.argv[1])
+    aggregator.run(float(sys.argv[2]) if len(sys.argv) == 3 else 10)
@@ -0,0 +1,200 @@
+import os
+import time
+import weakref
+import threading
+from collections import OrderedDict
+
+class BufferedFile:
+
+    '''
+    A single stream file, with a buffer of rows which haven't been written to it
+    yet, and a handle on it while it's open. The buffer is kept while the handle
+    is closed, so a file is only opened when its rows are written out.
+    The rows are bytes rather than text if binary is True.
+    '''
+
+    def __init__(self, fpath, binary=False):
+        self.fpath = fpath
+        self.binary = binary
+        self.handle = None
+        self.rows = []
+        self.nbytes = 0
+        self.unsynced = False # written since it was last fsynced?
+
+    def write(self, text):
+        self.rows.append(text)
+        self.nbytes += len(text)
+
+    def flush(self, sync=False):
+        # The handle must be open.
+        if self.rows:
+            self.handle.write((b'' if self.binary else '').join(self.rows))
+            self.rows = []
+            self.nbytes = 0
+            self.unsynced = True
+        self.handle.flush()
+        if sync and self.unsynced:
+            os.fsync(self.handle.fileno())
+            self.unsynced = False
+
+    def close(self):
+        if self.handle is None and self.rows:
+            self.handle = open(self.fpath, 'ab' if self.binary else 'a')
+        if self.handle is not None:
+            self.flush()
+            self.handle.close()
+            self.handle = None
+
+class WriterPool:
+
+    '''
+    Keeps an append handle open per stream file, rather than opening and closing
+    the file for every row. A file is written as text or bytes, according to
+    what it's first given.
+
+    Rows are buffered in memory and written out when either:
+    - more than buffer_size characters are buffered across all files,
+    - a row is written more than flush_interval seconds after the last flush,
+    - flush() or close() is called, or the pool is used as a context manager and exits.
+
+    At most max_open handles are kept open at once. A flush writes to the files
+    which are already open first, then opens the others in turn, closing the least
+    recently flushed handles to make room. So with more files than max_open, each
+    file is opened at most once per flush, however many rows it was given.
+
+    The pool can be written to from several threads at once.
+    '''
+
+    def __init__(
+            self,
+            buffer_size=1<<20, # Flush once this many characters are buffered
+            flush_interval=5.0, # Flush once this many seconds have passed since the last flush
+            max_open=512 # The maximum number of file handles to keep open
+            ):
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.max_open = max_open
+        self.lock = threading.RLock()
+        self.files = {} # every file written to since it was last closed
+        self.open_files = OrderedDict() # those with an open handle, least recently flushed first
+        self.buffered = 0
+        self.last_flush = time.monotonic()
+
+        # Make sure buffered rows aren't lost if the pool is never closed.
+        self._finalizer = weakref.finalize(self, WriterPool._close_files, self.files)
+
+    @staticmethod
+    def _close_files(files):
+        for f in files.values():
+            f.close()
+        files.clear()
+
+    def _open(self, f, mode='a'):
+        if self.max_open and len(self.open_files) >= self.max_open:
+            _, oldest = self.open_files.popitem(last=False)
+            oldest.close()
+        f.handle = open(f.fpath, mode+'b' if f.binary else mode)
+        self.open_files[f.fpath] = f
+
+    def init_file(self, fpath, header):
+        '''
+        Create (or truncate) the file at fpath and write its header.
+        '''
+        with self.lock:
+            f = self.files.pop(fpath, None)
+            if f is not None:
+                self.buffered -= f.nbytes
+                self.open_files.pop(fpath, None)
+                f.close()
+            f = self.files[fpath] = BufferedFile(fpath, isinstance(header, bytes))
+            self._open(f, 'w')
+            f.write(header)
+            self.buffered += len(header)
+
+    def write(self, fpath, text):
+        '''
+        Append text to the file at fpath.
+        '''
+        with self.lock:
+            f = self.files.get(fpath)
+            if f is None:
+                f = self.files[fpath] = BufferedFile(fpath, isinstance(text, bytes))
+            f.write(text)
+            self.buffered += len(text)
+
+            if self.buffered >= self.buffer_size or \
+                    time.monotonic() - self.last_flush >= self.flush_interval:
+                self.flush()
+
+    def flush(self, sync=False):
+        '''
+        Write all buffered rows to disk. If sync is True, also fsync every file
+        so that the rows survive a crash of the machine, not just the process.
+        '''
+        with self.lock:
+            # The open files first, so that the handles closed to make room
+            # for the others have already been written to.
+            for f in list(self.open_files.values()):
+                self.open_files.move_to_end(f.fpath)
+                f.flush(sync)
+            self._flush_closed(self.files.values(), sync)
+            self.buffered = 0
+            self.last_flush = time.monotonic()
+
+    def flush_dir(self, directory, sync=False):
+        '''
+        Write the buffered rows of the files under directory to disk, leaving
+        the others buffered, for when the pool is shared by several detectors.
+        '''
+        prefix = os.path.join(os.path.abspath(directory), '')
+        with self.lock:
+            files = [ f for fpath, f in self.files.items() if os.path.abspath(fpath).startswith(prefix) ]
+            self.buffered -= sum( f.nbytes for f in files )
+            for f in files:
+                if f.handle is not None:
+                    self.open_files.move_to_end(f.fpath)
+                    f.flush(sync)
+            self._flush_closed(files, sync)
+
+    def _flush_closed(self, files, sync):
+        for f in files:
+            if f.handle is None and (f.rows or (sync and f.unsynced)):
+                self._open(f)
+                f.flush(sync)
+
+    def close(self):
+        '''
+        Flush and close every open file. The pool can still be written to afterwards.
+        '''
+        with self.lock:
+            WriterPool._close_files(self.files)
+            self.open_files.clear()
+            self.buffered = 0
+            self.last_flush = time.monotonic()
+
+    def close_dir(self, directory):
+        '''
+        Flush and close the open files under directory, leaving the others open,
+        for when the pool is shared by several detectors.
+        '''
+        prefix = os.path.join(os.path.abspath(directory), '')
+        with self.lock:
+            for fpath in [ fpath for fpath in self.files if os.path.abspath(fpath).startswith(prefix) ]:
+                self.close_file(fpath)
+
+    def close_file(self, fpath):
+        '''
+        Flush and close a single file, e.g. before it's deleted.
+        '''
+        with self.lock:
+            f = self.files.pop(fpath, None)
+            if f is not None:
+                self.open_files.pop(fpath, None)
+                self.buffered -= f.nbytes
+                f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
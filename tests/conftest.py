@@ -0,0 +1,11 @@
+import pytest
+from synthetic import generate_stream, run_reference
+
+@pytest.fixture(scope='session')
+def stream():
+    return generate_stream()
+
+@pytest.fixture(scope='session')
+def reference(stream, tmp_path_factory):
+    # The logs, events and status from feeding the stream one record at a time.
+    return run_reference(str(tmp_path_factory.mktemp('reference')), stream)
@@ -0,0 +1,94 @@
+import os
+import numpy as np
+from multidriftdetector.multidriftdetector import MultiDriftDetector
+
+'''
+A synthetic stream of instances, predictions and labels with drifts in it, and
+helpers for feeding it to a MultiDriftDetector and comparing what it wrote.
+Also synthetic referral texts, for the BOWMachine.
+'''
+
+N_FEATURES = 24
+FEATURE_NAMES = [ f'F{j}' for j in range(N_FEATURES) ]
+LABEL_NAMES = ['P0', 'P1', 'P2']
+N_INSTANCES = 1200
+
+def generate_stream(seed=0):
+    # Sparse counts whose rates change part way through, so that there are drifts.
+    rng = np.random.default_rng(seed)
+    rates = np.full((N_INSTANCES, N_FEATURES), 0.15)
+    rates[600:, :4] = 0.7
+    rates[800:, 4:8] = 0.0
+    features = (rng.random(rates.shape) < rates) * rng.integers(1, 4, rates.shape)
+    predictions = rng.dirichlet(np.ones(len(LABEL_NAMES)), N_INSTANCES)
+    predictions[700:, 1] += 1
+    labels = [ LABEL_NAMES[k] for k in rng.integers(0, 2, N_INSTANCES) ]
+    return features, predictions / predictions.sum(axis=1, keepdims=True), labels
+
+# The words of the synthetic referral texts.
+WORDS = ['chest', 'pain', 'fever', 'cough', 'headache', 'nausea', 'rash', 'fracture',
+    'swelling', 'dizziness', 'fatigue', 'bleeding', 'infection', 'asthma', 'diabetes']
+
+def make_texts(n, seed=0, new_words=()):
+    # Texts of 8 of the words each (or of new_words too), as well as a few in every text.
+    rng = np.random.default_rng(seed)
+    words = WORDS + list(new_words)
+    return [ ' '.join(rng.choice(words, 8)) + f' Patient {i} was seen on 12/03.' for i in range(n) ]
+
+def make_detector(write_dir, events, vectorized=False, **kwargs):
+    detector = MultiDriftDetector(write_dir, drift_action=events.append, **kwargs)
+    detector.set_features(FEATURE_NAMES, vectorized=vectorized)
+    detector.set_labels(LABEL_NAMES)
+    return detector
+
+def add_records(detector, stream, ids, sparse=False):
+    # Add each instance, prediction and label of the stream, one at a time.
+    features, predictions, labels = stream
+    for i in ids:
+        if sparse:
+            nonzero = np.flatnonzero(features[i])
+            detector.add_sparse_instance((nonzero, features[i, nonzero]), i, f'doc {i}')
+        else:
+            detector.add_instance(features[i], i, f'doc {i}')
+        detector.add_prediction(predictions[i], i, f'doc {i}')
+        detector.add_label(labels[i], i)
+
+def add_batches(detector, stream, batch_size=250):
+    features, predictions, labels = stream
+    for start in range(0, N_INSTANCES, batch_size):
+        ids = range(start, min(start + batch_size, N_INSTANCES))
+        descriptions = [ f'doc {i}' for i in ids ]
+        detector.add_instances(features[ids.start:ids.stop], ids, descriptions)
+        detector.add_predictions(predictions[ids.start:ids.stop], ids, descriptions)
+        detector.add_labels(labels[ids.start:ids.stop], ids)
+
+def read_logs(write_dir):
+    # The contents of every state log file (not the checkpoints or the journal).
+    logs = {}
+    for root, dirs, fnames in os.walk(write_dir):
+        dirs[:] = [ d for d in dirs if d != 'checkpoints' ]
+        for fname in fnames:
+            if not fname.endswith('.jsonl'):
+                path = os.path.join(root, fname)
+                with open(path, 'rb') as f:
+                    logs[os.path.relpath(path, write_dir)] = f.read()
+    return logs
+
+def summarise(events):
+    # Batches and sparse catch-ups pass on their events stream by stream, so the order differs.
+    return sorted( (e.stream, e.old_status, e.new_status, e.direction, e.instance_id) for e in events )
+
+def get_status(detector):
+    status = detector.get_status(display=False)
+    return status.concept, \
+        { group: sorted(names) for group, names in status.warning.items() }, \
+        { group: sorted(names) for group, names in status.drift.items() }
+
+def run_reference(write_dir, stream):
+    # Feed the stream one record at a time. Returns the logs, events and status.
+    events = []
+    detector = make_detector(write_dir, events)
+    add_records(detector, stream, range(N_INSTANCES))
+    status = get_status(detector)
+    detector.close()
+    return read_logs(write_dir), summarise(events), status
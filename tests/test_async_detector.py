@@ -0,0 +1,91 @@
+import os
+import asyncio
+import numpy as np
+import pytest
+from multidriftdetector.async_detector import AsyncDetector
+from synthetic import N_INSTANCES, FEATURE_NAMES, make_detector, read_logs, summarise, get_status
+
+'''
+An AsyncDetector should add its records to the detector as they'd have been added
+directly, and lose only the records which fail.
+'''
+
+def test_same_as_direct(stream, reference, tmp_path):
+    features, predictions, labels = stream
+    events = []
+
+    async def main():
+        async with AsyncDetector(make_detector(str(tmp_path), events), batch_size=100) as detector:
+            for i in range(N_INSTANCES):
+                await detector.add_instance(features[i], i, f'doc {i}')
+                await detector.add_prediction(predictions[i], i, f'doc {i}')
+                await detector.add_label(labels[i], i)
+            await detector.join()
+            status = get_status(detector.detector)
+            assert detector.added == 3 * N_INSTANCES
+            assert detector.failed == 0
+        return status
+
+    status = asyncio.run(main())
+    logs, reference_events, reference_status = reference
+    assert read_logs(str(tmp_path)) == logs
+    assert summarise(events) == reference_events
+    assert status == reference_status
+
+def test_overflow(tmp_path):
+    async def main(overflow):
+        detector = AsyncDetector(make_detector(str(tmp_path / overflow), []), max_queue=2, overflow=overflow)
+        # The worker doesn't get to run until this coroutine waits on something.
+        for i in range(5):
+            await detector.add_instance(np.zeros(len(FEATURE_NAMES)), i)
+        await detector.join()
+        added, dropped = detector.added, detector.dropped
+        await detector.close()
+        return added, dropped
+
+    assert asyncio.run(main('drop_oldest')) == (2, 3)
+    with pytest.raises(asyncio.QueueFull):
+        asyncio.run(main('error'))
+
+def test_wrong_shape_rejected(tmp_path):
+    async def main():
+        async with AsyncDetector(make_detector(str(tmp_path), [])) as detector:
+            with pytest.raises(ValueError):
+                await detector.add_instance(np.zeros(3), 0)
+            with pytest.raises(ValueError):
+                await detector.add_instance(np.zeros((2, len(FEATURE_NAMES))), 0)
+            with pytest.raises(ValueError):
+                await detector.add_prediction([0.5, 0.5], 0)
+            assert detector.queue_depth == 0
+    asyncio.run(main())
+
+def test_failed_label(stream, tmp_path):
+    # One label of a batch has an id which can't be used, and only it is lost.
+    predictions = stream[1]
+    ids = [0, 1, [2], 3, 4]
+
+    async def main():
+        async with AsyncDetector(make_detector(str(tmp_path), [])) as detector:
+            for i in range(5):
+                await detector.add_prediction(predictions[i], i)
+            await detector.join()
+            for i in ids:
+                await detector.add_label('P0', i)
+            await detector.join()
+            assert detector.failed == 1
+            assert detector.added == 9
+            assert detector.detector.loss_stream.detector.total_n == 4
+    asyncio.run(main())
+    with open(os.path.join(str(tmp_path), 'accuracy', 'accuracy.csv')) as f:
+        assert len(f.readlines()) == 5
+
+def test_failed_labels_change_nothing(stream, tmp_path):
+    # A batch of labels with a bad id is rejected before any label is added.
+    detector = make_detector(str(tmp_path), [])
+    detector.add_predictions(stream[1][:5], range(5))
+    with pytest.raises(TypeError):
+        detector.add_labels(['P0'] * 5, [0, 1, [2], 3, 4])
+    assert len(detector.prediction_queue) == 5
+    detector.add_labels(['P0'] * 5, range(5))
+    assert detector.loss_stream.detector.total_n == 5
+    detector.close()
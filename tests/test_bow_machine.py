@@ -0,0 +1,136 @@
+import os
+import json
+import numpy as np
+import pytest
+from multidriftdetector.bow_machine import BOWMachine
+from multidriftdetector.multidriftdetector import MultiDriftDetector
+from synthetic import WORDS, make_texts, make_detector, read_logs
+
+'''
+A BOWMachine should convert text the same way however it's asked to: online or
+for training, dense or sparse, in one process or several, and after a reload.
+'''
+
+@pytest.fixture(scope='module')
+def texts():
+    return make_texts(300)
+
+@pytest.fixture(scope='module')
+def fitted(texts):
+    bow_machine = BOWMachine()
+    return bow_machine, bow_machine.convert_train_data(texts)
+
+def test_online_same_as_training(texts, fitted):
+    bow_machine, train = fitted
+    assert list(train.columns) == sorted(WORDS)
+    vectorizer = bow_machine.vectorizer
+    online = bow_machine.convert_online(texts)
+    assert bow_machine.vectorizer is vectorizer
+    assert online.equals(train)
+    # Every frame shares the one columns object.
+    assert online.columns is train.columns
+
+def test_sparse(texts, fitted):
+    bow_machine, train = fitted
+    sparse = bow_machine.convert_online(texts, sparse=True)
+    assert sparse.format == 'csr'
+    assert np.array_equal(sparse.toarray(), train.values)
+
+def test_needs_vocabulary(texts, fitted):
+    with pytest.raises(ValueError):
+        BOWMachine().convert_online(texts)
+    with pytest.raises(ValueError):
+        fitted[0].convert_train_data(texts)
+
+def test_hashing(texts):
+    bow_machine = BOWMachine(n_buckets=64)
+    assert bow_machine.vocab[:3] == ['hash00', 'hash01', 'hash02']
+    assert len(bow_machine.vocab) == 64
+    # Nothing is fitted, so each chunk converts the same on its own.
+    whole = bow_machine.convert_train_data(texts)
+    parts = [ bow_machine.convert_online(texts[start:start+50]) for start in range(0, len(texts), 50) ]
+    assert np.array_equal(np.vstack([ part.values for part in parts ]), whole.values)
+    # Every token is counted in some bucket: the 8 words, 'patient' and 'seen'.
+    assert (whole.values.sum(axis=1) == 10).all()
+    with pytest.raises(ValueError):
+        bow_machine.oov_tokens(texts)
+
+def test_parallel(texts, fitted):
+    train = fitted[1]
+    bow_machine = BOWMachine()
+    # A generator is read twice (once to fit, once to convert), so it's read into a list.
+    parallel = bow_machine.convert_train_data(( text for text in texts ), n_jobs=2, chunk_size=40)
+    assert list(parallel.columns) == list(train.columns)
+    assert np.array_equal(parallel.values, train.values)
+    chunks = list(bow_machine.convert_chunks(iter(texts), chunk_size=70, n_jobs=2))
+    assert [ chunk.shape[0] for chunk in chunks ] == [70, 70, 70, 70, 20]
+    assert np.array_equal(np.vstack([ chunk.toarray() for chunk in chunks ]), train.values)
+
+def test_parallel_empty(fitted):
+    empty = fitted[0].convert_online([], n_jobs=2)
+    assert empty.shape == (0, len(WORDS))
+
+def test_parallel_error(texts, fitted):
+    # A worker's error is raised by the caller, rather than the chunk being lost.
+    with pytest.raises(AttributeError):
+        fitted[0].convert_online(texts[:10] + [None], n_jobs=2, chunk_size=5)
+
+@pytest.mark.parametrize('n_buckets', [None, 32])
+def test_save_load(n_buckets, texts, tmp_path):
+    bow_machine = BOWMachine(n_buckets=n_buckets)
+    expected = bow_machine.convert_train_data(texts)
+    path = os.path.join(str(tmp_path), 'bow.json')
+    bow_machine.save(path)
+    loaded = BOWMachine.load(path)
+    assert loaded.vocab == bow_machine.vocab
+    assert loaded.convert_online(texts).equals(expected)
+
+def test_load_checks(texts, fitted, tmp_path):
+    path = os.path.join(str(tmp_path), 'bow.json')
+    fitted[0].save(path)
+    write_dir = str(tmp_path / 'detector')
+    detector = MultiDriftDetector(write_dir, drift_action=lambda event: None)
+    detector.set_features(fitted[0].vocab)
+    detector.close()
+    assert BOWMachine.load(path, write_dir).vocab == fitted[0].vocab
+
+    other_dir = str(tmp_path / 'other')
+    detector = MultiDriftDetector(other_dir, drift_action=lambda event: None)
+    detector.set_features(fitted[0].vocab[:-1])
+    detector.close()
+    with pytest.raises(ValueError, match='do not match'):
+        BOWMachine.load(path, other_dir)
+
+    # A hashing BOWMachine saved with other settings would put tokens in other buckets.
+    BOWMachine(n_buckets=32).save(path)
+    with open(path) as f:
+        state = json.load(f)
+    state['settings']['lowercase'] = False
+    with open(path, 'w') as f:
+        json.dump(state, f)
+    with pytest.raises(ValueError, match='changed'):
+        BOWMachine.load(path)
+
+def test_packed(texts, fitted):
+    bow_machine, train = fitted
+    # 15 words, so the last byte of each row is only partly used.
+    packed = bow_machine.convert_online(texts, packed=True)
+    assert np.array_equal(packed, np.packbits(train.values > 0, axis=1))
+    chunks = list(bow_machine.convert_chunks(texts, chunk_size=100, packed=True))
+    assert np.array_equal(np.vstack(chunks), packed)
+
+def test_packed_instances(stream, tmp_path):
+    presence = (stream[0][:100] > 0).astype(np.uint8)
+    ids = range(100)
+    expected_dir = str(tmp_path / 'expected')
+    detector = make_detector(expected_dir, [])
+    detector.add_instances(presence, ids)
+    detector.close()
+
+    write_dir = str(tmp_path / 'packed')
+    detector = make_detector(write_dir, [], sparse_window=7)
+    detector.add_packed_instances(BOWMachine.pack(presence), ids)
+    with pytest.raises(ValueError, match='bytes'):
+        detector.add_packed_instances(np.zeros((1, 2), dtype=np.uint8), [100])
+    detector.close()
+    assert read_logs(write_dir) == read_logs(expected_dir)
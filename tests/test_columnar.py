@@ -0,0 +1,74 @@
+import io
+import os
+import numpy as np
+import pandas as pd
+from multidriftdetector.multidriftdetector import MultiDriftDetector
+from multidriftdetector.state_log import ColumnarLog, convert_csv_log
+from multidriftdetector.writers import WriterPool
+from synthetic import N_INSTANCES, FEATURE_NAMES, LABEL_NAMES, make_detector, add_records, \
+    summarise, get_status
+
+'''
+The columnar state log should record the same values, statuses and descriptions
+as the csvs, written through the detector's WriterPool.
+'''
+
+def read_csv_group(logs, group, names):
+    # The values, statuses and descriptions of a group, from the csv logs of the reference.
+    frames = [ pd.read_csv(io.BytesIO(logs[os.path.join(group, name+'.csv')]), keep_default_na=False)
+        for name in names ]
+    values = np.array([ frame.value.astype(float) for frame in frames ]).T
+    statuses = np.array([ frame.status for frame in frames ]).T
+    return values, statuses, list(frames[0].description)
+
+def assert_same_as_csv(write_dir, logs):
+    for group, names in [('features', FEATURE_NAMES), ('predictions', LABEL_NAMES), ('accuracy', ['accuracy'])]:
+        log = ColumnarLog(os.path.join(write_dir, group))
+        # A converted log has its streams in sorted order.
+        assert sorted(log.names) == sorted(names)
+        values, statuses, descriptions = read_csv_group(logs, group, log.names)
+        assert np.array_equal(np.asarray(log.values), values.astype(np.float32))
+        assert np.array_equal(np.array(['NORMAL', 'WARNING', 'DRIFT'])[log.status], statuses)
+        assert [ log.descriptions[i] for i in log.description_ids ] == descriptions
+
+def test_same_as_csv(stream, reference, tmp_path):
+    write_dir = str(tmp_path)
+    events = []
+    # Only a few handles, so that the pool has to close and reopen the files.
+    writers = WriterPool(buffer_size=1000, max_open=2)
+    detector = make_detector(write_dir, events, storage='columnar', writers=writers)
+    add_records(detector, stream, range(N_INSTANCES))
+    status = get_status(detector)
+    assert os.path.join(write_dir, 'features', 'values.bin') in writers.files
+    detector.close()
+
+    logs, reference_events, reference_status = reference
+    assert_same_as_csv(write_dir, logs)
+    assert summarise(events) == reference_events
+    assert status == reference_status
+
+def test_convert_csv_log(reference, tmp_path):
+    logs, _, _ = reference
+    for path, data in logs.items():
+        os.makedirs(os.path.join(str(tmp_path), os.path.dirname(path)), exist_ok=True)
+        with open(os.path.join(str(tmp_path), path), 'wb') as f:
+            f.write(data)
+    convert_csv_log(str(tmp_path))
+    assert_same_as_csv(str(tmp_path), logs)
+
+def test_partial_step_on_restore(stream, tmp_path):
+    write_dir = str(tmp_path)
+    detector = make_detector(write_dir, [], storage='columnar', checkpoint_every=100)
+    add_records(detector, stream, range(250))
+    detector.flush()
+    # Half of a step, as if the process died part way through writing it.
+    with open(os.path.join(write_dir, 'features', 'values.bin'), 'ab') as f:
+        f.write(b'\0' * 10)
+
+    restored = MultiDriftDetector(write_dir, drift_action=lambda event: None, storage='columnar', restore=True)
+    add_records(restored, stream, range(250, 300))
+    restored.close()
+    log = ColumnarLog(os.path.join(write_dir, 'features'))
+    assert len(log) == 300
+    assert os.path.getsize(os.path.join(write_dir, 'features', 'values.bin')) == 300 * 4 * len(FEATURE_NAMES)
+    assert np.array_equal(np.asarray(log.values), stream[0][:300].astype(np.float32))
@@ -0,0 +1,80 @@
+import time
+import pickle
+import threading
+from multidriftdetector.multidriftdetector import MultiDriftDetector
+from multidriftdetector.datastream import DataStream, DriftEvent
+from multidriftdetector.dispatcher import DriftDispatcher
+from synthetic import N_INSTANCES, FEATURE_NAMES, LABEL_NAMES, add_records, summarise
+
+'''
+A DriftDispatcher should pass every event on to its action from its own thread,
+gathered into lists, without the detector building the events' messages.
+'''
+
+def test_same_events(stream, reference, tmp_path):
+    calls = []
+    dispatcher = DriftDispatcher(calls.append, window=0.05)
+    detector = MultiDriftDetector(str(tmp_path), drift_action=dispatcher)
+    detector.set_features(FEATURE_NAMES)
+    detector.set_labels(LABEL_NAMES)
+    add_records(detector, stream, range(N_INSTANCES))
+    detector.close()
+    assert dispatcher.closed
+    assert summarise( event for events in calls for event in events ) == reference[1]
+
+def test_messages_built_in_thread(monkeypatch):
+    threads = []
+    status_message = DataStream.status_message
+    def recorded(name, new_status):
+        threads.append(threading.current_thread())
+        return status_message(name, new_status)
+    monkeypatch.setattr(DataStream, 'status_message', staticmethod(recorded))
+
+    messages = []
+    dispatcher = DriftDispatcher(lambda events: messages.extend(map(str, events)), window=0)
+    event = DriftEvent('F0', 'NORMAL', 'DRIFT', 'INCREASE')
+    assert threads == []
+    dispatcher(event)
+    dispatcher.close()
+    assert threads == [dispatcher.thread]
+    assert 'F0' in messages[0] and 'DRIFT' in messages[0]
+
+def test_gathered_in_window():
+    calls = []
+    dispatcher = DriftDispatcher(calls.append, window=0.5)
+    for k in range(5):
+        dispatcher(DriftEvent(f'F{k}', 'NORMAL', 'WARNING', 'INCREASE'))
+    dispatcher.flush()
+    assert [ len(events) for events in calls ] == [5]
+    dispatcher.close()
+
+def test_failing_action():
+    calls = []
+    def action(events):
+        calls.append(events)
+        raise RuntimeError('sink is down')
+    dispatcher = DriftDispatcher(action, window=0)
+    dispatcher(DriftEvent('F0', 'NORMAL', 'WARNING', 'INCREASE'))
+    dispatcher.flush()
+    dispatcher(DriftEvent('F1', 'NORMAL', 'WARNING', 'INCREASE'))
+    dispatcher.close()
+    assert [ events[0].stream for events in calls ] == ['F0', 'F1']
+
+def test_full_queue_drops():
+    release = threading.Event()
+    dispatcher = DriftDispatcher(lambda events: release.wait(), window=0, max_queue=2, block=False)
+    for k in range(6):
+        dispatcher(DriftEvent(f'F{k}', 'NORMAL', 'WARNING', 'INCREASE'))
+        time.sleep(0.05)
+    release.set()
+    dispatcher.close()
+    # One event is with the action, and two are waiting.
+    assert dispatcher.dropped == 3
+
+def test_pickled_event():
+    event = DriftEvent('F0', 'WARNING', 'DRIFT', 'DECREASE', step=3)
+    event.instance_id = ('doc', 7)
+    event.tenant = 'a'
+    restored = pickle.loads(pickle.dumps(event))
+    assert vars(restored) == vars(event)
+    assert str(restored) == str(event)
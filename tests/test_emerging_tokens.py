@@ -0,0 +1,73 @@
+import os
+import numpy as np
+from multidriftdetector.emerging_tokens import CountMinSketch, EmergingTokens
+from multidriftdetector.bow_machine import BOWMachine
+from multidriftdetector.multidriftdetector import MultiDriftDetector
+from synthetic import make_texts
+
+'''
+Tokens outside the vocabulary which become common should emerge, and be given
+streams of their own, however many rare tokens there are around them.
+'''
+
+def noise(rng, n):
+    # Tokens which each occur in very few documents.
+    return [ f'rare{k}' for k in rng.integers(0, 100000, n) ]
+
+def test_sketch_never_undercounts():
+    rng = np.random.default_rng(0)
+    sketch = CountMinSketch(width=64, depth=3)
+    tokens = noise(rng, 2000)
+    counts = {}
+    for token in tokens:
+        counts[token] = counts.get(token, 0) + 1
+        sketch.add(token)
+    assert all( sketch.estimate(token) >= count for token, count in counts.items() )
+    assert sketch.counts.sum() == 3 * len(tokens)
+
+def test_common_token_emerges():
+    rng = np.random.default_rng(0)
+    tokens = EmergingTokens(max_emerged=2, n_candidates=10, min_documents=20, width=256)
+    emerged = []
+    for i in range(500):
+        document = noise(rng, 10)
+        if i >= 200:
+            document.append('covid')
+        if i >= 300:
+            document.append('mpox')
+        if i >= 400:
+            document.append('flu')
+        emerged.extend( (i, token) for token in tokens.add_document(document) )
+    # Estimates can only be high, so a token can emerge a little early. The third
+    # token doesn't emerge, as only two may.
+    assert [ token for _, token in emerged ] == ['covid', 'mpox']
+    assert 200 <= emerged[0][0] <= 219 and 300 <= emerged[1][0] <= 319
+    assert len(tokens.candidates) <= 10
+    assert [ token for token, _ in tokens.top(3) ] == ['covid', 'mpox', 'flu']
+
+def test_detector_streams(tmp_path):
+    write_dir = str(tmp_path)
+    bow_machine = BOWMachine()
+    bow_machine.convert_train_data(make_texts(200))
+    texts = make_texts(100, seed=1) + make_texts(100, seed=2, new_words=['covid'] * 5)
+
+    detector = MultiDriftDetector(write_dir, drift_action=lambda event: None, checkpoint_every=150)
+    detector.set_features(bow_machine.vocab)
+    detector.set_emerging_tokens(min_documents=20)
+    for i, (instance, tokens) in enumerate(zip(bow_machine.convert_online(texts).values,
+            bow_machine.oov_tokens(texts))):
+        detector.add_instance(instance, i)
+        detector.add_oov_tokens(tokens, i)
+    # The tokens in every document were left out of the vocabulary too (see max_df).
+    assert 'covid' not in bow_machine.vocab
+    assert set(detector.emerging_streams) == {'patient', 'seen', 'covid'}
+    detector.close()
+
+    # The stream starts from the instance after the token emerged.
+    with open(os.path.join(write_dir, 'emerging', 'covid', 'covid.csv')) as f:
+        n_rows = len(f.readlines()) - 1
+    assert 0 < n_rows < 100
+    restored = MultiDriftDetector(write_dir, drift_action=lambda event: None, restore=True)
+    assert set(restored.emerging_streams) == {'patient', 'seen', 'covid'}
+    assert restored.emerging_streams['covid'].detector.total_n == n_rows
+    restored.close()
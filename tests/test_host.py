@@ -0,0 +1,124 @@
+import os
+import time
+import shutil
+import threading
+from multidriftdetector.host import DetectorHost
+from multidriftdetector.multidriftdetector import MultiDriftDetector
+from multidriftdetector.writers import WriterPool
+from synthetic import FEATURE_NAMES, LABEL_NAMES, add_records, read_logs, summarise, get_status
+
+'''
+A DetectorHost should give each tenant the same results as a detector of its own,
+however often the tenant is hibernated, and whether or not the last host was closed.
+'''
+
+def add_tenant(host, name, **settings):
+    tenant = host.add_tenant(name, **settings)
+    tenant.set_features(FEATURE_NAMES)
+    tenant.set_labels(LABEL_NAMES)
+    return tenant
+
+def test_hibernation(stream, reference, tmp_path):
+    events = []
+    host = DetectorHost(str(tmp_path), drift_action=events.append, flush_interval=None, max_loaded=1)
+    add_tenant(host, 'a')
+    add_tenant(host, 'b')
+    assert not host.is_loaded('a')
+    for start in range(0, 1200, 300):
+        # Using each tenant in turn hibernates the other.
+        add_records(host['a'], stream, range(start, start + 300))
+        host['b'].add_instance(stream[0][start], start)
+        assert host.is_loaded('a') != host.is_loaded('b')
+    status = get_status(host['a'])
+    host.close()
+
+    logs, reference_events, reference_status = reference
+    tenant_logs = read_logs(os.path.join(str(tmp_path), 'a'))
+    del tenant_logs['tenant.pkl']
+    assert tenant_logs == logs
+    assert summarise( event for event in events if event.tenant == 'a' ) == reference_events
+    assert status == reference_status
+
+def test_restart_without_close(stream, tmp_path):
+    host = DetectorHost(str(tmp_path), flush_interval=None)
+    add_tenant(host, 'a')
+    host.add_tenant('b')
+    # The host dies, without closing or hibernating its tenants.
+    host.writers.flush()
+
+    restarted = DetectorHost(str(tmp_path), flush_interval=None)
+    assert restarted.tenants == ['a', 'b']
+    assert restarted['a'].feature_names == FEATURE_NAMES
+    add_records(restarted['a'], stream, range(10))
+    restarted['b'].set_features(['x'])
+    restarted['b'].add_instance([1], 0)
+    restarted.close()
+
+def test_tenant_without_checkpoint(tmp_path):
+    # As left by a host from before tenants were checkpointed when added.
+    host = DetectorHost(str(tmp_path), flush_interval=None)
+    host.add_tenant('a')
+    host.close()
+    shutil.rmtree(os.path.join(str(tmp_path), 'a', 'checkpoints'))
+
+    restarted = DetectorHost(str(tmp_path), flush_interval=None)
+    restarted['a'].set_features(['x'])
+    restarted['a'].add_instance([1], 0)
+    restarted.close()
+
+def test_restore_does_not_block_other_tenants(tmp_path, monkeypatch):
+    restore = MultiDriftDetector.restore
+    def slow_restore(detector):
+        time.sleep(1)
+        restore(detector)
+    monkeypatch.setattr(MultiDriftDetector, 'restore', slow_restore)
+
+    host = DetectorHost(str(tmp_path), flush_interval=None)
+    for name in ['a', 'b']:
+        host.add_tenant(name).set_features(['x', 'y'])
+    host.hibernate('a')
+    thread = threading.Thread(target=host['a'].add_instance, args=([1, 0], 0))
+    thread.start()
+    time.sleep(0.2)
+    start = time.monotonic()
+    host['b'].add_instance([0, 1], 1)
+    assert time.monotonic() - start < 0.5
+    thread.join()
+    host.close()
+
+def test_shared_writers_left_open(tmp_path):
+    writers = WriterPool()
+    other = os.path.join(str(tmp_path), 'other.txt')
+    writers.init_file(other, 'header\n')
+    host = DetectorHost(os.path.join(str(tmp_path), 'host'), flush_interval=None, writers=writers)
+    host.add_tenant('a').set_features(['x'])
+    host.close()
+    assert other in writers.files
+    writers.close()
+
+def test_flush(tmp_path, monkeypatch):
+    host = DetectorHost(str(tmp_path), flush_interval=None)
+    for name in ['a', 'b', 'c']:
+        host.add_tenant(name).set_features(['x'])
+        host[name].add_instance([1], 0)
+    calls = []
+    for method in ['flush', 'flush_dir']:
+        wrapped = getattr(host.writers, method)
+        monkeypatch.setattr(host.writers, method,
+            lambda *args, method=method, wrapped=wrapped: calls.append(method) or wrapped(*args))
+
+    # A tenant's own flush writes only its own files.
+    host['a'].flush()
+    assert calls == ['flush_dir']
+    assert not any( f.rows for fpath, f in host.writers.files.items()
+        if fpath.startswith(os.path.join(str(tmp_path), 'a', '')) )
+    assert host.writers.files[os.path.join(str(tmp_path), 'b', 'features', 'x.csv')].rows
+
+    # The host flushes the shared pool once, for every tenant.
+    calls.clear()
+    host.flush()
+    assert calls == ['flush']
+    assert not any( f.rows for f in host.writers.files.values() )
+    with open(os.path.join(str(tmp_path), 'c', 'features', 'x.csv')) as f:
+        assert len(f.readlines()) == 2
+    host.close()
@@ -0,0 +1,45 @@
+from synthetic import N_INSTANCES, make_detector, add_records, add_batches, \
+    read_logs, summarise, get_status
+
+'''
+Adding records in batches should give the same state logs, statuses and drift
+events as adding them one at a time.
+'''
+
+def test_reference_drifts(reference):
+    _, events, (_, _, drift) = reference
+    assert events
+    assert drift['features']
+
+def test_batches(stream, reference, tmp_path):
+    events = []
+    detector = make_detector(str(tmp_path), events)
+    add_batches(detector, stream)
+    status = get_status(detector)
+    detector.close()
+
+    logs, reference_events, reference_status = reference
+    assert read_logs(str(tmp_path)) == logs
+    assert summarise(events) == reference_events
+    assert status == reference_status
+
+def test_batches_and_records(stream, reference, tmp_path):
+    # Batches of different sizes, between records added one at a time.
+    features, predictions, labels = stream
+    events = []
+    detector = make_detector(str(tmp_path), events)
+    add_records(detector, stream, range(0, 100))
+    for start, end in [(100, 101), (101, 600), (600, 1000)]:
+        ids = range(start, end)
+        descriptions = [ f'doc {i}' for i in ids ]
+        detector.add_instances(features[start:end], ids, descriptions)
+        detector.add_predictions(predictions[start:end], ids, descriptions)
+        detector.add_labels(labels[start:end], ids)
+    add_records(detector, stream, range(1000, N_INSTANCES))
+    status = get_status(detector)
+    detector.close()
+
+    logs, reference_events, reference_status = reference
+    assert read_logs(str(tmp_path)) == logs
+    assert summarise(events) == reference_events
+    assert status == reference_status
@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse as sp
+from multidriftdetector.multidriftdetector import MultiDriftDetector
+from synthetic import FEATURE_NAMES, make_detector, read_logs
+
+'''
+An instance can be a list, a NumPy array, a pandas Series or DataFrame row, or a
+row of a scipy sparse matrix, and they should all be recorded the same way.
+'''
+
+N = 200
+
+def feature_logs(write_dir):
+    return { path: data for path, data in read_logs(write_dir).items() if path.startswith('features') }
+
+@pytest.fixture(scope='module')
+def expected(stream, tmp_path_factory):
+    write_dir = str(tmp_path_factory.mktemp('expected'))
+    detector = make_detector(write_dir, [])
+    for i in range(N):
+        detector.add_instance(stream[0][i], i)
+    detector.close()
+    return feature_logs(write_dir)
+
+@pytest.mark.parametrize('kind', ['list', 'series', 'row', 'frame', 'sparse'])
+def test_add_instance(kind, stream, expected, tmp_path):
+    features = stream[0][:N]
+    frame = pd.DataFrame(features, columns=FEATURE_NAMES)
+    matrix = sp.csr_matrix(features)
+    detector = make_detector(str(tmp_path), [])
+    for i in range(N):
+        instance = {
+            'list': lambda: features[i].tolist(),
+            'series': lambda: pd.Series(features[i], index=FEATURE_NAMES),
+            'row': lambda: frame.iloc[i],
+            'frame': lambda: frame.iloc[i:i+1],
+            'sparse': lambda: matrix[i],
+        }[kind]()
+        detector.add_instance(instance, i)
+    detector.close()
+    assert feature_logs(str(tmp_path)) == expected
+
+@pytest.mark.parametrize('kind', ['array', 'frame', 'sparse'])
+def test_add_instances(kind, stream, expected, tmp_path):
+    features = stream[0][:N]
+    instances = {
+        'array': features,
+        'frame': pd.DataFrame(features, columns=FEATURE_NAMES),
+        'sparse': sp.csr_matrix(features),
+    }[kind]
+    detector = make_detector(str(tmp_path), [])
+    detector.add_instances(instances[:150], range(150))
+    detector.add_instances(instances[150:], range(150, N))
+    detector.close()
+    assert feature_logs(str(tmp_path)) == expected
+
+def test_several_rows_rejected(stream, tmp_path):
+    frame = pd.DataFrame(stream[0][:3], columns=FEATURE_NAMES)
+    detector = make_detector(str(tmp_path), [])
+    for instances in [frame, stream[0][:3], sp.csr_matrix(stream[0][:3])]:
+        with pytest.raises(ValueError, match='single instance'):
+            detector.add_instance(instances, 0)
+    detector.close()
+
+def test_wrong_columns_rejected(stream, tmp_path):
+    detector = make_detector(str(tmp_path), [])
+    with pytest.raises(ValueError, match='columns'):
+        detector.add_instance(pd.Series(stream[0][0], index=FEATURE_NAMES[::-1]), 0)
+    with pytest.raises(ValueError):
+        detector.add_instance(stream[0][0][:-1], 0)
+    detector.close()
+
+def test_frame_after_restore(stream, tmp_path):
+    frame = pd.DataFrame(stream[0][:20], columns=FEATURE_NAMES)
+    detector = make_detector(str(tmp_path), [], checkpoint_every=5)
+    detector.add_instances(frame[:10], range(10))
+    detector.close()
+
+    restored = MultiDriftDetector(str(tmp_path), drift_action=lambda event: None, restore=True)
+    for i in range(10, 20):
+        restored.add_instance(frame.iloc[i], i)
+    restored.close()
@@ -0,0 +1,91 @@
+import os
+import uuid
+from multidriftdetector.prediction_store import PredictionStore
+from synthetic import make_detector
+
+'''
+A PredictionStore should evict the oldest entries beyond max_size or max_age,
+and still match the evicted entries from its spill index until they expire there.
+'''
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_max_size():
+    store = PredictionStore(max_size=3)
+    for i in range(5):
+        store.put(i, 'P0', 0.5)
+    assert list(store.entries) == [2, 3, 4]
+    assert store.pop(0) is None
+    assert store.pop(4) == ('P0', 0.5)
+    assert store.get_stats() == {'size': 2, 'hits': 1, 'misses': 1, 'evictions': 2,
+        'spill_hits': 0, 'spill_expired': 0}
+
+def test_max_age():
+    clock = Clock()
+    store = PredictionStore(max_age=10, clock=clock)
+    for i in range(20):
+        clock.now = i
+        store.put(i, 'P0', 0.5)
+    # Entries added before time 9 are older than 10 seconds.
+    assert list(store.entries) == list(range(9, 20))
+    assert store.pop(15) == ('P0', 0.5)
+    assert 15 not in store
+
+def test_spill(tmp_path):
+    clock = Clock()
+    store = PredictionStore(max_size=5, spill_path=os.path.join(str(tmp_path), 'spill'), clock=clock)
+    ids = [ uuid.uuid4() for _ in range(50) ]
+    for instance_id in ids:
+        store.put(instance_id, 'P1', 0.9)
+    assert len(store) == 5
+    assert len(store.spill) == 45
+    assert store.pop(ids[0]) == ('P1', 0.9)
+    assert store.pop(ids[0]) is None
+    assert (store.spill_hits, store.hits, store.misses) == (1, 1, 1)
+    store.close()
+
+def test_spill_expiry(tmp_path):
+    clock = Clock()
+    store = PredictionStore(max_age=10, spill_path=os.path.join(str(tmp_path), 'spill'), clock=clock)
+    for i in range(100):
+        clock.now = i
+        store.put(i, 'P0', 0.5)
+    # The index is only swept every tenth of spill_max_age, so a few expired entries can wait.
+    assert len(store.spill) <= 12
+    assert store.pop(85) == ('P0', 0.5)
+
+    # The entries in memory are spilled, then expire from the index in turn.
+    clock.now = 200
+    store.put('x', 'P0', 0.5)
+    assert len(store.spill) == 11
+    clock.now = 300
+    store.put('y', 'P0', 0.5)
+    assert list(store.spill.keys()) == [PredictionStore.spill_key('x')]
+    # Every one of the first hundred entries but 85 (which was matched) has expired.
+    assert store.spill_expired == 99
+    store.close()
+
+def test_no_spill_expiry(tmp_path):
+    store = PredictionStore(max_size=1, spill_path=os.path.join(str(tmp_path), 'spill'), spill_max_age=None)
+    for i in range(10):
+        store.put(i, 'P0', 0.5)
+    assert len(store.spill) == 9
+    store.close()
+
+def test_detector_store(stream, tmp_path):
+    # Labels for predictions which were evicted and dropped can't be used.
+    features, predictions, labels = stream
+    detector = make_detector(str(tmp_path), [], prediction_store=PredictionStore(max_size=10))
+    for i in range(20):
+        detector.add_prediction(predictions[i], i)
+    for i in range(20):
+        detector.add_label(labels[i], i)
+    assert detector.loss_stream.detector.total_n == 10
+    assert detector.prediction_queue.misses == 10
+    detector.close()
@@ -0,0 +1,118 @@
+import os
+import uuid
+from glob import glob
+import numpy as np
+import pandas as pd
+import pytest
+from multidriftdetector.multidriftdetector import MultiDriftDetector
+from synthetic import N_INSTANCES, LABEL_NAMES, make_detector, add_records, read_logs, \
+    summarise, get_status
+
+'''
+A detector restored from its last checkpoint should carry on as if it had never
+stopped, replaying the state logs and the prediction queue journal since then.
+'''
+
+def journals(write_dir):
+    return [ os.path.basename(fpath) for fpath in glob(os.path.join(write_dir, 'prediction_queue*.jsonl')) ]
+
+@pytest.mark.parametrize('vectorized', [False, True])
+def test_restore(vectorized, stream, reference, tmp_path):
+    write_dir = str(tmp_path)
+    events = []
+    detector = make_detector(write_dir, events, vectorized=vectorized, checkpoint_every=250)
+    add_records(detector, stream, range(650))
+    # Stop without closing, after the last checkpoint, so that the rows since are replayed.
+    detector.flush()
+
+    restored = MultiDriftDetector(write_dir, drift_action=events.append, checkpoint_every=250, restore=True)
+    add_records(restored, stream, range(650, N_INSTANCES))
+    status = get_status(restored)
+    restored.close()
+
+    logs, reference_events, reference_status = reference
+    assert read_logs(write_dir) == logs
+    assert summarise(events) == reference_events
+    assert status == reference_status
+
+def test_journal_rotated(stream, tmp_path):
+    write_dir = str(tmp_path)
+    predictions = stream[1]
+    detector = make_detector(write_dir, [], checkpoint_every=50)
+    for i in range(120):
+        detector.add_prediction(predictions[i], i)
+    # Each checkpoint starts a new journal, and the old one is deleted.
+    journal = os.path.join(write_dir, f'prediction_queue_{detector.checkpoint_count:08d}.jsonl')
+    assert journals(write_dir) == [os.path.basename(journal)]
+    detector.add_labels(['P0'] * 10, range(10))
+    detector.flush()
+    with open(journal) as f:
+        assert len(f.readlines()) == 20 + 10
+
+    restored = MultiDriftDetector(write_dir, drift_action=lambda event: None, checkpoint_every=50, restore=True)
+    assert len(restored.prediction_queue) == 110
+    assert restored.queue_file == journal
+    for i in range(10, 120):
+        restored.add_label('P1', i)
+    assert len(restored.prediction_queue) == 0
+    assert restored.loss_stream.detector.total_n == 120
+    restored.close()
+
+def test_stale_journals_removed(stream, tmp_path):
+    write_dir = str(tmp_path)
+    detector = make_detector(write_dir, [], checkpoint_every=5)
+    for i in range(7):
+        detector.add_prediction(stream[1][i], i)
+    detector.flush()
+    journal = os.path.basename(detector.queue_file)
+    # As left by a checkpoint which died after starting its journal.
+    open(os.path.join(write_dir, f'prediction_queue_{detector.checkpoint_count + 1:08d}.jsonl'), 'w').close()
+
+    restored = MultiDriftDetector(write_dir, drift_action=lambda event: None, restore=True)
+    assert journals(write_dir) == [journal]
+    assert len(restored.prediction_queue) == 7
+    restored.close()
+    # Starting afresh leaves only the new journal.
+    fresh = make_detector(write_dir, [])
+    assert journals(write_dir) == ['prediction_queue.jsonl']
+    fresh.close()
+
+def test_ids_round_trip(stream, tmp_path):
+    write_dir = str(tmp_path)
+    ids = [ 7, 'doc 7', 7.5, ('doc', 7), uuid.uuid4(), np.int64(8) ]
+    detector = make_detector(write_dir, [], checkpoint_every=1000)
+    detector.checkpoint()
+    for k, instance_id in enumerate(ids):
+        detector.add_prediction(stream[1][k], instance_id)
+    detector.flush()
+
+    # The ids are read back from the journal, rather than the checkpoint.
+    restored = MultiDriftDetector(write_dir, drift_action=lambda event: None, restore=True)
+    assert set(restored.prediction_queue.entries) == { 7, 'doc 7', 7.5, ('doc', 7), ids[4], 8 }
+    for instance_id in ids:
+        restored.add_label(LABEL_NAMES[0], instance_id)
+    assert len(restored.prediction_queue) == 0
+    restored.close()
+
+def test_multiline_descriptions(tmp_path):
+    write_dir = str(tmp_path)
+    descriptions = ['plain', 'Patient reports\nchest pain', 'says "ouch", twice', 'x\n\n"y"\n']
+    detector = MultiDriftDetector(write_dir, drift_action=lambda event: None, checkpoint_every=5)
+    detector.set_features(['a', 'b'])
+    for i in range(12):
+        detector.add_instance(np.array([i % 2, 1]), i, descriptions[i % 4])
+    detector.add_instances(np.ones((3, 2)), [12, 13, 14], descriptions[1:])
+    detector.flush()
+    status = get_status(detector)
+
+    # A final row which was only half written when the process died.
+    fpath = os.path.join(write_dir, 'features', 'a.csv')
+    with open(fpath, 'a') as f:
+        f.write('1.0,NORMAL,"half\nwritten')
+
+    restored = MultiDriftDetector(write_dir, drift_action=lambda event: None, restore=True)
+    assert get_status(restored) == status
+    restored.close()
+    written = pd.read_csv(fpath, keep_default_na=False)
+    assert len(written) == 15
+    assert list(written.description) == descriptions * 3 + descriptions[1:]
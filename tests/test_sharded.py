@@ -0,0 +1,72 @@
+import os
+import time
+import numpy as np
+import pytest
+from multiprocessing.shared_memory import SharedMemory
+from multidriftdetector.multidriftdetector import MultiDriftDetector
+from synthetic import N_INSTANCES, make_detector, add_records, read_logs, summarise, get_status
+
+'''
+Sharding the feature streams across worker processes should give the same logs,
+statuses and events as one process, and a failed worker shouldn't hang the detector.
+'''
+
+@pytest.mark.parametrize('n_shards', [1, 3])
+def test_same_as_one_process(n_shards, stream, reference, tmp_path):
+    events = []
+    detector = make_detector(str(tmp_path), events)
+    detector.shard_features(n_shards)
+    add_records(detector, stream, range(600))
+    features = stream[0]
+    detector.add_instances(features[600:900], range(600, 900), [ f'doc {i}' for i in range(600, 900) ])
+    for i in range(600, 900):
+        detector.add_prediction(stream[1][i], i, f'doc {i}')
+        detector.add_label(stream[2][i], i)
+    add_records(detector, stream, range(900, N_INSTANCES))
+    status = get_status(detector)
+    detector.close()
+
+    logs, reference_events, reference_status = reference
+    assert read_logs(str(tmp_path)) == logs
+    assert summarise(events) == reference_events
+    assert status == reference_status
+
+def make_sharded(write_dir):
+    detector = MultiDriftDetector(write_dir, drift_action=lambda event: None)
+    detector.set_features([ f'F{j}' for j in range(6) ])
+    detector.shard_features(2)
+    for i in range(10):
+        detector.add_instance(np.ones(6), i)
+    return detector
+
+def assert_closes(detector):
+    streams = detector.feature_streams
+    workers = list(streams.workers)
+    start = time.monotonic()
+    detector.close()
+    assert time.monotonic() - start < 30
+    assert not any( worker.is_alive() for worker in workers )
+    # The shared memory has been unlinked.
+    with pytest.raises(FileNotFoundError):
+        SharedMemory(streams.shm.name)
+
+def test_worker_error(tmp_path):
+    detector = make_sharded(str(tmp_path))
+    # A block the worker can't read, so it fails and stops answering.
+    detector.feature_streams.commands[0].put(('block', 0, 0, 1, 0, 'not a dtype', [], []))
+    with pytest.raises(RuntimeError, match='Feature shard 0 failed'):
+        detector.flush()
+    with pytest.raises(RuntimeError):
+        detector.add_instance(np.ones(6), 10)
+    assert_closes(detector)
+    # The other worker still wrote out its rows.
+    with open(os.path.join(str(tmp_path), 'features', 'F5.csv')) as f:
+        assert len(f.readlines()) == 11
+
+def test_worker_killed(tmp_path):
+    detector = make_sharded(str(tmp_path))
+    detector.feature_streams.workers[1].kill()
+    detector.feature_streams.workers[1].join()
+    with pytest.raises(RuntimeError, match='Feature shard 1 failed'):
+        detector.flush()
+    assert_closes(detector)
@@ -0,0 +1,78 @@
+import os
+import asyncio
+import pytest
+import scipy.sparse as sp
+from multidriftdetector.multidriftdetector import MultiDriftDetector
+from multidriftdetector.async_detector import AsyncDetector
+from synthetic import N_INSTANCES, FEATURE_NAMES, make_detector, add_records, read_logs, \
+    summarise, get_status
+
+'''
+Sparse instances should be recorded as the dense instances would have been, once
+the vectorized feature streams have been caught up.
+'''
+
+def assert_same_as_reference(write_dir, events, status, reference):
+    logs, reference_events, reference_status = reference
+    assert read_logs(write_dir) == logs
+    assert summarise(events) == reference_events
+    assert status == reference_status
+
+@pytest.mark.parametrize('sparse_window', [1, 7, 256])
+def test_pairs(sparse_window, stream, reference, tmp_path):
+    events = []
+    detector = make_detector(str(tmp_path), events, vectorized=True, sparse_window=sparse_window)
+    add_records(detector, stream, range(N_INSTANCES), sparse=True)
+    status = get_status(detector)
+    detector.close()
+    assert_same_as_reference(str(tmp_path), events, status, reference)
+
+@pytest.mark.parametrize('vectorized', [True, False])
+def test_csr_batches(vectorized, stream, reference, tmp_path, monkeypatch):
+    # Only a few rows are made dense at once.
+    monkeypatch.setattr(MultiDriftDetector, 'sparse_chunk_values', 10 * len(FEATURE_NAMES))
+    features, predictions, labels = stream
+    matrix = sp.csr_matrix(features)
+    events = []
+    detector = make_detector(str(tmp_path), events, vectorized=vectorized)
+    for start in range(0, N_INSTANCES, 100):
+        ids = range(start, start + 100)
+        descriptions = [ f'doc {i}' for i in ids ]
+        detector.add_instances(matrix[start:start+100], ids, descriptions)
+        for i in ids:
+            detector.add_prediction(predictions[i], i, f'doc {i}')
+            detector.add_label(labels[i], i)
+    status = get_status(detector)
+    detector.close()
+    assert_same_as_reference(str(tmp_path), events, status, reference)
+
+def test_held_until_status(stream, tmp_path):
+    detector = make_detector(str(tmp_path), [], vectorized=True, sparse_window=50)
+    add_records(detector, stream, range(20), sparse=True)
+    assert len(detector.sparse_instances) == 20
+    detector.get_status(display=False)
+    assert len(detector.sparse_instances) == 0
+    detector.close()
+
+def test_needs_vectorized_features(stream, tmp_path):
+    detector = make_detector(str(tmp_path), [])
+    with pytest.raises(ValueError, match='vectorized'):
+        detector.add_sparse_instance(([0, 3], [1, 2]), 0)
+    # A single sparse row is still made dense.
+    detector.add_instance(sp.csr_matrix(stream[0][:1]), 0)
+    detector.close()
+
+@pytest.mark.parametrize('vectorized', [True, False])
+def test_async_rows(vectorized, stream, tmp_path):
+    # An AsyncDetector holds sparse rows only if the features are vectorized.
+    matrix = sp.csr_matrix(stream[0][:30])
+
+    async def main():
+        async with AsyncDetector(make_detector(str(tmp_path), [], vectorized=vectorized)) as detector:
+            for i in range(30):
+                await detector.add_instance(matrix[i], i)
+            await detector.join()
+            assert (detector.added, detector.failed) == (30, 0)
+    asyncio.run(main())
+    with open(os.path.join(str(tmp_path), 'features', 'F0.csv')) as f:
+        assert len(f.readlines()) == 31
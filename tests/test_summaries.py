@@ -0,0 +1,100 @@
+import os
+import json
+import time
+from glob import glob
+from multiprocessing import get_context
+from multidriftdetector.summaries import SummaryExporter, SummaryAggregator, WindowedHDDM
+from synthetic import N_INSTANCES, FEATURE_NAMES, generate_stream, make_detector, add_records
+
+'''
+Nodes which each export the counts of their share of the instances should be
+merged by the aggregator into the same counts, and the same drifts, as one node
+which saw every instance.
+'''
+
+WINDOW = 100
+
+def run_node(node, ids, shared_dir, write_dir):
+    # Feed a node its instances, with the clock at the instance's index.
+    stream = generate_stream()
+    detector = make_detector(write_dir, [])
+    now = [ids[0]]
+    exporter = SummaryExporter(detector, shared_dir, node=node, window_seconds=WINDOW, clock=lambda: now[0])
+    for i in ids:
+        if i // WINDOW != now[0] // WINDOW:
+            # The last values of a window are exported before the clock moves on.
+            exporter.export()
+        now[0] = i
+        add_records(detector, stream, [i])
+    exporter.close()
+    detector.close()
+
+def aggregate(shared_dir):
+    events = []
+    aggregator = SummaryAggregator(shared_dir, drift_action=events.append)
+    return aggregator, events
+
+def merged_counts(aggregator):
+    return { group: { name: [ getattr(detector, field) for field in WindowedHDDM.count_fields ]
+        for name, (detector, _) in streams.items() } for group, streams in aggregator.streams.items() }
+
+def summarise(events):
+    return [ (e.stream, e.old_status, e.new_status, e.direction, e.step) for e in events ]
+
+def test_nodes_same_as_single_node(tmp_path):
+    single_dir = str(tmp_path / 'single')
+    run_node('single', range(N_INSTANCES), single_dir, str(tmp_path / 'single_node'))
+    single, single_events = aggregate(single_dir)
+    assert single.poll() == list(range(N_INSTANCES // WINDOW))
+
+    # Each node runs in a process of its own, while the aggregator polls.
+    shared_dir = str(tmp_path / 'shared')
+    n_nodes = 3
+    ctx = get_context('spawn')
+    processes = [ ctx.Process(target=run_node, args=(f'node{k}', range(k, N_INSTANCES, n_nodes),
+        shared_dir, str(tmp_path / f'node{k}'))) for k in range(n_nodes) ]
+    for process in processes:
+        process.start()
+    aggregator, events = aggregate(shared_dir)
+    deadline = time.monotonic() + 120
+    # Until every node has started, a node's windows could be merged without the others'.
+    while len(glob(os.path.join(shared_dir, 'nodes', '*'))) < n_nodes and time.monotonic() < deadline:
+        time.sleep(0.05)
+    while any( process.is_alive() for process in processes ) and time.monotonic() < deadline:
+        aggregator.poll()
+        time.sleep(0.1)
+    for process in processes:
+        process.join(1)
+        assert process.exitcode == 0
+    aggregator.poll()
+    assert aggregator.last_window == single.last_window
+
+    # The nodes' windows add up to every instance.
+    for name in FEATURE_NAMES:
+        n = 0
+        for path in glob(os.path.join(shared_dir, 'nodes', '*', 'window_*.json')):
+            with open(path) as f:
+                counts = json.load(f)['groups']['features']
+            n += counts['n'][counts['names'].index(name)]
+        assert n == N_INSTANCES
+
+    assert merged_counts(aggregator) == merged_counts(single)
+    assert summarise(events) == summarise(single_events)
+    assert repr(aggregator.get_status()) == repr(single.get_status())
+    # The features whose rates change drift.
+    drifted = aggregator.get_status().drift['features']
+    assert set(FEATURE_NAMES[:8]) & set(drifted)
+
+def test_aggregator_restart(tmp_path):
+    shared_dir = str(tmp_path / 'shared')
+    run_node('single', range(N_INSTANCES // 2), shared_dir, str(tmp_path / 'node'))
+    aggregator, _ = aggregate(shared_dir)
+    aggregator.poll()
+
+    # Carries on from aggregate.json, without merging any window twice.
+    restarted, events = aggregate(shared_dir)
+    assert restarted.last_window == aggregator.last_window
+    assert merged_counts(restarted) == merged_counts(aggregator)
+    assert repr(restarted.get_status()) == repr(aggregator.get_status())
+    assert restarted.poll() == []
+    assert events == []
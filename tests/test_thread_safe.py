@@ -0,0 +1,65 @@
+import threading
+import numpy as np
+import pytest
+from multidriftdetector.multidriftdetector import MultiDriftDetector
+from synthetic import FEATURE_NAMES, make_detector
+
+'''
+In thread-safe mode, threads can feed the detector at once without losing records,
+and a checkpoint falling due while a lock is held shouldn't deadlock.
+'''
+
+def run_in_thread(target):
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(60)
+    assert not thread.is_alive()
+
+@pytest.mark.parametrize('thread_safe', [False, True])
+def test_checkpoint_while_catching_up_sparse(thread_safe, tmp_path):
+    # Catching up the sparse instances adds records, which can be due a checkpoint
+    # while a checkpoint is already flushing them.
+    def run():
+        detector = MultiDriftDetector(str(tmp_path), drift_action=lambda event: None,
+            checkpoint_every=10, thread_safe=thread_safe)
+        detector.set_features([ f'F{j}' for j in range(5) ], vectorized=True)
+        for i in range(9):
+            detector.add_instance(np.ones(5), i)
+        for i in range(9, 14):
+            detector.add_sparse_instance(([0, 2], [1, 1]), i)
+        detector.checkpoint()
+        detector.close()
+    run_in_thread(run)
+
+def test_threads_lose_nothing(stream, tmp_path):
+    features, predictions, labels = stream
+    detector = make_detector(str(tmp_path), [], checkpoint_every=50, thread_safe=True)
+    n = 300
+
+    def add_instances():
+        for i in range(n):
+            detector.add_instance(features[i], i)
+
+    def add_predictions():
+        for i in range(n):
+            detector.add_prediction(predictions[i], i)
+        for i in range(n):
+            detector.add_label(labels[i], i)
+
+    def run():
+        threads = [ threading.Thread(target=target) for target in [add_instances, add_predictions] ]
+        for thread in threads:
+            thread.start()
+        for _ in range(5):
+            detector.checkpoint()
+        for thread in threads:
+            thread.join()
+    run_in_thread(run)
+
+    assert detector.feature_streams[FEATURE_NAMES[0]].detector.total_n == n
+    assert detector.loss_stream.detector.total_n == n
+    detector.close()
+    restored = MultiDriftDetector(str(tmp_path), drift_action=lambda event: None, restore=True)
+    assert restored.feature_streams[FEATURE_NAMES[0]].detector.total_n == n
+    assert restored.loss_stream.detector.total_n == n
+    restored.close()
@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+from tornado_mod.drift_detection.__init__ import HDDM_A_test
+from multidriftdetector.datastream import DataStream
+from multidriftdetector.detector_bank import HDDMBank, StreamBank
+from multidriftdetector.bidirectional_hddm import BidirectionalHDDM
+from synthetic import N_INSTANCES, make_detector, add_records, add_batches, read_logs, \
+    summarise, get_status
+
+'''
+A StreamBank should detect the same drifts as a DataStream per stream, for either
+test type of HDDM_A_test, whether it's given one vector of values at a time or a block.
+'''
+
+STATS = ['n_min', 'c_min', 'total_n', 'total_c', 'n_max', 'c_max']
+
+def make_values(seed, n_streams=20):
+    # Rates which fall and then rise again, at different times for each stream.
+    rng = np.random.default_rng(seed)
+    rates = np.full((900, n_streams), 0.5)
+    for k in range(n_streams):
+        start = rng.integers(100, 400)
+        rates[start:start+300, k] = 0.05 + 0.01 * k
+    return rng.random(rates.shape) >= rates
+
+@pytest.mark.parametrize('mode', ['records', 'batches'])
+def test_same_as_datastreams(mode, stream, reference, tmp_path):
+    events = []
+    detector = make_detector(str(tmp_path), events, vectorized=True)
+    if mode == 'records':
+        add_records(detector, stream, range(N_INSTANCES))
+    else:
+        add_batches(detector, stream)
+    status = get_status(detector)
+    detector.close()
+
+    logs, reference_events, reference_status = reference
+    assert read_logs(str(tmp_path)) == logs
+    assert summarise(events) == reference_events
+    assert status == reference_status
+
+@pytest.mark.parametrize('test_type', ['two-sided', 'one-sided'])
+def test_one_direction(test_type):
+    # A decrease resets a detector which only monitors increases if its test is two-sided,
+    # which changes the increases it finds afterwards.
+    values = make_values(0)
+    n_streams = values.shape[1]
+    prototype = HDDM_A_test(test_type=test_type)
+    detectors = [ HDDM_A_test(test_type=test_type) for _ in range(n_streams) ]
+    bidirectional = [ BidirectionalHDDM(prototype) for _ in range(n_streams) ]
+    bank = HDDMBank(prototype, n_streams)
+    n_drifts = 0
+    for x in values:
+        warning, drift = bank.update((~x).astype(np.int64))
+        for k in range(n_streams):
+            expected = detectors[k].run(bool(x[k]))
+            n_drifts += expected[1]
+            assert (warning[0, k], drift[0, k]) == expected
+            assert bidirectional[k].detect_counts(1, 0 if x[k] else 1, bidirectional=False)[:2] == expected
+            for stat in STATS:
+                assert getattr(bank, stat)[k] == getattr(detectors[k], stat) == getattr(bidirectional[k], stat)
+    assert n_drifts > 0
+
+@pytest.mark.parametrize('test_type', ['two-sided', 'one-sided'])
+@pytest.mark.parametrize('bidirectional', [True, False])
+def test_bank_same_as_streams(test_type, bidirectional):
+    values = make_values(1)
+    names = [ f's{k}' for k in range(values.shape[1]) ]
+
+    def stream_events(k, single_pass):
+        events = []
+        stream = DataStream(HDDM_A_test(test_type=test_type), events.append, names[k],
+            bidirectional=bidirectional, single_pass=single_pass)
+        for x in values[:, k]:
+            stream.add_value(bool(x))
+        return [ (e.stream, e.old_status, e.new_status, e.direction) for e in events ]
+
+    expected = []
+    for k in range(len(names)):
+        events = stream_events(k, single_pass=False)
+        assert stream_events(k, single_pass=True) == events
+        expected.extend(events)
+    assert any( new_status == 'DRIFT' for _, _, new_status, _ in expected )
+
+    for block_size in [1, 900]:
+        events = []
+        bank = StreamBank(names, HDDM_A_test(test_type=test_type), events.append, bidirectional)
+        for start in range(0, len(values), block_size):
+            if block_size == 1:
+                bank.add_values(values[start])
+            else:
+                bank.add_block(values[start:start+block_size])
+        events = [ (e.stream, e.old_status, e.new_status, e.direction) for e in events ]
+        assert sorted(events, key=lambda e: names.index(e[0])) == expected
@@ -0,0 +1,55 @@
+import os
+from multidriftdetector.writers import WriterPool
+
+'''
+A WriterPool should write every row it's given, in order, however few handles
+it may keep open, and flush or close only the files it's asked to.
+'''
+
+def read(fpath, mode='r'):
+    with open(fpath, mode) as f:
+        return f.read()
+
+def test_few_handles(tmp_path):
+    writers = WriterPool(buffer_size=50, flush_interval=3600, max_open=2)
+    paths = [ os.path.join(str(tmp_path), f'{k}.csv') for k in range(5) ]
+    for fpath in paths:
+        writers.init_file(fpath, 'value\n')
+    for i in range(20):
+        for fpath in paths:
+            writers.write(fpath, f'{i}\n')
+    assert len(writers.open_files) <= 2
+    writers.close()
+    for fpath in paths:
+        assert read(fpath) == 'value\n' + ''.join( f'{i}\n' for i in range(20) )
+
+def test_bytes(tmp_path):
+    writers = WriterPool()
+    fpath = os.path.join(str(tmp_path), 'values.bin')
+    writers.init_file(fpath, b'')
+    writers.write(fpath, b'\x00\x01')
+    writers.write(fpath, b'\x02')
+    writers.close()
+    assert read(fpath, 'rb') == b'\x00\x01\x02'
+
+def test_flush_dir(tmp_path):
+    writers = WriterPool(flush_interval=3600)
+    a = os.path.join(str(tmp_path), 'a', 'x.csv')
+    b = os.path.join(str(tmp_path), 'b', 'x.csv')
+    for fpath in [a, b]:
+        os.makedirs(os.path.dirname(fpath))
+        writers.init_file(fpath, 'value\n')
+        writers.write(fpath, '1\n')
+    writers.flush_dir(os.path.join(str(tmp_path), 'a'))
+    assert read(a) == 'value\n1\n'
+    assert writers.files[b].rows
+    assert writers.buffered == len('value\n1\n')
+
+    # A file can be closed and deleted without the pool writing to it again.
+    writers.close_file(a)
+    os.remove(a)
+    assert a not in writers.files
+    writers.flush()
+    assert not os.path.exists(a)
+    assert read(b) == 'value\n1\n'
+    writers.close()